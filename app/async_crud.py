@@ -0,0 +1,204 @@
+from datetime import datetime, tzinfo, UTC
+from typing import Callable, Iterator, List
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.models import DashboardData, OccupancyPublic, StateUpdate, User, BoatPass, OcrResult, BoatPassCreate, State, StateBase
+from app import crud
+from app.crud import next_changes_cursor, state_changed, states_changed, mark_edited, boat_passes_created, build_boat_pass, boat_passes_page_statement, dashboard_statement, dashboard_data_from_row, dashboard_states_statement, row_boxes_statement, row_ocr_results_statement, passes_with_row_boxes, attach_row_boxes, occupancy_range
+from app.core.detections import iter_ocr_results
+from app.core import occupancy, state_changes
+from app.core.dashboard_cache import dashboard_cache
+from app.core.app_logger import AppLogger
+from app.core.app_config import app_config
+import logging
+
+# Async counterparts of app.crud, used when API_DB_ASYNC is enabled. Sessions are created with expire_on_commit=False
+# and relationships are loaded eagerly because lazy loading is not possible on an async session.
+
+logger = AppLogger(__name__, logging._nameToLevel[app_config.LOG_LEVEL]).get_logger()
+
+async def get_user_by_id(*, session: AsyncSession, user_id: int) -> User | None:
+    return await session.get(User, user_id)
+
+async def get_user_by_email(*, session: AsyncSession, email: str) -> User | None:
+    statement = select(User).where(User.email == email)
+    session_user = (await session.exec(statement)).first()
+    return session_user
+
+async def get_user_by_username(*, session: AsyncSession, username: str) -> User | None:
+    statement = select(User).where(User.username == username)
+    session_user = (await session.exec(statement)).first()
+    return session_user
+
+async def link_boat_passes(*, session: AsyncSession, boat_passes: List[BoatPass]) -> List[State]:
+    # The State lookups of linking run on the sync session behind the async one
+    return await session.run_sync(lambda sync_session: crud.link_boat_passes(session=sync_session, boat_passes=boat_passes))
+
+async def detection_ids(*, session: AsyncSession, boat_passes: List[BoatPassCreate]) -> tuple[Iterator[int], Iterator[int]] | None:
+    return await session.run_sync(lambda sync_session: crud.detection_ids(session=sync_session, boat_passes=boat_passes))
+
+async def create_boat_pass(*, session: AsyncSession, boat_pass: BoatPassCreate, before_commit: Callable[[], None] | None = None, link: bool = False) -> BoatPass:
+    boat_pass_db = build_boat_pass(boat_pass, await detection_ids(session=session, boat_passes=[boat_pass]))
+    session.add(boat_pass_db)
+    await session.flush()
+    logger.debug(f"Created boat pass: {boat_pass_db.id}")
+    try:
+        changed = await link_boat_passes(session=session, boat_passes=[boat_pass_db]) if link else []
+        if before_commit is not None:
+            before_commit()
+    except Exception:
+        await session.rollback()
+        raise
+    await session.commit()
+    boat_passes_created([boat_pass_db])
+    states_changed(changed)
+    return boat_pass_db
+
+async def create_boat_passes(*, session: AsyncSession, boat_passes: List[BoatPassCreate], before_commit: Callable[[], None] | None = None, link: bool = False) -> List[BoatPass]:
+    ids = await detection_ids(session=session, boat_passes=boat_passes)
+    boat_passes_db = [build_boat_pass(boat_pass, ids) for boat_pass in boat_passes]
+    session.add_all(boat_passes_db)
+    changed = []
+    if link or before_commit is not None:
+        await session.flush()
+        try:
+            changed = await link_boat_passes(session=session, boat_passes=boat_passes_db) if link else []
+            if before_commit is not None:
+                before_commit()
+        except Exception:
+            await session.rollback()
+            raise
+    await session.commit()
+    boat_passes_created(boat_passes_db)
+    states_changed(changed)
+    logger.debug(f"Created {len(boat_passes_db)} boat passes")
+    return boat_passes_db
+
+async def load_row_boxes(*, session: AsyncSession, boat_passes: List[BoatPass]) -> List[BoatPass]:
+    row_passes = passes_with_row_boxes(boat_passes)
+    if row_passes:
+        attach_row_boxes(row_passes, (await session.exec(row_boxes_statement(boat_pass_ids=[boat_pass.id for boat_pass in row_passes]))).all())
+    return boat_passes
+
+async def get_all_boat_passes(*, session: AsyncSession) -> List[BoatPass]:
+    statement = select(BoatPass)
+    session_boat_passes = (await session.exec(statement)).all()
+    return await load_row_boxes(session=session, boat_passes=session_boat_passes)
+
+async def get_boat_passes_page(*, session: AsyncSession, limit: int, cursor: tuple[datetime, int] | None = None, camera_id: int | None = None, since: datetime | None = None, until: datetime | None = None) -> List[BoatPass]:
+    statement = boat_passes_page_statement(limit=limit, cursor=cursor, camera_id=camera_id, since=since, until=until)
+    session_boat_passes = (await session.exec(statement)).all()
+    return await load_row_boxes(session=session, boat_passes=session_boat_passes)
+
+async def get_all_ocr_results(*, session: AsyncSession) -> List[OcrResult]:
+    session_ocr = (await session.exec(row_ocr_results_statement())).all()
+    # Compact detections carry ids from the same sequences, see crud.allocate_ids
+    for detections in await session.exec(select(BoatPass.detections).where(BoatPass.detections != None)):
+        session_ocr.extend(iter_ocr_results(detections))
+    return session_ocr
+
+async def get_states(*, session: AsyncSession) -> List[State]:
+    statement = select(State).order_by(State.id.desc())
+    session_states = (await session.exec(statement)).all()
+    return session_states
+
+async def get_state_changes_horizon(*, session: AsyncSession) -> int:
+    return (await session.execute(state_changes.horizon_statement(session.get_bind().dialect.name))).scalar_one()
+
+async def get_states_changed(*, session: AsyncSession, limit: int, cursor: tuple[int, int] | None = None) -> tuple[List[State], tuple[int, int]]:
+    horizon = await get_state_changes_horizon(session=session)
+    rows = (await session.execute(state_changes.changes_statement(horizon=horizon, limit=limit, cursor=cursor))).all()
+    return [row[0] for row in rows], next_changes_cursor(rows, horizon, limit)
+
+async def create_state(*, session: AsyncSession, state: StateBase, first_boat_pass_id: int | None = None, last_boat_pass_id: int | None = None) -> State:
+    state_db = State.model_validate(state, update={"first_boat_pass_id": first_boat_pass_id, "last_boat_pass_id": last_boat_pass_id})
+    mark_edited(state_db)
+    session.add(state_db)
+    await session.commit()
+    state_changed(state_db)
+    return state_db
+
+async def get_state_by_id(*, session: AsyncSession, state_id: int) -> State | None:
+    statement = select(State).where(State.id == state_id)
+    session_state = (await session.exec(statement)).first()
+    return session_state
+
+async def update_state_payment(*, session: AsyncSession, update_state: StateUpdate) -> State:
+    state = await get_state_by_id(session=session, state_id=update_state.id)
+    state.payment_status = update_state.payment_status
+    mark_edited(state)
+    session.add(state)
+    await session.commit()
+    state_changed(state)
+    return state
+
+async def update_state_best_detected_identifier(*, session: AsyncSession, update_state: StateUpdate) -> State:
+    state = await get_state_by_id(session=session, state_id=update_state.id)
+    state.best_detected_identifier = update_state.best_detected_identifier
+    mark_edited(state)
+    session.add(state)
+    await session.commit()
+    state_changed(state)
+    return state
+
+async def update_state_raw(*, session: AsyncSession, original_state: State, updated_state: State) -> State:
+    state_data = updated_state.model_dump(exclude_unset=True)
+    original_state.sqlmodel_update(state_data)
+    mark_edited(original_state)
+    session.add(original_state)
+    await session.commit()
+    state_changed(original_state)
+    return original_state
+
+async def update_state(*, session: AsyncSession, updated_state: State) -> State:
+    original_state = await get_state_by_id(session=session, state_id=updated_state.id)
+    return await update_state_raw(session=session, original_state=original_state, updated_state=updated_state)
+
+async def count_dashboard_data(*, session: AsyncSession) -> DashboardData:
+    statement = dashboard_statement(since=datetime.now(UTC) - dashboard_cache.window)
+    return dashboard_data_from_row((await session.exec(statement)).one())
+
+async def rebuild_dashboard_cache(*, session: AsyncSession) -> DashboardData:
+    since = dashboard_cache.begin_rebuild()
+    dashboard_cache.finish_rebuild((await session.exec(dashboard_states_statement(since=since))).all())
+    return dashboard_cache.get()
+
+async def get_dashboard_data(*, session: AsyncSession) -> DashboardData:
+    if not dashboard_cache.enabled:
+        return await count_dashboard_data(session=session)
+    if not dashboard_cache.is_valid():
+        return await rebuild_dashboard_cache(session=session)
+    return dashboard_cache.get()
+
+async def get_occupancy(*, session: AsyncSession, since: datetime, until: datetime | None, bucket: occupancy.Bucket, zone: tzinfo) -> List[OccupancyPublic]:
+    since, until = occupancy_range(since=since, until=until, bucket=bucket, zone=zone)
+    rows = (await session.exec(occupancy.range_statement(since=since, until=until))).all()
+    return occupancy.periods(rows, since, until, bucket, zone)
+
+# The crud function each of the above stands in for, run_crud only calls an async function listed here
+COUNTERPARTS: dict[Callable, Callable] = {
+    crud.get_user_by_id: get_user_by_id,
+    crud.get_user_by_email: get_user_by_email,
+    crud.get_user_by_username: get_user_by_username,
+    crud.link_boat_passes: link_boat_passes,
+    crud.create_boat_pass: create_boat_pass,
+    crud.create_boat_passes: create_boat_passes,
+    crud.load_row_boxes: load_row_boxes,
+    crud.get_all_boat_passes: get_all_boat_passes,
+    crud.get_boat_passes_page: get_boat_passes_page,
+    crud.get_all_ocr_results: get_all_ocr_results,
+    crud.get_states: get_states,
+    crud.get_state_changes_horizon: get_state_changes_horizon,
+    crud.detection_ids: detection_ids,
+    crud.get_states_changed: get_states_changed,
+    crud.create_state: create_state,
+    crud.get_state_by_id: get_state_by_id,
+    crud.update_state_payment: update_state_payment,
+    crud.update_state_best_detected_identifier: update_state_best_detected_identifier,
+    crud.update_state_raw: update_state_raw,
+    crud.update_state: update_state,
+    crud.count_dashboard_data: count_dashboard_data,
+    crud.rebuild_dashboard_cache: rebuild_dashboard_cache,
+    crud.get_dashboard_data: get_dashboard_data,
+    crud.get_occupancy: get_occupancy,
+}
@@ -0,0 +1,65 @@
+"""Maintenance commands, run with the same environment as the API.
+
+Usage: python -m app.cli migrate | status | compact-detections [--batch-size 500] [--keep-rows] | rebuild-occupancy
+"""
+import argparse
+from sqlmodel import Session
+from app import crud
+from app.core.db import engine
+from app.core.migrations import current_version, latest_version, migrate
+
+def migrate_command(args: argparse.Namespace) -> None:
+    applied = migrate(engine)
+    for migration in applied:
+        print(f"Applied {migration.version}: {migration.description}")
+    with engine.connect() as connection:
+        print(f"Schema version {current_version(connection)}")
+
+def status_command(args: argparse.Namespace) -> None:
+    with engine.connect() as connection:
+        print(f"Schema version {current_version(connection)}, latest {latest_version()}")
+
+def compact_detections_command(args: argparse.Namespace) -> None:
+    total = 0
+    while True:
+        with Session(engine) as session:
+            moved = crud.compact_row_boxes(session=session, batch_size=args.batch_size, keep_rows=args.keep_rows)
+        if not moved:
+            break
+        total += moved
+        print(f"Compacted {total} boat passes", flush=True)
+    print(f"Done, {total} boat passes compacted")
+    if args.keep_rows:
+        return
+    # Rows an earlier run with --keep-rows left behind
+    deleted = 0
+    while True:
+        with Session(engine) as session:
+            removed = crud.delete_kept_rows(session=session, batch_size=args.batch_size)
+        if not removed:
+            break
+        deleted += removed
+        print(f"Deleted {deleted} kept boxes", flush=True)
+    if deleted:
+        print(f"Done, {deleted} kept boxes deleted")
+
+def rebuild_occupancy_command(args: argparse.Namespace) -> None:
+    with Session(engine) as session:
+        hours = crud.rebuild_occupancy(session=session)
+    print(f"Done, {hours} hours in the occupancy rollup")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("migrate", help="create missing tables and apply pending migrations").set_defaults(run=migrate_command)
+    commands.add_parser("status", help="print the schema version").set_defaults(run=status_command)
+    compact = commands.add_parser("compact-detections", help="move boxes and OCR results of boat passes from their rows into the detections column")
+    compact.add_argument("--batch-size", type=int, default=500, help="boat passes per transaction")
+    compact.add_argument("--keep-rows", action="store_true", help="leave the BoundingBox and OcrResult rows in place, a later run without it deletes them")
+    compact.set_defaults(run=compact_detections_command)
+    commands.add_parser("rebuild-occupancy", help="recompute the hourly occupancy rollup from all States").set_defaults(run=rebuild_occupancy_command)
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,8 @@ from pydantic_core import MultiHostUrl
 class AppConfig(BaseSettings):
     model_config = SettingsConfigDict(env_prefix='API_')
     LOG_LEVEL: Literal['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'] = "DEBUG"
+    # Prometheus metrics on /metrics and the request timing middleware
+    METRICS_ENABLED: bool = True
     API_V1_STR: str = "/api/v1"
     POSTGRES_SERVER: str
     POSTGRES_PORT: int = 5432
@@ -26,14 +28,83 @@ class AppConfig(BaseSettings):
             path=self.POSTGRES_DB,
         )
     
+    # Overrides the Postgres settings above, e.g. sqlite:///bench.sqlite for local benchmarks
+    DATABASE_URL: str | None = None
+    DB_ASYNC: bool = False
+    # Connections kept open per engine and per worker, and how many more may be opened under load
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    # Seconds to wait for a free connection before the request fails
+    DB_POOL_TIMEOUT: float = 30.0
+    # Seconds after which a connection is replaced, -1 keeps connections forever
+    DB_POOL_RECYCLE: int = 1800
+    # Tests connections on checkout, so a restarted database does not fail the first requests
+    DB_POOL_PRE_PING: bool = True
+    # Postgres only, seconds a statement may run before the server cancels it, 0 for no limit
+    DB_STATEMENT_TIMEOUT: float = 30.0
+    # psycopg only, executions of a query before it becomes a server-side prepared statement, -1 disables them (PgBouncer in transaction mode)
+    DB_PREPARE_THRESHOLD: int = 5
     INIT_DB_FILE: str
     INIT_DB: bool = False
+    PASSWORD_HASH_WORKERS: int = 2
     JWT_SECRET: str = secrets.token_urlsafe(32)
     JWT_ALGORITHM: str = "HS256"
     JWT_EXPIRATION: int = 20160
+    # Seconds a user resolved from a token is reused, also how long a user changed directly in the database keeps the old rights
+    USER_CACHE_TTL: int = 60
+    USER_CACHE_SIZE: int = 1024
+    DASHBOARD_CACHE_TTL: int = 60
+    # New boat passes keep their boxes and OCR results as BoundingBox and OcrResult rows or compact in one binary column, see app.core.detections
+    DETECTIONS_STORAGE: Literal['rows', 'compact'] = 'rows'
+    # Rows fetched per round trip by the streaming exports
+    EXPORT_BATCH_SIZE: int = 500
+    # Which way each camera sees boats pass, used to link boat passes into States
+    CAMERA_DIRECTIONS: dict[int, Literal['arrival', 'departure']] = {1: 'arrival', 2: 'departure'}
+    # Shorter stays are recorded as a transit instead of anchoring
+    STATE_TRANSIT_MINUTES: int = 60
+    # Departures whose identifier has no exact open State are matched to the closest one within this edit distance, 0 disables it
+    STATE_MATCH_MAX_DISTANCE: int = 1
     DATA_FOLDER: str
-    WS_CAM_PREVIEW_1:str
-    WS_CAM_PREVIEW_2:str
+    WS_QUEUE_SIZE: int = 8
+    WS_SEND_TIMEOUT: float = 10.0
+    PREVIEW_MAX_BYTES: int = 10 * 1024 * 1024
+    WS_CAM_PREVIEW_TEMPLATE: str = "camera_preview_{camera_id}.base64"
+    WS_CAM_PREVIEW_PERSIST_INTERVAL: float = 10.0
+    # Previews broadcast per second and camera, 0 for no limit, PREVIEW_CAMERA_MAX_FPS overrides it for single cameras
+    PREVIEW_MAX_FPS: float = 5.0
+    PREVIEW_CAMERA_MAX_FPS: dict[int, float] = {}
+    # Previews whose difference hash is within this many of 256 bits of the last broadcast one are dropped as unchanged (needs Pillow), -1 only drops identical frames
+    PREVIEW_DEDUPE_DISTANCE: int = 4
+    # Longer side in pixels of the preview variant for clients that ask for low resolution, 0 disables it (needs Pillow)
+    PREVIEW_LOW_SIZE: int = 480
+    PREVIEW_LOW_QUALITY: int = 60
+    # Thumbnails of stored images, longer side in pixels, made by this many worker processes on ingest (needs Pillow)
+    THUMBNAIL_SIZE: int = 320
+    THUMBNAIL_QUALITY: int = 75
+    THUMBNAIL_WORKERS: int = 1
+    # Seconds browsers may reuse an image, stored images never change
+    IMAGE_CACHE_MAX_AGE: int = 86400
+    # Internal nginx location serving DATA_FOLDER, e.g. /protected-images/, images are then sent by nginx
+    IMAGE_ACCEL_REDIRECT: str | None = None
+    # 'spool' answers POST /boat-pass with 202 once the pass is in a local append-only spool, a background task writes it to the database
+    INGEST_MODE: Literal['direct', 'spool'] = 'direct'
+    # Defaults to .spool in DATA_FOLDER
+    SPOOL_FOLDER: str | None = None
+    SPOOL_BATCH_SIZE: int = 50
+    # Undrained bytes above which new boat passes are refused with 503
+    SPOOL_MAX_BYTES: int = 1024 * 1024 * 1024
+    SPOOL_SEGMENT_BYTES: int = 64 * 1024 * 1024
+    # Seconds before retrying a failed batch, doubled up to a minute while the database stays unavailable
+    SPOOL_RETRY_DELAY: float = 1.0
+    # Failed attempts after which a record the database refuses is set aside in the rejected folder
+    SPOOL_MAX_ATTEMPTS: int = 5
+    # How WebSocket broadcasts reach clients of the other workers, 'local' for a single worker or 'postgres' for LISTEN/NOTIFY
+    BROADCAST_BACKPLANE: Literal['local', 'postgres'] = 'local'
+    BACKPLANE_CHANNEL: str = 'smartharbour'
+    # Folder shared by all workers for large previews, defaults to .backplane in DATA_FOLDER
+    BACKPLANE_FOLDER: str | None = None
+    # Seconds a large backplane message stays in the database or the folder for the other workers to read it
+    BACKPLANE_MESSAGE_TTL: int = 60
 
 
 app_config = AppConfig()
\ No newline at end of file
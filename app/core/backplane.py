@@ -0,0 +1,230 @@
+import asyncio
+import base64
+import logging
+import os
+import re
+import struct
+import time
+import uuid
+from typing import Awaitable, Callable
+import psycopg
+from psycopg import sql
+from sqlalchemy.engine import make_url
+from app.core.app_config import app_config
+from app.core.app_logger import AppLogger
+
+logger = AppLogger(__name__, logging._nameToLevel[app_config.LOG_LEVEL]).get_logger()
+
+Handler = Callable[[bytes], Awaitable[None]]
+
+# Sequence number in front of the payload of a shared file
+FILE_HEADER = struct.Struct(">Q")
+
+class Backplane:
+    """Fans messages out to the other API workers.
+
+    A message has a kind and a binary payload. The publishing worker handles its own message directly, a backplane
+    only carries it to the other processes, where it is passed to the handler subscribed to its kind. This base
+    class is the single process backplane, publishing is a no-op.
+    """
+    # False when there are no other workers to reach, publishers can skip encoding their messages
+    enabled = False
+
+    def __init__(self):
+        self.handlers: dict[str, Handler] = {}
+        self.published = 0
+        self.received = 0
+
+    def subscribe(self, kind: str, handler: Handler) -> None:
+        self.handlers[kind] = handler
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def publish(self, kind: str, payload: bytes, key: str | None = None) -> None:
+        """Sends payload to the handlers of kind in the other workers.
+
+        A message with a key supersedes earlier ones of the same kind and key, like the previous frame of a camera,
+        so a backplane may skip those the other workers did not read yet.
+        """
+        pass
+
+    async def deliver(self, kind: str, payload: bytes) -> None:
+        handler = self.handlers.get(kind)
+        if handler is None:
+            logger.debug(f"No backplane handler for {kind}")
+            return
+        self.received += 1
+        try:
+            await handler(payload)
+        except Exception as e:
+            logger.error(f"Error while handling {kind} from the backplane: {e!r}")
+
+    def stats(self) -> dict[str, int | str]:
+        return {"type": type(self).__name__, "published": self.published, "received": self.received}
+
+class PostgresBackplane(Backplane):
+    """Backplane over Postgres LISTEN/NOTIFY, for workers on one or more hosts sharing the database.
+
+    NOTIFY payloads are limited to 8000 bytes, so small messages travel inline as base64. Larger messages with a key,
+    like preview frames, are written over the last one of their key in a file of the shared folder and only its
+    sequence number is notified, a worker that reads a newer one skips the message and handles the newer one's
+    notification. Other large messages are stored in the backplanemessage table and only their id is notified. Stored
+    messages and files are deleted after message_ttl seconds. Messages published while a worker is reconnecting are
+    lost, which is fine for previews where the next frame supersedes the previous one.
+    """
+    enabled = True
+    # Leaves room for the origin, kind and separators within the 8000 bytes
+    INLINE_LIMIT = 7000
+
+    def __init__(self, conninfo: str, channel: str, folder: str, message_ttl: float, reconnect_delay: float = 1.0):
+        super().__init__()
+        self.conninfo = conninfo
+        self.channel = channel
+        self.folder = folder
+        self.message_ttl = message_ttl
+        self.reconnect_delay = reconnect_delay
+        # Lets a worker skip its own notifications
+        self.origin = uuid.uuid4().hex[:12]
+        self._connection: psycopg.AsyncConnection | None = None
+        self._lock = asyncio.Lock()
+        self._listener: asyncio.Task | None = None
+        self._last_cleanup = 0.0
+        self._sequence = 0
+        self._keys: set[tuple[str, str]] = set()
+
+    async def start(self) -> None:
+        os.makedirs(self.folder, exist_ok=True)
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+        if self._connection is not None:
+            await self._connection.close()
+        for kind, key in self._keys:
+            try:
+                os.remove(self._path(self.origin, kind, key))
+            except OSError:
+                pass
+
+    def _path(self, origin: str, kind: str, key: str) -> str:
+        return os.path.join(self.folder, f"{origin}-{kind}-{key}")
+
+    def _write(self, kind: str, key: str, sequence: int, payload: bytes) -> None:
+        path = self._path(self.origin, kind, key)
+        with open(f"{path}.tmp", "wb") as shared_file:
+            shared_file.write(FILE_HEADER.pack(sequence))
+            shared_file.write(payload)
+        os.replace(f"{path}.tmp", path)
+
+    def _read(self, origin: str, kind: str, key: str, sequence: int) -> bytes | None:
+        try:
+            with open(self._path(origin, kind, key), "rb") as shared_file:
+                content = shared_file.read()
+        except FileNotFoundError:
+            return None
+        (written,) = FILE_HEADER.unpack_from(content)
+        # A newer message replaced the file, its own notification delivers it
+        return content[FILE_HEADER.size:] if written == sequence else None
+
+    def _remove_expired(self) -> None:
+        expired = time.time() - self.message_ttl
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < expired:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+
+    async def _query_connection(self) -> psycopg.AsyncConnection:
+        # Publishing and reading stored messages share one connection, the listening one is blocked waiting for notifications
+        if self._connection is None or self._connection.closed:
+            self._connection = await psycopg.AsyncConnection.connect(self.conninfo, autocommit=True)
+        return self._connection
+
+    async def publish(self, kind: str, payload: bytes, key: str | None = None) -> None:
+        encoded = base64.b64encode(payload).decode()
+        async with self._lock:
+            try:
+                connection = await self._query_connection()
+                if len(encoded) <= self.INLINE_LIMIT:
+                    message = f"{self.origin}:{kind}:i:{encoded}"
+                elif key is not None:
+                    self._sequence += 1
+                    await asyncio.to_thread(self._write, kind, key, self._sequence, payload)
+                    self._keys.add((kind, key))
+                    message = f"{self.origin}:{kind}:f:{self._sequence}:{key}"
+                else:
+                    cursor = await connection.execute("INSERT INTO backplanemessage (kind, payload, created_at) VALUES (%s, %s, now()) RETURNING id", (kind, payload))
+                    (message_id,) = await cursor.fetchone()
+                    message = f"{self.origin}:{kind}:s:{message_id}"
+                await connection.execute("SELECT pg_notify(%s, %s)", (self.channel, message))
+                if time.monotonic() - self._last_cleanup > self.message_ttl:
+                    self._last_cleanup = time.monotonic()
+                    await connection.execute("DELETE FROM backplanemessage WHERE created_at < now() - make_interval(secs => %s)", (self.message_ttl,))
+                    await asyncio.to_thread(self._remove_expired)
+            except (psycopg.Error, OSError) as e:
+                # The local clients already have the message, the other workers miss this one
+                logger.error(f"Error while publishing {kind} to the backplane: {e!r}")
+                return
+        self.published += 1
+
+    async def _stored(self, message_id: int) -> bytes | None:
+        async with self._lock:
+            connection = await self._query_connection()
+            cursor = await connection.execute("SELECT payload FROM backplanemessage WHERE id = %s", (message_id,))
+            row = await cursor.fetchone()
+        return row[0] if row is not None else None
+
+    async def _receive(self, message: str) -> None:
+        try:
+            origin, kind, mode, body = message.split(":", 3)
+            if origin == self.origin:
+                return
+            if mode == "i":
+                payload = base64.b64decode(body)
+            elif mode == "f":
+                sequence, _, key = body.partition(":")
+                if not re.fullmatch(r"[\w.]+", key):
+                    raise ValueError(f"Invalid key {key!r}")
+                payload = await asyncio.to_thread(self._read, origin, kind, key, int(sequence))
+            else:
+                payload = await self._stored(int(body))
+        except (ValueError, OSError, struct.error) as e:
+            logger.error(f"Malformed backplane message: {e}")
+            return
+        if payload is None:
+            logger.debug(f"Backplane message {body} expired or was superseded before it was read")
+            return
+        await self.deliver(kind, payload)
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(self.conninfo, autocommit=True) as connection:
+                    await connection.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+                    logger.debug(f"Listening on backplane channel {self.channel}")
+                    async for notify in connection.notifies():
+                        await self._receive(notify.payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Backplane listener failed, reconnecting: {e!r}")
+                await asyncio.sleep(self.reconnect_delay)
+
+def create_backplane(kind: str, database_url: str) -> Backplane:
+    if kind == "postgres":
+        # psycopg takes a libpq URL, without the SQLAlchemy driver suffix
+        conninfo = make_url(database_url).set(drivername="postgresql").render_as_string(hide_password=False)
+        folder = app_config.BACKPLANE_FOLDER or os.path.join(app_config.DATA_FOLDER, ".backplane")
+        return PostgresBackplane(conninfo, app_config.BACKPLANE_CHANNEL, folder, app_config.BACKPLANE_MESSAGE_TTL)
+    return Backplane()
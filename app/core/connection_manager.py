@@ -1,23 +1,202 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
 from typing import Any
 from fastapi import WebSocket
+from app.core.app_config import app_config
+from app.core.app_logger import AppLogger
+from app.core.metrics import preview_bytes_saved, ws_broadcast_duration, ws_send_duration
+from app.core.preview_cache import PreviewFrame
+
+logger = AppLogger(__name__, logging._nameToLevel[app_config.LOG_LEVEL]).get_logger()
+
+def message_type(message: Any) -> str:
+    if isinstance(message, PreviewFrame):
+        return "image"
+    return "text" if isinstance(message, str) else "json"
+
+class QueueOverflow(Exception):
+    """A client fell max_queue messages behind and none of them could be dropped."""
+
+class ClientConnection:
+    """Outgoing side of one WebSocket: a bounded queue drained by its own writer task.
+
+    Messages enqueued with a key replace a pending message with the same key, so a client that falls behind
+    only receives the latest frame of each camera instead of a growing backlog. Preview frames are sent as binary
+    WebSocket messages to clients that negotiated the binary mode and as JSON with base64 to the others, strings are
+    already encoded JSON. A full queue drops its oldest preview frame, a newer one follows. When it holds nothing but
+    messages that must not be lost, like State changes, the client is disconnected and resyncs after reconnecting.
+    """
+    def __init__(self, websocket: WebSocket, max_queue: int, send_timeout: float):
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.pending: OrderedDict[Hashable, Any] = OrderedDict()
+        self.dropped = 0
+        self.sent = 0
+        self.binary = False
+        self.authorized = False
+        self.low_resolution = False
+        self.overflowed = False
+        self._wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    def queue_depth(self) -> int:
+        return len(self.pending)
+
+    def enqueue(self, json: Any, key: Hashable | None = None) -> None:
+        if self.overflowed:
+            return
+        if key is None:
+            key = object()
+        if key in self.pending:
+            del self.pending[key]
+            self.dropped += 1
+        elif len(self.pending) >= self.max_queue:
+            frame_key = next((pending_key for pending_key, message in self.pending.items() if isinstance(message, PreviewFrame)), None)
+            if frame_key is None and isinstance(json, PreviewFrame):
+                self.dropped += 1
+                return
+            if frame_key is None:
+                # The writer task raises QueueOverflow and the manager closes the connection
+                self.overflowed = True
+                self._wakeup.set()
+                return
+            del self.pending[frame_key]
+            self.dropped += 1
+        self.pending[key] = json
+        self._wakeup.set()
+
+    async def run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.pending and not self.overflowed:
+                _, message = self.pending.popitem(last=False)
+                start = time.perf_counter()
+                await asyncio.wait_for(self._send(message), timeout=self.send_timeout)
+                ws_send_duration.observe(time.perf_counter() - start, message=message_type(message))
+                self.sent += 1
+            if self.overflowed:
+                raise QueueOverflow(f"More than {self.max_queue} messages behind")
+
+    async def _send(self, message: Any) -> None:
+        if isinstance(message, str):
+            await self.websocket.send_text(message)
+        elif not isinstance(message, PreviewFrame):
+            await self.websocket.send_json(message)
+        elif self.binary:
+            await self.websocket.send_bytes(message.binary_message)
+        else:
+            await self.websocket.send_json(message.json_message)
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
+    def __init__(self, max_queue: int = app_config.WS_QUEUE_SIZE, send_timeout: float = app_config.WS_SEND_TIMEOUT):
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.active_connections: dict[WebSocket, ClientConnection] = {}
+        self.sent_total = 0
+        self.dropped_total = 0
+        self.evicted_total = 0
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        connection = ClientConnection(websocket, self.max_queue, self.send_timeout)
+        connection.task = asyncio.create_task(self._write(connection))
+        self.active_connections[websocket] = connection
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        connection = self.active_connections.pop(websocket, None)
+        if connection is None:
+            return
+        self.sent_total += connection.sent
+        self.dropped_total += connection.dropped
+        if connection.task is not None and connection.task is not asyncio.current_task():
+            connection.task.cancel()
 
     def number_of_connections(self):
         return len(self.active_connections)
 
-    async def send_personal_message(self, json: Any, websocket: WebSocket):
-        await websocket.send_json(json)
+    async def send_personal_message(self, json: Any, websocket: WebSocket, key: Hashable | None = None):
+        connection = self.active_connections.get(websocket)
+        if connection is not None:
+            connection.enqueue(json, key)
+
+    async def broadcast(self, json: Any, key: Hashable | None = None):
+        # Only enqueues, every client is written by its own task so a slow socket does not delay the others
+        start = time.perf_counter()
+        for connection in list(self.active_connections.values()):
+            connection.enqueue(json, key)
+        ws_broadcast_duration.observe(time.perf_counter() - start, message=message_type(json))
+
+    def set_binary(self, websocket: WebSocket, binary: bool):
+        connection = self.active_connections.get(websocket)
+        if connection is not None:
+            connection.binary = binary
+
+    def set_low_resolution(self, websocket: WebSocket, low_resolution: bool):
+        connection = self.active_connections.get(websocket)
+        if connection is not None:
+            connection.low_resolution = low_resolution
+
+    def wants_low_resolution(self) -> bool:
+        return any(connection.low_resolution for connection in self.active_connections.values())
+
+    def set_authorized(self, websocket: WebSocket):
+        connection = self.active_connections.get(websocket)
+        if connection is not None:
+            connection.authorized = True
+
+    async def broadcast_state(self, state_id: int, message: str):
+        # States carry payment data, only for clients that sent a valid token. A client that falls behind gets the
+        # latest version of each State once.
+        start = time.perf_counter()
+        for connection in list(self.active_connections.values()):
+            if connection.authorized:
+                connection.enqueue(message, key=("state", state_id))
+        ws_broadcast_duration.observe(time.perf_counter() - start, message="text")
+
+    async def send_frame(self, frame: PreviewFrame, websocket: WebSocket):
+        connection = self.active_connections.get(websocket)
+        if connection is not None:
+            connection.enqueue(frame.low if connection.low_resolution and frame.low is not None else frame, ("image", frame.camera_id))
+
+    async def broadcast_frame(self, frame: PreviewFrame):
+        start = time.perf_counter()
+        low_clients = 0
+        for connection in list(self.active_connections.values()):
+            if connection.low_resolution and frame.low is not None:
+                connection.enqueue(frame.low, ("image", frame.camera_id))
+                low_clients += 1
+            else:
+                connection.enqueue(frame, ("image", frame.camera_id))
+        ws_broadcast_duration.observe(time.perf_counter() - start, message="image")
+        if low_clients:
+            preview_bytes_saved.inc((frame.size - frame.low.size) * low_clients, reason="low_resolution")
+
+    async def _write(self, connection: ClientConnection):
+        try:
+            await connection.run()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.debug(f"Evicting WebSocket client after failed send or full queue: {e!r}")
+            self.evicted_total += 1
+            self.disconnect(connection.websocket)
+            try:
+                await connection.websocket.close()
+            except Exception:
+                pass
 
-    async def broadcast(self, json: Any):
-        for connection in self.active_connections:
-            await connection.send_json(json)
\ No newline at end of file
+    def stats(self) -> dict[str, int]:
+        connections = list(self.active_connections.values())
+        return {
+            "connections": len(connections),
+            "queue_depth": sum(c.queue_depth() for c in connections),
+            "max_queue_depth": max((c.queue_depth() for c in connections), default=0),
+            "sent_messages": self.sent_total + sum(c.sent for c in connections),
+            "dropped_frames": self.dropped_total + sum(c.dropped for c in connections),
+            "evicted_connections": self.evicted_total,
+        }
@@ -0,0 +1,33 @@
+import base64
+import json
+from datetime import datetime
+
+# Opaque keyset cursors, a cursor points at the (timestamp, id) of the last row of the previous page
+
+def encode_cursor(timestamp: datetime, id: int) -> str:
+    raw = json.dumps([timestamp.isoformat(), id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        timestamp, id = json.loads(raw)
+        return datetime.fromisoformat(timestamp), int(id)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+# GET /states?since= cursors point at the (change_version, id) of a State, see app.core.state_changes
+
+def encode_change_cursor(version: int, id: int) -> str:
+    raw = json.dumps([version, id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_change_cursor(cursor: str) -> tuple[int, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        version, id = json.loads(raw)
+        if not isinstance(version, int):
+            raise TypeError(version)
+        return version, int(id)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
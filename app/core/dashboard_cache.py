@@ -0,0 +1,105 @@
+import threading
+import time
+from datetime import datetime, timedelta, UTC
+from typing import Iterable, NamedTuple
+from app.models import DashboardData, PaymentStatusEnum, State
+from app.core.app_config import app_config
+
+DASHBOARD_WINDOW = timedelta(days=1)
+
+def as_utc(value: datetime | None) -> datetime | None:
+    # Columns are stored without a time zone, naive values are treated as UTC like the database does
+    if value is None or value.tzinfo is not None:
+        return value
+    return value.replace(tzinfo=UTC)
+
+class StateSnapshot(NamedTuple):
+    arrival_time: datetime | None
+    departure_time: datetime | None
+    undetected_identifier: bool
+    payment_status: PaymentStatusEnum
+
+    @classmethod
+    def from_state(cls, state: State) -> "StateSnapshot":
+        return cls(
+            arrival_time=as_utc(state.arrival_time),
+            departure_time=as_utc(state.departure_time),
+            undetected_identifier=state.best_detected_identifier is not None and '?' in state.best_detected_identifier,
+            payment_status=state.payment_status,
+        )
+
+class DashboardCache:
+    """In-process copy of the States that fall into the dashboard window.
+
+    It is rebuilt from the database once per TTL and kept up to date by the crud functions that change a State in between,
+    so dashboard reads are answered from memory. The TTL bounds staleness for changes made by other workers.
+    """
+    def __init__(self, ttl: float, window: timedelta = DASHBOARD_WINDOW):
+        self.ttl = ttl
+        self.window = window
+        self._states: dict[int, StateSnapshot] = {}
+        self._changed_during_rebuild: set[int] = set()
+        self._built_at: float | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def is_valid(self) -> bool:
+        return self._built_at is not None and time.monotonic() - self._built_at < self.ttl
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._built_at = None
+
+    def begin_rebuild(self) -> datetime:
+        """Returns the lower bound of the window the rebuild query has to load."""
+        with self._lock:
+            self._changed_during_rebuild.clear()
+        return datetime.now(UTC) - self.window
+
+    def finish_rebuild(self, states: Iterable[State]) -> None:
+        snapshots = {state.id: StateSnapshot.from_state(state) for state in states}
+        with self._lock:
+            # Changes applied while the rebuild query was running are newer than its result
+            for state_id in self._changed_during_rebuild:
+                if state_id in self._states:
+                    snapshots[state_id] = self._states[state_id]
+            self._states = snapshots
+            self._built_at = time.monotonic()
+
+    def apply(self, state: State) -> None:
+        with self._lock:
+            self._states[state.id] = StateSnapshot.from_state(state)
+            self._changed_during_rebuild.add(state.id)
+
+    def get(self) -> DashboardData:
+        since = datetime.now(UTC) - self.window
+        counts = dict.fromkeys(DashboardData.model_fields, 0)
+        with self._lock:
+            expired = []
+            for state_id, state in self._states.items():
+                arrived = state.arrival_time is not None and state.arrival_time > since
+                departed = state.departure_time is not None and state.departure_time > since
+                if not arrived and not departed:
+                    expired.append(state_id)
+                    continue
+                if arrived:
+                    counts["today_arrived"] += 1
+                    counts["today_arrived_undetected_identifier"] += state.undetected_identifier
+                    if state.departure_time is None:
+                        counts["today_in_marina"] += 1
+                        counts["today_in_marina_undetected_identifier"] += state.undetected_identifier
+                    if state.payment_status == PaymentStatusEnum.zaplaceno:
+                        counts["today_payed"] += 1
+                    elif state.payment_status == PaymentStatusEnum.nezaplaceno:
+                        counts["today_not_payed"] += 1
+                if departed:
+                    counts["today_departed"] += 1
+                    counts["today_departed_undetected_identifier"] += state.undetected_identifier
+            for state_id in expired:
+                del self._states[state_id]
+        return DashboardData(**counts)
+
+dashboard_cache = DashboardCache(ttl=app_config.DASHBOARD_CACHE_TTL)
@@ -1,13 +1,77 @@
+from typing import Any
 from sqlmodel import Session, create_engine, select, SQLModel
-from app.core.app_config import app_config
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from app.core.app_config import AppConfig, app_config
 from app.models import User, UserCreate, State, BoatPass, BoundingBox, OcrResult, DbInitState
 from app.crud import create_user, get_init_db_state, set_init_db_state
 from app.core.app_logger import AppLogger
+from app.core.migrations import migrate
+from app.core.metrics import TimedAsyncAdaptedQueuePool, TimedQueuePool, instrument_engine, metrics
 import logging
 import json
 
 logger = AppLogger(__name__, logging._nameToLevel[app_config.LOG_LEVEL]).get_logger()
-engine = create_engine(str(app_config.SQLALCHEMY_DATABASE_URI), echo=False)
+
+def engine_options(database_url: str, config: AppConfig = app_config) -> dict[str, Any]:
+    """Pool and connection settings for create_engine, leaving out those the database or driver does not take."""
+    options: dict[str, Any] = {
+        "pool_size": config.DB_POOL_SIZE,
+        "max_overflow": config.DB_MAX_OVERFLOW,
+        "pool_timeout": config.DB_POOL_TIMEOUT,
+        "pool_recycle": config.DB_POOL_RECYCLE,
+        "pool_pre_ping": config.DB_POOL_PRE_PING,
+    }
+    url = make_url(database_url)
+    if url.get_backend_name() != "postgresql":
+        return options
+    connect_args: dict[str, Any] = {}
+    if config.DB_STATEMENT_TIMEOUT > 0:
+        # Set per connection at startup, so it costs no extra round trip
+        connect_args["options"] = f"-c statement_timeout={int(config.DB_STATEMENT_TIMEOUT * 1000)}"
+    if url.get_driver_name() == "psycopg":
+        connect_args["prepare_threshold"] = config.DB_PREPARE_THRESHOLD if config.DB_PREPARE_THRESHOLD >= 0 else None
+    options["connect_args"] = connect_args
+    return options
+
+database_url = app_config.DATABASE_URL or str(app_config.SQLALCHEMY_DATABASE_URI)
+# Statement and pool checkout timings are only taken with metrics enabled
+engine = create_engine(database_url, echo=False, poolclass=TimedQueuePool if app_config.METRICS_ENABLED else QueuePool, **engine_options(database_url))
+if app_config.METRICS_ENABLED:
+    instrument_engine(engine)
+# psycopg 3 serves both modes, the async engine is only created when the async session path is selected
+async_pool = TimedAsyncAdaptedQueuePool if app_config.METRICS_ENABLED else AsyncAdaptedQueuePool
+async_engine: AsyncEngine | None = create_async_engine(database_url, echo=False, poolclass=async_pool, **engine_options(database_url)) if app_config.DB_ASYNC else None
+if async_engine is not None and app_config.METRICS_ENABLED:
+    instrument_engine(async_engine.sync_engine)
+
+def pool_stats() -> dict[str, dict[str, int]]:
+    """Connections of each engine's pool, saturated when checked_out reaches size + max_overflow."""
+    pools = {"sync": engine.pool}
+    if async_engine is not None:
+        pools["async"] = async_engine.pool
+    stats = {}
+    for name, pool in pools.items():
+        if not isinstance(pool, QueuePool):
+            continue
+        stats[name] = {
+            "size": pool.size(),
+            "max_overflow": pool._max_overflow,
+            "checked_out": pool.checkedout(),
+            "idle": pool.checkedin(),
+            # Negative while fewer than size connections have been opened
+            "overflow": max(0, pool.overflow()),
+        }
+    return stats
+
+def _pool_metric(key: str):
+    return lambda: {(name, ): values[key] for name, values in pool_stats().items()}
+
+metrics.callback("db_pool_size", "Connections the pool keeps open", _pool_metric("size"), ("engine",))
+metrics.callback("db_pool_max_overflow", "Connections the pool may open beyond its size", _pool_metric("max_overflow"), ("engine",))
+metrics.callback("db_pool_checked_out", "Connections in use by requests", _pool_metric("checked_out"), ("engine",))
+metrics.callback("db_pool_overflow", "Connections open beyond the pool size", _pool_metric("overflow"), ("engine",))
 
 def prepare_data(session: Session) -> None:
     state = get_init_db_state(session=session)
@@ -26,8 +90,8 @@ def prepare_data(session: Session) -> None:
     
 
 def init_db(init_data=False) -> None:
-    SQLModel.metadata.create_all(engine)
-    
+    migrate(engine)
+
     if init_data:
         with Session(engine) as session:
             prepare_data(session)
\ No newline at end of file
@@ -0,0 +1,64 @@
+import struct
+from typing import Any, Iterable, Iterator
+from app.models import OcrResult
+
+# Compact detections of a boat pass, stored in BoatPass.detections as one binary value instead of a BoundingBox row
+# per box and an OcrResult row per text hit. Little-endian: a version byte and the number of boxes, then every box
+#   left, top, right, bottom, confidence: float64, class_identifier: int32, id: uint32, number of OCR results: uint16
+# followed by its OCR results
+#   left, top, right, bottom, confidence: float64, id: uint32, length of text: uint16, text: UTF-8
+# Coordinates stay float64 so the API returns exactly the values it got. Boxes moved from the row tables keep their
+# ids, boxes of passes written compact get theirs from the id sequences of the row tables, see app.crud.allocate_ids.
+
+VERSION = 1
+HEADER = struct.Struct("<BH")
+BOX = struct.Struct("<5diIH")
+OCR = struct.Struct("<5dIH")
+
+def pack_detections(boxes: Iterable[Any], box_ids: Iterator[int] | None = None, ocr_ids: Iterator[int] | None = None) -> bytes:
+    """Compact value of BoundingBoxCreate models with ids from box_ids and ocr_ids, or of BoundingBox rows and their
+    OcrResult rows with their own ids when those are None."""
+    boxes = list(boxes)
+    parts = [HEADER.pack(VERSION, len(boxes))]
+    for box in boxes:
+        parts.append(BOX.pack(box.left, box.top, box.right, box.bottom, box.confidence, box.class_identifier, box.id if box_ids is None else next(box_ids), len(box.ocr_results)))
+        for ocr in box.ocr_results:
+            text = ocr.text.encode()
+            parts.append(OCR.pack(ocr.left, ocr.top, ocr.right, ocr.bottom, ocr.confidence, ocr.id if ocr_ids is None else next(ocr_ids), len(text)))
+            parts.append(text)
+    return b"".join(parts)
+
+def iter_detections(detections: bytes) -> Iterator[tuple[tuple, list[tuple]]]:
+    """(box values, [OCR values with the text]) in the order of the BOX and OCR layouts."""
+    version, count = HEADER.unpack_from(detections)
+    if version != VERSION:
+        raise ValueError(f"Unsupported detections version {version}")
+    offset = HEADER.size
+    for _ in range(count):
+        box = BOX.unpack_from(detections, offset)
+        offset += BOX.size
+        ocr_results = []
+        for _ in range(box[7]):
+            ocr = OCR.unpack_from(detections, offset)
+            offset += OCR.size
+            ocr_results.append((*ocr, detections[offset:offset + ocr[6]].decode()))
+            offset += ocr[6]
+        yield box, ocr_results
+
+def unpack_detections(detections: bytes) -> list[dict[str, Any]]:
+    """The boxes as BoundingBoxPublic dicts, with the keys in the same order as the row per box layout."""
+    return [
+        {
+            "left": box[0], "top": box[1], "right": box[2], "bottom": box[3], "confidence": box[4], "class_identifier": box[5], "id": box[6],
+            "ocr_results": [
+                {"left": ocr[0], "top": ocr[1], "right": ocr[2], "bottom": ocr[3], "text": ocr[7], "confidence": ocr[4], "id": ocr[5]}
+                for ocr in ocr_results
+            ],
+        }
+        for box, ocr_results in iter_detections(detections)
+    ]
+
+def iter_ocr_results(detections: bytes) -> Iterator[OcrResult]:
+    for box, ocr_results in iter_detections(detections):
+        for ocr in ocr_results:
+            yield OcrResult(left=ocr[0], top=ocr[1], right=ocr[2], bottom=ocr[3], text=ocr[7], confidence=ocr[4], id=ocr[5], bounding_box_id=box[6])
@@ -0,0 +1,52 @@
+import csv
+import io
+from enum import Enum
+from typing import Callable, Iterable, Iterator, Literal
+from sqlmodel import SQLModel
+from app.core.serialization import RowSerializer
+
+ExportFormat = Literal["ndjson", "csv"]
+
+MEDIA_TYPES: dict[ExportFormat, str] = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+# Rows are buffered into chunks of about this size, small enough to get the first bytes out early
+CHUNK_SIZE = 64 * 1024
+
+def ndjson_chunks(rows: Iterable[SQLModel], serializer: RowSerializer) -> Iterator[bytes]:
+    """One JSON document per line, as the serializer writes the row."""
+    buffer: list[bytes] = []
+    size = 0
+    for row in rows:
+        line = serializer.dump_json(row) + b"\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield b"".join(buffer)
+            buffer.clear()
+            size = 0
+    if buffer:
+        yield b"".join(buffer)
+
+def csv_value(value):
+    if isinstance(value, Enum):
+        return value.value
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+def csv_chunks(rows: Iterable, columns: list[str], extra: dict[str, Callable] | None = None) -> Iterator[str]:
+    """Header line and one line per row with the given attributes, extra maps further columns to functions of the row."""
+    extra = extra or {}
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns + list(extra))
+    for row in rows:
+        writer.writerow([csv_value(getattr(row, column)) for column in columns] + [csv_value(func(row)) for func in extra.values()])
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
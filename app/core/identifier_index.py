@@ -0,0 +1,180 @@
+import threading
+from collections import Counter, defaultdict
+from collections.abc import Hashable
+from itertools import chain
+from typing import Iterable, NamedTuple
+
+WILDCARD = "?"
+
+class WildcardPattern:
+    """Edit distance to one query string, '?' on either side matches any character for free.
+
+    Bit-parallel Levenshtein (Myers/Hyyrö): the DP column of the pattern is kept as bit vectors, so a text costs
+    one pass over its characters. The per-character masks are built once per query.
+    """
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.length = len(pattern)
+        self.full = (1 << self.length) - 1
+        self.wildcards = 0
+        self.masks: dict[str, int] = {}
+        for i, char in enumerate(pattern):
+            if char == WILDCARD:
+                self.wildcards |= 1 << i
+            else:
+                self.masks[char] = self.masks.get(char, 0) | 1 << i
+
+    def distance(self, text: str) -> int:
+        if not self.length:
+            return len(text)
+        full, high, wildcards, masks = self.full, 1 << (self.length - 1), self.wildcards, self.masks
+        positive, negative, score = full, 0, self.length
+        for char in text:
+            equal = full if char == WILDCARD else masks.get(char, 0) | wildcards
+            vertical = equal | negative
+            horizontal = (((equal & positive) + positive) ^ positive) | equal
+            horizontal_positive = negative | (~(horizontal | positive) & full)
+            horizontal_negative = positive & horizontal
+            if horizontal_positive & high:
+                score += 1
+            elif horizontal_negative & high:
+                score -= 1
+            horizontal_positive = ((horizontal_positive << 1) | 1) & full
+            horizontal_negative = (horizontal_negative << 1) & full
+            positive = horizontal_negative | (~(vertical | horizontal_positive) & full)
+            negative = horizontal_positive & vertical
+        return score
+
+class IdentifierMatch(NamedTuple):
+    identifier: str
+    distance: int
+    keys: frozenset
+
+class IdentifierIndex:
+    """Approximate lookup of OCR identifiers, each identifier maps to the keys (e.g. State ids) it was read for.
+
+    Every identifier is indexed by its characters and bigrams together with their positions. A query within edit
+    distance k of an identifier keeps at least len - k of its readable characters (and len - 1 - 2k of its readable
+    bigrams) at a position shifted by at most k, a '?' of the identifier matching any character. Only identifiers
+    passing that count filter are verified with WildcardPattern.
+    """
+    def __init__(self):
+        self._identifiers: list[str | None] = []
+        self._keys: list[set[Hashable]] = []
+        self._slots: dict[str, int] = {}
+        self._free: list[int] = []
+        self._characters: dict[tuple[str, int], set[int]] = defaultdict(set)
+        self._bigrams: dict[tuple[str, int], set[int]] = defaultdict(set)
+        self._by_length: dict[int, set[int]] = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def _postings(self, identifier: str) -> Iterable[tuple[dict[tuple[str, int], set[int]], tuple[str, int]]]:
+        for position, char in enumerate(identifier):
+            yield self._characters, (char, position)
+        for position in range(len(identifier) - 1):
+            yield self._bigrams, (identifier[position:position + 2], position)
+
+    def add(self, identifier: str | None, key: Hashable) -> None:
+        if not identifier:
+            return
+        with self._lock:
+            slot = self._slots.get(identifier)
+            if slot is not None:
+                self._keys[slot].add(key)
+                return
+            if self._free:
+                slot = self._free.pop()
+                self._identifiers[slot], self._keys[slot] = identifier, {key}
+            else:
+                slot = len(self._identifiers)
+                self._identifiers.append(identifier)
+                self._keys.append({key})
+            self._slots[identifier] = slot
+            self._by_length[len(identifier)].add(slot)
+            for postings, gram in self._postings(identifier):
+                postings[gram].add(slot)
+
+    def remove(self, identifier: str | None, key: Hashable) -> None:
+        if not identifier:
+            return
+        with self._lock:
+            slot = self._slots.get(identifier)
+            if slot is None:
+                return
+            self._keys[slot].discard(key)
+            if self._keys[slot]:
+                return
+            del self._slots[identifier]
+            self._identifiers[slot] = None
+            self._free.append(slot)
+            self._by_length[len(identifier)].discard(slot)
+            for postings, gram in self._postings(identifier):
+                postings[gram].discard(slot)
+                if not postings[gram]:
+                    del postings[gram]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._identifiers.clear()
+            self._keys.clear()
+            self._slots.clear()
+            self._free.clear()
+            self._characters.clear()
+            self._bigrams.clear()
+            self._by_length.clear()
+
+    def _near(self, postings: dict[tuple[str, int], set[int]], grams: Iterable[str], position: int, max_distance: int) -> set[int]:
+        slots: set[int] = set()
+        for gram in grams:
+            for shifted in range(max(0, position - max_distance), position + max_distance + 1):
+                slots |= postings.get((gram, shifted), set())
+        return slots
+
+    def _candidates(self, query: str, max_distance: int) -> Iterable[int]:
+        bigrams = [(query[i:i + 2], i) for i in range(len(query) - 1) if WILDCARD not in query[i:i + 2]]
+        required = len(bigrams) - 2 * max_distance
+        if required > 0:
+            # Identifier bigrams with a '?' match the query bigram too
+            near = [self._near(self._bigrams, {gram, gram[0] + WILDCARD, WILDCARD + gram[1], WILDCARD * 2}, i, max_distance) for gram, i in bigrams]
+        else:
+            characters = [(char, i) for i, char in enumerate(query) if char != WILDCARD]
+            required = len(characters) - max_distance
+            if required <= 0:
+                # Mostly unreadable query, every identifier of a close enough length is a candidate
+                return chain.from_iterable(self._by_length.get(length, ()) for length in range(len(query) - max_distance, len(query) + max_distance + 1))
+            near = [self._near(self._characters, (char, WILDCARD), i, max_distance) for char, i in characters]
+        return [slot for slot, count in Counter(chain.from_iterable(near)).items() if count >= required]
+
+    def search(self, query: str, max_distance: int = 1, limit: int = 10) -> list[IdentifierMatch]:
+        if not query:
+            return []
+        pattern = WildcardPattern(query)
+        matches = []
+        with self._lock:
+            for slot in self._candidates(query, max_distance):
+                identifier = self._identifiers[slot]
+                if abs(len(identifier) - len(query)) > max_distance:
+                    continue
+                distance = pattern.distance(identifier)
+                if distance <= max_distance:
+                    matches.append(IdentifierMatch(identifier, distance, frozenset(self._keys[slot])))
+        # Closest first, reads with fewer unreadable characters win ties
+        matches.sort(key=lambda match: (match.distance, match.identifier.count(WILDCARD), match.identifier))
+        return matches[:limit]
+
+    def linear_search(self, query: str, max_distance: int = 1, limit: int = 10) -> list[IdentifierMatch]:
+        """Reference implementation without the index, used by the benchmark."""
+        pattern = WildcardPattern(query)
+        matches = []
+        with self._lock:
+            for identifier, slot in self._slots.items():
+                distance = pattern.distance(identifier)
+                if distance <= max_distance:
+                    matches.append(IdentifierMatch(identifier, distance, frozenset(self._keys[slot])))
+        matches.sort(key=lambda match: (match.distance, match.identifier.count(WILDCARD), match.identifier))
+        return matches[:limit]
+
+boat_pass_identifiers = IdentifierIndex()
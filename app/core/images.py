@@ -0,0 +1,211 @@
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import stat
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from email.utils import formatdate, parsedate_to_datetime
+import anyio
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+from app.core.app_config import app_config
+from app.core.app_logger import AppLogger
+
+try:
+    from PIL import Image
+except ImportError:
+    # Thumbnails are optional, without Pillow the full images are served instead
+    Image = None
+
+logger = AppLogger(__name__, logging._nameToLevel[app_config.LOG_LEVEL]).get_logger()
+
+# Hidden, so it cannot clash with an image filename, see app.core.storage.image_path
+THUMBNAIL_FOLDER = ".thumbnails"
+CHUNK_SIZE = 256 * 1024
+
+def thumbnail_path(filename: str) -> str:
+    # The whole filename, a.png and a.jpg get their own thumbnails
+    return os.path.join(app_config.DATA_FOLDER, THUMBNAIL_FOLDER, f"{filename}.jpg")
+
+def is_current(target: str, source: str) -> bool:
+    """True when the thumbnail exists and is not older than its image."""
+    try:
+        return os.stat(target).st_mtime_ns >= os.stat(source).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+def make_thumbnail(source: str, target: str, size: int, quality: int) -> None:
+    """Writes a JPEG of at most size pixels on the longer side. Runs in the thumbnail process pool."""
+    with Image.open(source) as image:
+        # Lets the JPEG decoder scale down while decoding, much cheaper than decoding the full frame
+        image.draft("RGB", (size, size))
+        image = image.convert("RGB")
+        image.thumbnail((size, size))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_path = f"{target}.{os.getpid()}.tmp"
+        image.save(tmp_path, "JPEG", quality=quality, optimize=True)
+    os.replace(tmp_path, target)
+
+class ThumbnailGenerator:
+    """Creates thumbnails of stored images in a pool of worker processes, decoding and resizing holds the GIL.
+
+    submit() is called for every new image and returns immediately, get() creates a missing or outdated thumbnail on
+    demand, e.g. for images stored before thumbnails existed. With 0 workers thumbnails are only made on demand, in a thread.
+    """
+    def __init__(self, workers: int, size: int, quality: int):
+        self.workers = workers
+        self.size = size
+        self.quality = quality
+        self.enabled = Image is not None
+        self._executor: ProcessPoolExecutor | None = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ProcessPoolExecutor | None:
+        with self._lock:
+            if self._executor is None and self.workers > 0:
+                # Spawned, forking a process with running threads and an event loop is not safe
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def _discard(self, pool: ProcessPoolExecutor) -> None:
+        # A pool whose worker died refuses all further work, the next _pool() starts a new one
+        with self._lock:
+            if self._executor is pool:
+                self._executor = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, pool: ProcessPoolExecutor, source: str, target: str) -> Future:
+        try:
+            future = pool.submit(make_thumbnail, source, target, self.size, self.quality)
+        except BrokenProcessPool:
+            self._discard(pool)
+            pool = self._pool()
+            future = pool.submit(make_thumbnail, source, target, self.size, self.quality)
+        future.add_done_callback(lambda done: self._discard(pool) if not done.cancelled() and isinstance(done.exception(), BrokenProcessPool) else None)
+        return future
+
+    def _log_error(self, future: Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Error while creating a thumbnail: {future.exception()!r}")
+
+    def submit(self, source: str, filename: str) -> None:
+        """Never raises, it runs after the image and its boat pass are committed."""
+        try:
+            pool = self._pool() if self.enabled else None
+            if pool is not None:
+                self._submit(pool, source, thumbnail_path(filename)).add_done_callback(self._log_error)
+        except Exception as e:
+            logger.error(f"Error while submitting the thumbnail of {filename}: {e!r}")
+
+    async def get(self, source: str, filename: str) -> str | None:
+        """Path of the thumbnail, None when thumbnails are not available."""
+        target = thumbnail_path(filename)
+        if is_current(target, source):
+            return target
+        if not self.enabled:
+            return None
+        pool = self._pool()
+        if pool is not None:
+            await asyncio.wrap_future(self._submit(pool, source, target))
+        else:
+            await asyncio.to_thread(make_thumbnail, source, target, self.size, self.quality)
+        return target
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+thumbnails = ThumbnailGenerator(app_config.THUMBNAIL_WORKERS, app_config.THUMBNAIL_SIZE, app_config.THUMBNAIL_QUALITY)
+
+def etag(stat_result: os.stat_result) -> str:
+    return '"' + hashlib.md5(f"{stat_result.st_mtime_ns}-{stat_result.st_size}".encode(), usedforsecurity=False).hexdigest() + '"'
+
+def not_modified(headers, tag: str, stat_result: os.stat_result) -> bool:
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        return if_none_match.strip() == "*" or tag in [value.strip().removeprefix("W/") for value in if_none_match.split(",")]
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return int(stat_result.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def parse_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """First and last byte of a single "bytes=" range, None to send the whole file, ValueError when unsatisfiable."""
+    if header is None or not header.startswith("bytes=") or "," in header:
+        # Multiple ranges are rare for images, answering them with the whole file is allowed
+        return None
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        if first == "":
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise ValueError(header)
+    return start, end
+
+class FileRangeResponse(Response):
+    """Sends a byte range of a file, with the ASGI zero-copy send extension when the server offers it."""
+    def __init__(self, path: str, start: int, end: int, status_code: int, headers: dict[str, str], media_type: str):
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.path = path
+        self.start = start
+        self.end = end
+        self.headers["content-length"] = str(end - start + 1)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        count = self.end - self.start + 1
+        if scope["method"] == "HEAD" or count == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        with open(self.path, "rb") as file:
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send({"type": "http.response.zerocopysend", "file": file, "offset": self.start, "count": count, "more_body": False})
+                return
+            position = self.start
+            while position <= self.end:
+                chunk = await anyio.to_thread.run_sync(os.pread, file.fileno(), min(CHUNK_SIZE, self.end - position + 1), position)
+                if not chunk:
+                    break
+                position += len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": position <= self.end})
+            if position <= self.end:
+                # The file shrank while it was sent
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+def file_response(path: str, stat_result: os.stat_result, request_headers, media_type: str = "image/jpeg") -> Response:
+    """Conditional and range aware response for a stored file, handed to nginx when IMAGE_ACCEL_REDIRECT is set."""
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise FileNotFoundError(path)
+    tag = etag(stat_result)
+    headers = {
+        "etag": tag,
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "cache-control": f"private, max-age={app_config.IMAGE_CACHE_MAX_AGE}",
+        "accept-ranges": "bytes",
+    }
+    if app_config.IMAGE_ACCEL_REDIRECT:
+        # nginx answers conditional and range requests itself and sends the file with sendfile
+        relative = os.path.relpath(path, app_config.DATA_FOLDER)
+        return Response(headers={"x-accel-redirect": app_config.IMAGE_ACCEL_REDIRECT.rstrip("/") + "/" + relative, "content-type": media_type, "cache-control": headers["cache-control"]})
+    if not_modified(request_headers, tag, stat_result):
+        return Response(status_code=304, headers=headers)
+    size = stat_result.st_size
+    if_range = request_headers.get("if-range")
+    try:
+        byte_range = parse_range(request_headers.get("range"), size) if if_range is None or if_range in (tag, headers["last-modified"]) else None
+    except ValueError:
+        return Response(status_code=416, headers=headers | {"content-range": f"bytes */{size}"})
+    if byte_range is None:
+        return FileRangeResponse(path, 0, size - 1, 200, headers, media_type)
+    start, end = byte_range
+    return FileRangeResponse(path, start, end, 206, headers | {"content-range": f"bytes {start}-{end}/{size}"}, media_type)
@@ -0,0 +1,217 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+from functools import lru_cache
+from typing import Callable, Iterable
+from sqlalchemy import Engine, event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# Prometheus text exposition format without the client library. Every update is a dict lookup and an addition
+# under a lock, cheap enough to stay on in production.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.labelnames)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+    def samples(self) -> list[str]:
+        return []
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, key)} {value}" for key, value in values]
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        # Per label set: count per bucket (the last one is +Inf), sum of observations
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+class CallbackMetric(Metric):
+    """Value read when the metrics are scraped, callback returns a number or a dict of label values tuple to number.
+
+    Exposes state other components already keep, e.g. the counters of ConnectionManager, without updating it twice.
+    """
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float | dict[tuple, float]], labelnames: Iterable[str] = (), type: str = "gauge"):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.type = type
+
+    def samples(self) -> list[str]:
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{_labels(self.labelnames, key)} {value}" for key, value in values.items()]
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name: str, documentation: str, callback: Callable[[], float | dict[tuple, float]], labelnames: Iterable[str] = (), type: str = "gauge") -> CallbackMetric:
+        return self.register(CallbackMetric(name, documentation, callback, labelnames, type))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.header()
+            lines += metric.samples()
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+http_request_duration = metrics.histogram("http_request_duration_seconds", "Time from receiving a request to sending the last byte of its response", ("method", "route", "status"))
+db_query_duration = metrics.histogram("db_query_duration_seconds", "Database statement execution time by statement type and table", ("statement",))
+db_pool_wait = metrics.histogram("db_pool_checkout_wait_seconds", "Time spent waiting for a connection from the pool")
+db_pool_timeouts = metrics.counter("db_pool_checkout_timeouts_total", "Checkouts that gave up after DB_POOL_TIMEOUT with every connection in use")
+ws_broadcast_duration = metrics.histogram("ws_broadcast_duration_seconds", "Time to hand a broadcast to all WebSocket client queues", ("message",))
+ws_send_duration = metrics.histogram("ws_send_duration_seconds", "Time to write one message to a WebSocket client", ("message",))
+preview_frames_dropped = metrics.counter("preview_frames_dropped_total", "Posted preview frames not broadcast, by camera and reason (rate, duplicate, unchanged)", ("camera_id", "reason"))
+preview_bytes_saved = metrics.counter("preview_bytes_saved_total", "JPEG bytes not sent to WebSocket clients thanks to dropped frames and low resolution variants", ("reason",))
+image_bytes = metrics.counter("image_bytes_ingested_total", "Bytes of image data received", ("camera_id", "source"))
+
+class MetricsMiddleware:
+    """ASGI middleware timing HTTP requests by route template, so path parameters do not multiply the series."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # FastAPI stores the matched route in the scope while routing
+            route = scope.get("route")
+            http_request_duration.observe(time.perf_counter() - start, method=scope["method"], route=getattr(route, "path", "unmatched"), status=status)
+
+_STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+"?(\w+)', re.IGNORECASE)
+
+@lru_cache(maxsize=1024)
+def statement_label(statement: str) -> str:
+    # SQLAlchemy caches compiled statements, so the same strings come back and the regex runs once per statement
+    words = statement.split(None, 1)
+    if not words:
+        return "unknown"
+    match = _STATEMENT_TABLE.search(statement)
+    return f"{words[0].upper()} {match.group(1).lower()}" if match else words[0].upper()
+
+def instrument_engine(engine: Engine) -> None:
+    """Times every statement executed through the (sync) engine, async engines pass their sync_engine."""
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        db_query_duration.observe(time.perf_counter() - conn.info["query_start"].pop(), statement=statement_label(statement))
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        starts = context.connection.info.get("query_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a free connection."""
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            db_pool_timeouts.inc()
+            raise
+        finally:
+            db_pool_wait.observe(time.perf_counter() - start)
+
+class TimedAsyncAdaptedQueuePool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            db_pool_timeouts.inc()
+            raise
+        finally:
+            db_pool_wait.observe(time.perf_counter() - start)
@@ -0,0 +1,95 @@
+import logging
+from datetime import datetime, UTC
+from typing import Callable, NamedTuple
+from sqlalchemy import Connection, Engine, inspect, text
+from sqlmodel import SQLModel, select
+from app.core.app_config import app_config
+from app.core.app_logger import AppLogger
+from app.models import SchemaVersion
+from app.core.occupancy import rebuild as rebuild_occupancy
+from app.core.state_changes import create_triggers as create_state_change_triggers
+
+logger = AppLogger(__name__, logging._nameToLevel[app_config.LOG_LEVEL]).get_logger()
+
+# Arbitrary key of the Postgres advisory lock that serialises workers migrating at the same time
+MIGRATION_LOCK_KEY = 7_240_113
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+
+def execute(*statements: str) -> Callable[[Connection], None]:
+    def upgrade(connection: Connection) -> None:
+        for statement in statements:
+            connection.execute(text(statement))
+    return upgrade
+
+def add_detections_column(connection: Connection) -> None:
+    column_type = "BYTEA" if connection.dialect.name == "postgresql" else "BLOB"
+    connection.execute(text(f"ALTER TABLE boatpass ADD COLUMN detections {column_type}"))
+
+def backfill_occupancy(connection: Connection) -> None:
+    rebuild_occupancy(connection)
+
+def add_change_version(connection: Connection) -> None:
+    # Existing States keep version 0, clients with an old cursor get 400 and read all States again
+    connection.execute(text("ALTER TABLE state ADD COLUMN change_version BIGINT NOT NULL DEFAULT 0"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_state_change_version_id ON state (change_version, id)"))
+    connection.execute(text("DROP INDEX IF EXISTS ix_state_edit_timestamp_id"))
+    create_state_change_triggers(connection)
+
+# Append only, a released migration is never edited. create_all builds the latest schema of a new database, which is then
+# stamped with the latest version, so every migration has to bring an existing database to what models.py declares.
+MIGRATIONS: list[Migration] = [
+    Migration(1, "Indexes for time ranges, identifier lookups and foreign keys", execute(
+        "CREATE INDEX IF NOT EXISTS ix_boatpass_timestamp_id ON boatpass (timestamp, id)",
+        "CREATE INDEX IF NOT EXISTS ix_boatpass_detected_identifier ON boatpass (detected_identifier)",
+        "CREATE INDEX IF NOT EXISTS ix_boundingbox_boat_pass_id ON boundingbox (boat_pass_id)",
+        "CREATE INDEX IF NOT EXISTS ix_ocrresult_bounding_box_id ON ocrresult (bounding_box_id)",
+        "CREATE INDEX IF NOT EXISTS ix_state_arrival_time ON state (arrival_time)",
+        "CREATE INDEX IF NOT EXISTS ix_state_departure_time ON state (departure_time)",
+        "CREATE INDEX IF NOT EXISTS ix_state_payment_status ON state (payment_status)",
+        "CREATE INDEX IF NOT EXISTS ix_state_best_detected_identifier ON state (best_detected_identifier)",
+        "CREATE INDEX IF NOT EXISTS ix_state_first_boat_pass_id ON state (first_boat_pass_id)",
+    )),
+    Migration(2, "Index for State changes since a cursor", execute(
+        "CREATE INDEX IF NOT EXISTS ix_state_edit_timestamp_id ON state (edit_timestamp, id)",
+    )),
+    # Only the column, the rows are moved by python -m app.cli compact-detections in batches
+    Migration(3, "Compact detections column on boat passes", add_detections_column),
+    # create_all adds the table, the rows come from the existing States. python -m app.cli rebuild-occupancy redoes it.
+    Migration(4, "Backfill the hourly occupancy rollup", backfill_occupancy),
+    Migration(5, "Database assigned change versions for State changes since a cursor", add_change_version),
+]
+
+def latest_version() -> int:
+    return max((migration.version for migration in MIGRATIONS), default=0)
+
+def current_version(connection: Connection) -> int:
+    if not inspect(connection).has_table(SchemaVersion.__tablename__):
+        return 0
+    versions = connection.execute(select(SchemaVersion.version)).scalars().all()
+    return max(versions, default=0)
+
+def _record(connection: Connection, migration: Migration) -> None:
+    connection.execute(SchemaVersion.__table__.insert().values(version=migration.version, description=migration.description, applied_at=datetime.now(UTC)))
+
+def migrate(engine: Engine) -> list[Migration]:
+    """Creates missing tables and applies pending migrations in one transaction, returns the applied ones."""
+    with engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            # Index builds on large tables and waiting for another worker's migration may outlast DB_STATEMENT_TIMEOUT
+            connection.execute(text("SET LOCAL statement_timeout = 0"))
+            connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        # A database without the boat pass table is new, create_all gives it the latest schema
+        new_database = not inspect(connection).has_table("boatpass")
+        SQLModel.metadata.create_all(connection)
+        version = current_version(connection)
+        pending = [migration for migration in MIGRATIONS if migration.version > version]
+        for migration in pending:
+            if not new_database:
+                logger.debug(f"Applying migration {migration.version}: {migration.description}")
+                migration.upgrade(connection)
+            _record(connection, migration)
+    return [] if new_database else pending
@@ -0,0 +1,159 @@
+from collections import Counter
+from datetime import datetime, timedelta, tzinfo, UTC
+from typing import Iterable, Literal
+from sqlalchemy import Connection, delete, event, func, inspect, or_, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from sqlmodel import select
+from app.models import OccupancyCounts, OccupancyHour, OccupancyPublic, PaymentStatusEnum, State
+from app.core.dashboard_cache import as_utc
+
+# Hourly rollup of the States in the occupancyhour table. Every flush that adds or changes States adds the difference
+# between the old and the new contributions of those States to their hours in the same transaction, so the rollup commits
+# and rolls back together with the States. rebuild() computes it from scratch.
+#
+# A State counts as arrived in the hour of its arrival_time and as departed in the hour of its departure_time. It is in
+# the marina from its arrival to its departure, weird States are left out of the occupancy: an arrival without departure
+# is closed by nothing and would be counted for ever.
+
+HOUR = timedelta(hours=1)
+# Periods a range query may return, a bit over two years of hours
+MAX_PERIODS = 20_000
+COUNTERS = (*OccupancyCounts.model_fields, "occupancy_change")
+SNAPSHOT = ("arrival_time", "departure_time", "best_detected_identifier", "payment_status", "weird_state")
+
+Bucket = Literal["hour", "day"]
+
+def hour_of(value: datetime) -> datetime:
+    """Naive UTC start of the hour, like the hour column."""
+    return as_utc(value).astimezone(UTC).replace(minute=0, second=0, microsecond=0, tzinfo=None)
+
+def bucket_start(value: datetime, bucket: Bucket, zone: tzinfo) -> datetime:
+    """Naive UTC start of the hour, or of the day in zone, that value falls into."""
+    if bucket == "day":
+        # The rollup has no finer steps than UTC hours, a day starting within an hour starts with that hour
+        value = as_utc(value).astimezone(zone).replace(hour=0, minute=0, second=0, microsecond=0)
+    return hour_of(value)
+
+def contributions(arrival_time: datetime | None, departure_time: datetime | None, best_detected_identifier: str | None, payment_status: PaymentStatusEnum, weird_state: bool) -> Counter:
+    """Counts a State adds to the rollup, keyed by (hour, counter)."""
+    result = Counter()
+    undetected = best_detected_identifier is not None and '?' in best_detected_identifier
+    if arrival_time is not None:
+        hour = hour_of(arrival_time)
+        result[hour, "arrived"] += 1
+        result[hour, "arrived_undetected_identifier"] += undetected
+        result[hour, "payed"] += payment_status == PaymentStatusEnum.zaplaceno
+        result[hour, "not_payed"] += payment_status == PaymentStatusEnum.nezaplaceno
+        if not weird_state:
+            result[hour, "occupancy_change"] += 1
+            if departure_time is not None:
+                result[hour_of(departure_time), "occupancy_change"] -= 1
+    if departure_time is not None:
+        hour = hour_of(departure_time)
+        result[hour, "departed"] += 1
+        result[hour, "departed_undetected_identifier"] += undetected
+    return result
+
+def _committed_value(state: State, name: str):
+    # The value before the flush, while after_flush runs the attribute history is not reset yet
+    history = inspect(state).attrs[name].history
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return getattr(state, name)
+
+def apply(connection: Connection, changes: Counter) -> None:
+    """Adds the (hour, counter) changes to their rows, missing hours are inserted."""
+    rows: dict[datetime, dict] = {}
+    for (hour, counter), value in changes.items():
+        if value:
+            rows.setdefault(hour, dict.fromkeys(COUNTERS, 0) | {"hour": hour})[counter] += value
+    if not rows:
+        return
+    insert = postgresql.insert if connection.dialect.name == "postgresql" else sqlite.insert
+    table = OccupancyHour.__table__
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(index_elements=[table.c.hour], set_={name: table.c[name] + statement.excluded[name] for name in COUNTERS})
+    # In hour order, so concurrent transactions lock the rows they share in the same order
+    connection.execute(statement, [rows[hour] for hour in sorted(rows)])
+
+@event.listens_for(Session, "after_flush")
+def _update_rollup(session: Session, flush_context) -> None:
+    changes = Counter()
+    for state in session.new:
+        if isinstance(state, State):
+            changes.update(contributions(*(getattr(state, name) for name in SNAPSHOT)))
+    for state in session.dirty:
+        if isinstance(state, State) and session.is_modified(state):
+            changes.update(contributions(*(getattr(state, name) for name in SNAPSHOT)))
+            changes.subtract(contributions(*(_committed_value(state, name) for name in SNAPSHOT)))
+    for state in session.deleted:
+        if isinstance(state, State):
+            changes.subtract(contributions(*(_committed_value(state, name) for name in SNAPSHOT)))
+    if changes:
+        apply(session.connection(), changes)
+
+def rebuild(connection: Connection, batch_size: int = 5000) -> int:
+    """Replaces the rollup with one computed from all States, returns the number of hours."""
+    if connection.dialect.name == "postgresql":
+        # Transactions changing States wait for the rebuild in their flush and then add their change to the new rows.
+        # Ones that flushed before hold the table until they commit and the rebuild sees their States.
+        connection.execute(text(f"LOCK TABLE {OccupancyHour.__tablename__} IN EXCLUSIVE MODE"))
+    # On SQLite the delete takes the write lock of the whole database first
+    connection.execute(delete(OccupancyHour))
+    totals = Counter()
+    statement = select(*(getattr(State, name) for name in SNAPSHOT))
+    for partition in connection.execute(statement, execution_options={"yield_per": batch_size}).partitions():
+        for row in partition:
+            totals.update(contributions(*row))
+    apply(connection, totals)
+    return len({hour for hour, _ in totals})
+
+def range_statement(*, since: datetime, until: datetime):
+    """Hours in [since, until) with the running occupancy, and the last hour before since as its starting point.
+
+    The window runs over all hours before until in one scan of the primary key, the outer filter only drops rows.
+    """
+    order = {"order_by": OccupancyHour.hour}
+    hours = select(
+        OccupancyHour,
+        func.sum(OccupancyHour.occupancy_change).over(**order).label("occupancy"),
+        func.lead(OccupancyHour.hour).over(**order).label("next_hour"),
+    ).where(OccupancyHour.hour < until).subquery()
+    return select(*hours.c).where(or_(hours.c.hour >= since, func.coalesce(hours.c.next_hour, until) >= since)).order_by(hours.c.hour)
+
+def periods(rows: Iterable, since: datetime, until: datetime, bucket: Bucket, zone: tzinfo) -> list[OccupancyPublic]:
+    """Rows of range_statement summed into the hours or days of [since, until), hours without a row included."""
+    occupancy = 0
+    by_hour = {}
+    for row in rows:
+        if row.hour < since:
+            occupancy = row.occupancy
+        else:
+            by_hour[row.hour] = row
+    result: list[OccupancyPublic] = []
+    start = None
+    hour = since
+    while hour < until:
+        row = by_hour.get(hour)
+        if row is not None:
+            occupancy = row.occupancy
+        period_start = bucket_start(hour, bucket, zone)
+        if period_start != start:
+            start = period_start
+            display = start.replace(tzinfo=UTC).astimezone(zone) if bucket == "day" else start.replace(tzinfo=UTC)
+            result.append(OccupancyPublic(start=display, undetected_identifier_rate=0.0, occupancy=occupancy, peak_occupancy=occupancy))
+        period = result[-1]
+        if row is not None:
+            for name in OccupancyCounts.model_fields:
+                setattr(period, name, getattr(period, name) + getattr(row, name))
+        period.occupancy = occupancy
+        period.peak_occupancy = max(period.peak_occupancy, occupancy)
+        hour += HOUR
+    for period in result:
+        passes = period.arrived + period.departed
+        if passes:
+            period.undetected_identifier_rate = (period.arrived_undetected_identifier + period.departed_undetected_identifier) / passes
+    return result
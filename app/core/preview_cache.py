@@ -0,0 +1,132 @@
+import asyncio
+import base64
+import logging
+import os
+import re
+import struct
+from functools import cached_property
+from typing import Any
+from app.core.app_config import app_config
+from app.models import WebsocketImageData
+from app.core.app_logger import AppLogger
+
+logger = AppLogger(__name__, logging._nameToLevel[app_config.LOG_LEVEL]).get_logger()
+
+# Header of binary WebSocket frames: protocol version, message type and camera id, followed by the raw JPEG bytes
+BINARY_HEADER = struct.Struct(">BBI")
+BINARY_VERSION = 1
+BINARY_TYPE_IMAGE = 1
+
+class PreviewFrame:
+    """One preview image, received either as raw bytes or as base64.
+
+    Both WebSocket encodings are computed lazily and at most once, however many clients the frame is sent to.
+    low is the smaller variant for clients that asked for low resolution, see app.core.preview_filter.
+    """
+    low: "PreviewFrame | None" = None
+
+    def __init__(self, camera_id: int, data: bytes | None = None, image_b64: str | None = None):
+        if data is None and image_b64 is None:
+            raise ValueError("Preview frame needs data or image_b64")
+        self.camera_id = camera_id
+        if data is not None:
+            self.data = data
+        if image_b64 is not None:
+            self.base64 = image_b64
+
+    @classmethod
+    def from_binary_message(cls, message: bytes) -> "PreviewFrame":
+        version, message_type, camera_id = BINARY_HEADER.unpack_from(message)
+        if version != BINARY_VERSION or message_type != BINARY_TYPE_IMAGE:
+            raise ValueError(f"Unsupported preview message {version}/{message_type}")
+        frame = cls(camera_id, data=message[BINARY_HEADER.size:])
+        frame.binary_message = message
+        return frame
+
+    @property
+    def size(self) -> int:
+        # Without decoding a frame that arrived as base64
+        if "data" in self.__dict__:
+            return len(self.data)
+        return len(self.base64) * 3 // 4 - self.base64[-2:].count("=")
+
+    @cached_property
+    def data(self) -> bytes:
+        return base64.b64decode(self.base64)
+
+    @cached_property
+    def base64(self) -> str:
+        return base64.b64encode(self.data).decode()
+
+    @cached_property
+    def json_message(self) -> dict[str, Any]:
+        return WebsocketImageData(camera_id=self.camera_id, image=self.base64).model_dump()
+
+    @cached_property
+    def binary_message(self) -> bytes:
+        return BINARY_HEADER.pack(BINARY_VERSION, BINARY_TYPE_IMAGE, self.camera_id) + self.data
+
+class PreviewCache:
+    """Latest preview frame of every camera, kept in memory.
+
+    New WebSocket subscribers are served from here. Frames are written to disk only by a background task every
+    persist_interval seconds, and only for cameras that changed, so the last frames survive a restart.
+    """
+    def __init__(self, folder: str, file_template: str, persist_interval: float):
+        self.folder = folder
+        self.file_template = file_template
+        self.persist_interval = persist_interval
+        self.frames: dict[int, PreviewFrame] = {}
+        self._dirty: set[int] = set()
+        prefix, _, suffix = file_template.partition("{camera_id}")
+        self._file_pattern = re.compile(f"^{re.escape(prefix)}(\\d+){re.escape(suffix)}$")
+
+    def put(self, frame: PreviewFrame) -> None:
+        self.frames[frame.camera_id] = frame
+        self._dirty.add(frame.camera_id)
+
+    def get(self, camera_id: int) -> PreviewFrame | None:
+        return self.frames.get(camera_id)
+
+    def values(self) -> list[PreviewFrame]:
+        return [self.frames[camera_id] for camera_id in sorted(self.frames)]
+
+    def path(self, camera_id: int) -> str:
+        return os.path.join(self.folder, self.file_template.format(camera_id=camera_id))
+
+    def load(self) -> None:
+        if not os.path.isdir(self.folder):
+            return
+        for name in os.listdir(self.folder):
+            match = self._file_pattern.match(name)
+            if match is None:
+                continue
+            camera_id = int(match.group(1))
+            with open(os.path.join(self.folder, name), "r") as img_file:
+                self.frames.setdefault(camera_id, PreviewFrame(camera_id, image_b64=img_file.read()))
+        logger.debug(f"Loaded previews of cameras {sorted(self.frames)}")
+
+    def _write(self, frames: dict[int, PreviewFrame]) -> None:
+        # Files keep the base64 format so previews saved by older versions still load
+        for camera_id, frame in frames.items():
+            path = self.path(camera_id)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w") as new_file:
+                new_file.write(frame.base64)
+            os.replace(tmp_path, path)
+
+    async def persist(self) -> None:
+        if not self._dirty:
+            return
+        frames = {camera_id: self.frames[camera_id] for camera_id in self._dirty}
+        self._dirty.clear()
+        try:
+            await asyncio.to_thread(self._write, frames)
+        except OSError as e:
+            logger.error(f"Error while saving camera previews: {e}")
+            self._dirty.update(frames)
+
+    async def run_persister(self) -> None:
+        while True:
+            await asyncio.sleep(self.persist_interval)
+            await self.persist()
@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import io
+import logging
+import time
+from app.core.app_config import app_config
+from app.core.app_logger import AppLogger
+from app.core.preview_cache import PreviewFrame
+
+try:
+    from PIL import Image
+except ImportError:
+    # Without Pillow only byte identical frames are dropped and every client gets the full resolution
+    Image = None
+
+logger = AppLogger(__name__, logging._nameToLevel[app_config.LOG_LEVEL]).get_logger()
+
+# The difference hash compares neighbouring pixels of a HASH_SIZE x HASH_SIZE grey frame, HASH_SIZE ** 2 bits
+HASH_SIZE = 16
+
+def analyse(data: bytes, low_size: int, low_quality: int) -> tuple[int, bytes | None]:
+    """Difference hash of a JPEG and, with low_size, a JPEG of at most low_size pixels on the longer side."""
+    with Image.open(io.BytesIO(data)) as image:
+        # Decodes at 1/2 to 1/8 of the resolution when the JPEG allows it, only the luma for the hash alone
+        image.draft("RGB" if low_size else "L", (max(low_size, HASH_SIZE + 1), max(low_size, HASH_SIZE)))
+        image = image.convert("RGB" if low_size else "L")
+        pixels = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BILINEAR).tobytes()
+        low = None
+        if low_size:
+            image.thumbnail((low_size, low_size))
+            buffer = io.BytesIO()
+            image.save(buffer, "JPEG", quality=low_quality)
+            low = buffer.getvalue()
+    bits = 0
+    for row in range(0, len(pixels), HASH_SIZE + 1):
+        for left, right in zip(pixels[row:row + HASH_SIZE], pixels[row + 1:row + HASH_SIZE + 1]):
+            bits = bits << 1 | (left > right)
+    return bits, low if low is not None and len(low) < len(data) else None
+
+class CameraState:
+    __slots__ = ("last_sent", "digest", "dhash")
+
+    def __init__(self):
+        self.last_sent = float("-inf")
+        self.digest: bytes | None = None
+        self.dhash: int | None = None
+
+class PreviewFilter:
+    """Decides which posted preview frames are broadcast at all.
+
+    Per camera, frames arriving faster than its max fps are dropped, then frames byte identical to the last broadcast
+    one and, with Pillow, frames whose difference hash is within max_distance bits of it, like an empty harbour at
+    night. Comparing with the last broadcast frame instead of the last posted one lets slow changes add up until they
+    are sent. Broadcast frames get a variant of at most low_size pixels for clients that asked for low resolution.
+    """
+    def __init__(self, max_fps: float, camera_max_fps: dict[int, float], max_distance: int, low_size: int, low_quality: int):
+        self.max_fps = max_fps
+        self.camera_max_fps = camera_max_fps
+        self.max_distance = max_distance
+        self.low_size = low_size if Image is not None else 0
+        self.low_quality = low_quality
+        self.perceptual = max_distance >= 0 and Image is not None
+        self.cameras: dict[int, CameraState] = {}
+        self.forwarded = 0
+        self.dropped: dict[str, int] = {"rate": 0, "duplicate": 0, "unchanged": 0}
+
+    def min_interval(self, camera_id: int) -> float:
+        fps = self.camera_max_fps.get(camera_id, self.max_fps)
+        return 1.0 / fps if fps > 0 else 0.0
+
+    async def _analyse(self, frame: PreviewFrame, low_size: int) -> tuple[int | None, bytes | None]:
+        try:
+            # Pillow releases the GIL while decoding
+            return await asyncio.to_thread(analyse, frame.data, low_size, self.low_quality)
+        except Exception as e:
+            # Not a JPEG Pillow can read, broadcast as it is like before
+            logger.debug(f"Error while analysing a preview of camera {frame.camera_id}: {e!r}")
+            return None, None
+
+    async def process(self, frame: PreviewFrame, low_resolution: bool) -> str | None:
+        """Reason the frame is dropped, None when it is to be broadcast. With low_resolution it gets frame.low."""
+        camera = self.cameras.setdefault(frame.camera_id, CameraState())
+        now = time.monotonic()
+        reason = None
+        if now - camera.last_sent < self.min_interval(frame.camera_id):
+            reason = "rate"
+        else:
+            digest = hashlib.blake2b(frame.data, digest_size=16).digest()
+            if digest == camera.digest:
+                reason = "duplicate"
+        if reason is not None:
+            self.dropped[reason] += 1
+            return reason
+
+        # Claimed before the analysis, frames posted while it runs are checked against this one
+        previous = camera.last_sent, camera.digest
+        camera.last_sent, camera.digest = now, digest
+        low_size = self.low_size if low_resolution else 0
+        if self.perceptual or low_size:
+            dhash, low = await self._analyse(frame, low_size)
+            if self.perceptual and dhash is not None and camera.dhash is not None and (dhash ^ camera.dhash).bit_count() <= self.max_distance:
+                if (camera.last_sent, camera.digest) == (now, digest):
+                    # Not broadcast, the next frame is compared with the last broadcast one again
+                    camera.last_sent, camera.digest = previous
+                self.dropped["unchanged"] += 1
+                return "unchanged"
+            camera.dhash = dhash
+            if low is not None:
+                frame.low = PreviewFrame(frame.camera_id, data=low)
+        self.forwarded += 1
+        return None
+
+    async def add_low_variant(self, frame: PreviewFrame) -> None:
+        """For frames another worker already filtered and broadcast through the backplane."""
+        if self.low_size and frame.low is None:
+            _, low = await self._analyse(frame, self.low_size)
+            if low is not None:
+                frame.low = PreviewFrame(frame.camera_id, data=low)
+
+    def stats(self) -> dict[str, int | dict[str, int]]:
+        return {"forwarded": self.forwarded, "dropped": dict(self.dropped)}
@@ -1,3 +1,5 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
 from passlib.context import CryptContext
 from jose import jwt
@@ -5,6 +7,8 @@ from datetime import datetime, timedelta
 from app.core.app_config import app_config
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt releases the GIL, so a small thread pool keeps password checks off the event loop. 0 workers runs them inline.
+password_executor = ThreadPoolExecutor(max_workers=app_config.PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash") if app_config.PASSWORD_HASH_WORKERS > 0 else None
 
 def create_access_token(subject: str | Any) -> str:
     expire = datetime.utcnow() + timedelta(hours=app_config.JWT_EXPIRATION)
@@ -15,4 +19,9 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
\ No newline at end of file
+    return pwd_context.hash(password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    if password_executor is None:
+        return verify_password(plain_password, hashed_password)
+    return await asyncio.get_running_loop().run_in_executor(password_executor, verify_password, plain_password, hashed_password)
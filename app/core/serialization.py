@@ -0,0 +1,76 @@
+from operator import attrgetter, itemgetter
+from typing import Any, Iterable
+from pydantic_core import to_json
+from sqlmodel import SQLModel
+from starlette.responses import Response
+from app.core.detections import unpack_detections
+from app.models import BoatPassPublic, BoundingBoxPublic, OcrResult, OcrResultPublic, State
+
+class RowSerializer:
+    """Writes ORM rows as the JSON of a public model without validating them into that model first.
+
+    The rows come from our own tables, so FastAPI's validation of every nested object against the response model
+    only repeats work. The field names are read from the model once and pydantic_core encodes the resulting dicts in
+    the field order of the model. nested maps relationship fields to the serializer of their rows. Rows of a table
+    model serialized as that model are encoded by its own pydantic serializer, which like the response_model path
+    writes the keys in the order the attributes were loaded. Either way the output parses to the same documents as
+    the response_model path.
+    """
+    def __init__(self, model: type[SQLModel], **nested: "RowSerializer"):
+        self.fields = tuple(name for name, field in model.model_fields.items() if name not in nested and not field.exclude)
+        self.nested = nested
+        self.direct = not nested and bool(model.model_config.get("table"))
+        # Loaded column values sit in the instance __dict__, reading them there skips the SQLAlchemy descriptors.
+        # Both getters return a bare value instead of a tuple for a single field.
+        single = len(self.fields) == 1
+        loaded = itemgetter(*self.fields)
+        self._loaded = (lambda values: (loaded(values),)) if single else loaded
+        attributes = attrgetter(*self.fields)
+        self._attributes = (lambda row: (attributes(row),)) if single else attributes
+
+    def columns(self, row: Any) -> dict[str, Any]:
+        try:
+            values = self._loaded(row.__dict__)
+        except KeyError:
+            # Expired or deferred attributes, loaded through the descriptors
+            values = self._attributes(row)
+        return dict(zip(self.fields, values))
+
+    def to_dict(self, row: Any) -> dict[str, Any]:
+        data = self.columns(row)
+        for name, serializer in self.nested.items():
+            data[name] = [serializer.to_dict(child) for child in getattr(row, name)]
+        return data
+
+    def _loaded_row(self, row: Any) -> Any:
+        # pydantic reads the instance __dict__ and would write {} for a row expired by a commit, reading one
+        # attribute reloads all of them
+        if self.fields[0] not in row.__dict__:
+            getattr(row, self.fields[0])
+        return row
+
+    def dump_json(self, row: Any) -> bytes:
+        return to_json(self._loaded_row(row) if self.direct else self.to_dict(row))
+
+    def dump_json_list(self, rows: Iterable[Any]) -> bytes:
+        return to_json([self._loaded_row(row) for row in rows] if self.direct else [self.to_dict(row) for row in rows])
+
+class BoatPassSerializer(RowSerializer):
+    """Reads the boxes of a pass from its compact detections, or from its BoundingBox rows when it has none."""
+    def to_dict(self, row: Any) -> dict[str, Any]:
+        detections = row.detections
+        if detections is None:
+            return super().to_dict(row)
+        data = self.columns(row)
+        data["bounding_boxes"] = unpack_detections(detections)
+        return data
+
+class JSONBytesResponse(Response):
+    """Response for a body that is already encoded JSON, returned as is by the route."""
+    media_type = "application/json"
+
+ocr_result_public_json = RowSerializer(OcrResultPublic)
+bounding_box_public_json = RowSerializer(BoundingBoxPublic, ocr_results=ocr_result_public_json)
+boat_pass_public_json = BoatPassSerializer(BoatPassPublic, bounding_boxes=bounding_box_public_json)
+ocr_result_json = RowSerializer(OcrResult)
+state_json = RowSerializer(State)
@@ -0,0 +1,350 @@
+import asyncio
+import fcntl
+import logging
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+from dataclasses import dataclass
+from typing import BinaryIO
+from sqlalchemy import Engine, exc
+from sqlmodel import Session
+from app import crud
+from app.core.app_config import app_config
+from app.core.app_logger import AppLogger
+from app.core.images import thumbnails
+from app.core.storage import CHUNK_SIZE, StagedFile, image_path
+from app.models import BoatPassCreate, SpoolCheckpoint
+
+logger = AppLogger(__name__, logging._nameToLevel[app_config.LOG_LEVEL]).get_logger()
+
+# Payload length, CRC32 of the payload, enqueue time, length of the boat pass JSON that precedes the image
+RECORD_HEADER = struct.Struct(">IIdI")
+SEGMENT_SUFFIX = ".spool"
+# Database errors worth waiting out, anything else is blamed on the records
+TRANSIENT_ERRORS = (exc.OperationalError, exc.InterfaceError, exc.TimeoutError)
+
+class SpoolFull(Exception):
+    pass
+
+@dataclass
+class SpoolRecord:
+    offset: int
+    end: int
+    enqueued_at: float
+    boat_pass: BoatPassCreate
+    image: bytes
+
+class Segment:
+    """One append-only spool file, locked with flock by the worker draining it."""
+    def __init__(self, path: str, fd: int, drained: int = 0):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.fd = fd
+        # Bytes written, and bytes known to be on disk, which is as far as the drain reads
+        self.written = self.size = os.fstat(fd).st_size
+        self.drained = drained
+        # Only the active segment of a worker gets appended to
+        self.active = False
+
+    @property
+    def pending(self) -> int:
+        return self.written - self.drained
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+class IngestSpool:
+    """Write-behind queue for boat passes, durable across restarts.
+
+    append() writes a validated pass and its image to the worker's active segment file and fsyncs it, the request
+    can be answered right after. run() drains the segments in order in batches: images are written, the passes are
+    inserted and linked into States together with the segment's new offset in the spoolcheckpoint table, so a batch
+    is in the database exactly once. Every worker appends to its own segment and holds an flock on
+    each segment it drains, segments left by a stopped worker are unlocked and taken over by the next worker that
+    looks, which replays them from their checkpoint.
+    """
+    def __init__(self, folder: str, batch_size: int, max_bytes: int, segment_bytes: int, retry_delay: float, max_attempts: int):
+        self.folder = folder
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.segments: list[Segment] = []
+        self._lock = threading.Lock()
+        self._wakeup: asyncio.Event | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._task: asyncio.Task | None = None
+        # Enqueue time of the oldest record not in the database yet
+        self.oldest_pending: float | None = None
+        self.appended = 0
+        self.drained = 0
+        self.failures = 0
+        self.rejected = 0
+        # Consecutive failures of the batch at the head of the spool, and the end of a refused batch as (segment, offset)
+        self._attempts = 0
+        self._retry_until: tuple[str, int] | None = None
+
+    def open(self) -> None:
+        os.makedirs(os.path.join(self.folder, "rejected"), exist_ok=True)
+        with self._lock:
+            self._new_segment()
+
+    def _new_segment(self) -> None:
+        if self.segments and self.segments[-1].active:
+            self.segments[-1].active = False
+        name = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}{SEGMENT_SUFFIX}"
+        # Locked under a temporary name, so no other worker takes it for an abandoned segment
+        tmp_path = os.path.join(self.folder, f".{name}")
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        path = os.path.join(self.folder, name)
+        os.rename(tmp_path, path)
+        segment = Segment(path, fd)
+        segment.active = True
+        self.segments.append(segment)
+
+    def pending_bytes(self) -> int:
+        with self._lock:
+            return sum(segment.pending for segment in self.segments)
+
+    def append(self, boat_pass: BoatPassCreate, image: bytes | BinaryIO) -> int:
+        """Blocks until the record is on disk, raises SpoolFull when the drain is too far behind.
+
+        image is either the bytes or a file, which is copied to the segment in chunks. Returns the image size.
+        """
+        meta = boat_pass.model_dump_json().encode()
+        if isinstance(image, bytes):
+            size, crc = len(image), zlib.crc32(image, zlib.crc32(meta))
+        else:
+            # Read twice, once for the header and once into the segment, so the image is never in memory as a whole
+            size, crc = 0, zlib.crc32(meta)
+            image.seek(0)
+            while chunk := image.read(CHUNK_SIZE):
+                size += len(chunk)
+                crc = zlib.crc32(chunk, crc)
+        now = time.time()
+        header = RECORD_HEADER.pack(len(meta) + size, crc, now, len(meta))
+        length = len(header) + len(meta) + size
+        with self._lock:
+            if sum(segment.pending for segment in self.segments) + length > self.max_bytes:
+                raise SpoolFull()
+            segment = self.segments[-1]
+            if segment.written >= self.segment_bytes:
+                self._new_segment()
+                segment = self.segments[-1]
+            try:
+                if isinstance(image, bytes):
+                    self._write_all(segment.fd, header + meta + image)
+                else:
+                    self._write_all(segment.fd, header + meta)
+                    image.seek(0)
+                    while chunk := image.read(CHUNK_SIZE):
+                        self._write_all(segment.fd, chunk)
+            except BaseException:
+                # A partial record would hide every record appended after it
+                os.ftruncate(segment.fd, segment.written)
+                raise
+            segment.written += length
+            end = segment.written
+        # Outside the lock, concurrent requests share the flushes
+        os.fsync(segment.fd)
+        with self._lock:
+            # Visible to the drain only once it is durable, the fsync also covered the records written before this one
+            segment.size = max(segment.size, end)
+            if self.oldest_pending is None:
+                self.oldest_pending = now
+            self.appended += 1
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return size
+
+    @staticmethod
+    def _write_all(fd: int, data: bytes) -> None:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+
+    def _adopt(self, session: Session) -> None:
+        """Takes over the segments of workers that are gone, the files nobody holds a lock on."""
+        known = {segment.name for segment in self.segments}
+        adopted = []
+        for name in sorted(os.listdir(self.folder)):
+            if not name.endswith(SEGMENT_SUFFIX) or name.startswith(".") or name in known:
+                continue
+            path = os.path.join(self.folder, name)
+            fd = os.open(path, os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            adopted.append(Segment(path, fd, crud.get_spool_checkpoint(session=session, segment=name)))
+        if adopted:
+            logger.info(f"Replaying spool segments {', '.join(segment.name for segment in adopted)}")
+            with self._lock:
+                # Names start with the creation time, left over segments are older than the ones of this worker
+                self.segments = sorted(adopted + self.segments, key=lambda segment: (segment.active, segment.name))
+
+    def _read_batch(self, segment: Segment, limit: int) -> list[SpoolRecord]:
+        records = []
+        offset = segment.drained
+        while len(records) < limit and offset < segment.size:
+            header = os.pread(segment.fd, RECORD_HEADER.size, offset)
+            if len(header) == RECORD_HEADER.size:
+                length, crc, enqueued_at, meta_length = RECORD_HEADER.unpack(header)
+                payload = os.pread(segment.fd, length, offset + RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size or len(payload) < length or zlib.crc32(payload) != crc:
+                # A write cut short by a crash, nothing after it was acknowledged
+                logger.error(f"Truncated record at {offset} of spool segment {segment.name}, skipping the rest")
+                with self._lock:
+                    segment.written = segment.size = offset
+                    if segment.active:
+                        self._new_segment()
+                break
+            end = offset + RECORD_HEADER.size + length
+            records.append(SpoolRecord(offset, end, enqueued_at, BoatPassCreate.model_validate_json(payload[:meta_length]), payload[meta_length:]))
+            offset = end
+        return records
+
+    def _store(self, session: Session, segment: Segment, records: list[SpoolRecord]) -> None:
+        staged = [StagedFile(image_path(record.boat_pass.image_filename)) for record in records]
+        try:
+            for staged_file, record in zip(staged, records):
+                staged_file.write_bytes(record.image)
+
+            def before_commit():
+                session.merge(SpoolCheckpoint(segment=segment.name, offset=records[-1].end))
+                for staged_file in staged:
+                    staged_file.commit()
+
+            # Linked in the same transaction, a replay after a crash finds the passes either linked or not stored at all
+            crud.create_boat_passes(session=session, boat_passes=[record.boat_pass for record in records], before_commit=before_commit, link=True)
+        except Exception:
+            for staged_file in staged:
+                staged_file.discard()
+            raise
+        with self._lock:
+            segment.drained = records[-1].end
+        for staged_file, record in zip(staged, records):
+            thumbnails.submit(staged_file.final_path, record.boat_pass.image_filename)
+
+    def _reject(self, session: Session, segment: Segment, record: SpoolRecord) -> None:
+        # Kept next to the segments as <segment>.<offset>.json and .jpg, the checkpoint moves past the record
+        base = os.path.join(self.folder, "rejected", f"{segment.name}.{record.offset}")
+        with open(f"{base}.json", "w") as f:
+            f.write(record.boat_pass.model_dump_json())
+        with open(f"{base}.jpg", "wb") as f:
+            f.write(record.image)
+        session.merge(SpoolCheckpoint(segment=segment.name, offset=record.end))
+        session.commit()
+        with self._lock:
+            segment.drained = record.end
+        self.rejected += 1
+        logger.error(f"Set aside spool record {record.offset} of {segment.name} after {self.max_attempts} failed attempts")
+
+    def _finish(self, session: Session, segment: Segment) -> None:
+        # The file goes first, a checkpoint without its file is harmless, a file without its checkpoint would be replayed
+        os.remove(segment.path)
+        segment.close()
+        with self._lock:
+            self.segments.remove(segment)
+        crud.delete_spool_checkpoint(session=session, segment=segment.name)
+
+    def drain_once(self, engine: Engine) -> int:
+        """Writes one batch to the database, returns the number of records it took off the spool."""
+        with Session(engine, expire_on_commit=False) as session:
+            self._adopt(session)
+            while True:
+                with self._lock:
+                    segment = next((segment for segment in self.segments if segment.pending or not segment.active), None)
+                if segment is None:
+                    return 0
+                # Goes through a batch the database refused one record at a time, to find the record to set aside
+                single = self._retry_until is not None and self._retry_until[0] == segment.name and segment.drained < self._retry_until[1]
+                records = self._read_batch(segment, 1 if single else self.batch_size)
+                if records:
+                    break
+                with self._lock:
+                    done = not segment.active and segment.pending == 0 and segment.size == segment.written
+                if not done:
+                    # The last append is still being flushed, it wakes the drain when it is done
+                    return 0
+                self._finish(session, segment)
+            self.oldest_pending = records[0].enqueued_at
+            try:
+                self._store(session, segment, records)
+            except TRANSIENT_ERRORS:
+                raise
+            except Exception:
+                self._attempts += 1
+                if self._attempts >= self.max_attempts:
+                    self._attempts = 0
+                    if len(records) > 1:
+                        self._retry_until = (segment.name, records[-1].end)
+                    else:
+                        session.rollback()
+                        self._reject(session, segment, records[0])
+                        return 1
+                raise
+            self._attempts = 0
+            self.drained += len(records)
+            with self._lock:
+                if not any(segment.pending for segment in self.segments):
+                    self.oldest_pending = None
+            return len(records)
+
+    async def run(self, engine: Engine) -> None:
+        delay = self.retry_delay
+        while True:
+            try:
+                drained = await asyncio.to_thread(self.drain_once, engine)
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"Error while draining the spool, retrying in {delay} s: {e!r}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60.0)
+                continue
+            delay = self.retry_delay
+            if not drained:
+                self._wakeup.clear()
+                # Also looks for segments of stopped workers now and then
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), 5.0)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def start(self, engine: Engine) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self.run(engine))
+
+    async def stop(self) -> None:
+        # Whatever is left is replayed on the next start
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._loop = None
+
+    def lag(self) -> float:
+        oldest = self.oldest_pending
+        return time.time() - oldest if oldest is not None else 0.0
+
+    def stats(self) -> dict[str, int | float]:
+        with self._lock:
+            segments = len(self.segments)
+        return {
+            "segments": segments,
+            "pending_bytes": self.pending_bytes(),
+            "lag_seconds": self.lag(),
+            "appended": self.appended,
+            "drained": self.drained,
+            "failures": self.failures,
+            "rejected": self.rejected,
+        }
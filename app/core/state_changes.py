@@ -0,0 +1,51 @@
+from sqlalchemy import DDL, event, func, select, text, tuple_
+from app.models import State
+
+# Every transaction writing a State stamps it with a change version assigned by the database, GET /states?since= pages
+# through the States by (change_version, id). Versions are only returned below the horizon, under which no transaction
+# is still running, so a cursor never skips a change that commits later.
+#
+# Postgres uses the writing transaction's id, the horizon is the oldest transaction id still running. SQLite lets one
+# transaction write at a time, the version is one more than the highest committed one and every version up to it is done.
+
+# The triggers filling State.change_version, created with the table or by migration 5
+TRIGGERS = {
+    "postgresql": [
+        """CREATE OR REPLACE FUNCTION state_change_version() RETURNS trigger AS $$
+        BEGIN
+            NEW.change_version := pg_current_xact_id()::text::bigint;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql""",
+        "CREATE TRIGGER state_change_version BEFORE INSERT OR UPDATE ON state FOR EACH ROW EXECUTE FUNCTION state_change_version()",
+    ],
+    "sqlite": [
+        # The WHEN clause keeps the trigger from firing on its own update
+        f"""CREATE TRIGGER state_change_version_{operation} AFTER {operation.upper()} ON state
+        FOR EACH ROW WHEN NEW.change_version = {"0" if operation == "insert" else "OLD.change_version"} BEGIN
+            UPDATE state SET change_version = (SELECT MAX(change_version) + 1 FROM state) WHERE id = NEW.id;
+        END"""
+        for operation in ("insert", "update")
+    ],
+}
+
+for dialect, statements in TRIGGERS.items():
+    for statement in statements:
+        event.listen(State.__table__, "after_create", DDL(statement).execute_if(dialect=dialect))
+
+def create_triggers(connection) -> None:
+    for statement in TRIGGERS.get(connection.dialect.name, []):
+        connection.execute(text(statement))
+
+def horizon_statement(dialect: str):
+    """Version below which every change is committed or rolled back."""
+    if dialect == "postgresql":
+        return text("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint")
+    return select(func.coalesce(func.max(State.change_version), 0) + 1)
+
+def changes_statement(*, horizon: int, limit: int, cursor: tuple[int, int] | None = None):
+    # Oldest change first, keyset on (change_version, id)
+    statement = select(State, State.change_version).where(State.change_version < horizon)
+    if cursor is not None:
+        statement = statement.where(tuple_(State.change_version, State.id) > tuple_(*cursor))
+    return statement.order_by(State.change_version, State.id).limit(limit)
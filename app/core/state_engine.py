@@ -0,0 +1,81 @@
+import threading
+from datetime import datetime
+from typing import Iterable, Literal
+from app.core.app_config import app_config
+from app.core.dashboard_cache import as_utc
+from app.core.identifier_index import IdentifierIndex
+from app.models import State, StateOfBoatEnum
+
+class StateEngine:
+    """In-memory index of open States (arrived, not departed yet) keyed by their identifier.
+
+    crud.link_boat_passes uses it to match an incoming BoatPass against the open States in O(1), falling back to the
+    approximate index when OCR read the identifier differently. Both are kept in sync by crud.state_changed and rebuilt
+    from the database on startup.
+    """
+    def __init__(self, camera_directions: dict[int, Literal["arrival", "departure"]], transit_minutes: int, match_max_distance: int):
+        self.camera_directions = camera_directions
+        self.transit_minutes = transit_minutes
+        self.match_max_distance = match_max_distance
+        self.open_states: dict[str, int] = {}
+        self.identifiers = IdentifierIndex()
+        self._identifiers: dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def direction(self, camera_id: int) -> Literal["arrival", "departure"] | None:
+        return self.camera_directions.get(camera_id)
+
+    def match(self, identifier: str | None) -> int | None:
+        if not identifier:
+            return None
+        return self.open_states.get(identifier)
+
+    def closest(self, identifier: str | None) -> int | None:
+        """The open State whose identifier is nearest to this read, None when there is none or the nearest is ambiguous."""
+        if not identifier or self.match_max_distance <= 0:
+            return None
+        matches = self.identifiers.search(identifier, max_distance=self.match_max_distance, limit=2)
+        if not matches:
+            return None
+        if len(matches) > 1 and matches[1].distance == matches[0].distance:
+            return None
+        if len(matches[0].keys) > 1:
+            return None
+        return next(iter(matches[0].keys))
+
+    def rebuild(self, states: Iterable[tuple[int, str]]) -> None:
+        with self._lock:
+            self.open_states = {identifier: state_id for state_id, identifier in states}
+            self._identifiers = {state_id: identifier for identifier, state_id in self.open_states.items()}
+            self.identifiers.clear()
+            for identifier, state_id in self.open_states.items():
+                self.identifiers.add(identifier, state_id)
+
+    def apply(self, state: State) -> None:
+        with self._lock:
+            previous = self._identifiers.pop(state.id, None)
+            if previous is not None:
+                self.identifiers.remove(previous, state.id)
+                if self.open_states.get(previous) == state.id:
+                    del self.open_states[previous]
+            if self.is_open(state):
+                replaced = self.open_states.get(state.best_detected_identifier)
+                if replaced is not None and replaced != state.id:
+                    self._identifiers.pop(replaced, None)
+                    self.identifiers.remove(state.best_detected_identifier, replaced)
+                self.open_states[state.best_detected_identifier] = state.id
+                self._identifiers[state.id] = state.best_detected_identifier
+                self.identifiers.add(state.best_detected_identifier, state.id)
+
+    @staticmethod
+    def is_open(state: State) -> bool:
+        # Weird open States were superseded by a later arrival of the same boat and are left for the operator
+        return state.departure_time is None and state.arrival_time is not None and not state.weird_state and bool(state.best_detected_identifier)
+
+    def time_in_marina(self, arrival_time: datetime, departure_time: datetime) -> int:
+        return int((as_utc(departure_time) - as_utc(arrival_time)).total_seconds() // 60)
+
+    def state_of_boat(self, time_in_marina: int) -> StateOfBoatEnum:
+        return StateOfBoatEnum.prujezd if time_in_marina < self.transit_minutes else StateOfBoatEnum.kotvi
+
+state_engine = StateEngine(camera_directions=app_config.CAMERA_DIRECTIONS, transit_minutes=app_config.STATE_TRANSIT_MINUTES, match_max_distance=app_config.STATE_MATCH_MAX_DISTANCE)
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+from app.core.app_config import app_config
+from app.core.app_logger import AppLogger
+from app.core.serialization import state_json
+from app.models import State
+
+logger = AppLogger(__name__, logging._nameToLevel[app_config.LOG_LEVEL]).get_logger()
+
+Handler = Callable[[int, str], Awaitable[None]]
+
+def state_message(state: State) -> str:
+    """WebSocket message of a changed State, the State is encoded like in the GET /states response."""
+    return '{"type":"state","state":' + state_json.dump_json(state).decode() + "}"
+
+class StateEvents:
+    """Hands committed State changes to the event loop, where the subscribed handlers push them to clients.
+
+    crud.state_changed runs on the event loop, in the threadpool or in the spool drain thread. The State is encoded
+    right away, while its session is still open, and only the finished message crosses to the loop. Before bind(),
+    e.g. in the CLI, there is nobody to notify and changes are not encoded at all.
+    """
+    def __init__(self):
+        self.handlers: list[Handler] = []
+        self.published = 0
+        self._loop: asyncio.AbstractEventLoop | None = None
+        # Keeps the dispatch tasks referenced until they finish
+        self._tasks: set[asyncio.Task] = set()
+
+    def subscribe(self, handler: Handler) -> None:
+        self.handlers.append(handler)
+
+    def bind(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+
+    def unbind(self) -> None:
+        self._loop = None
+
+    def publish(self, state: State) -> None:
+        loop = self._loop
+        if loop is None or not self.handlers:
+            return
+        state_id, message = state.id, state_message(state)
+        self.published += 1
+        try:
+            on_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._dispatch(state_id, message)
+        else:
+            try:
+                loop.call_soon_threadsafe(self._dispatch, state_id, message)
+            except RuntimeError:
+                # The loop closed during shutdown
+                pass
+
+    def _dispatch(self, state_id: int, message: str) -> None:
+        for handler in self.handlers:
+            task = asyncio.create_task(handler(state_id, message))
+            self._tasks.add(task)
+            task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Error while pushing a State change: {task.exception()!r}")
+
+state_events = StateEvents()
@@ -0,0 +1,82 @@
+import base64
+import filecmp
+import os
+import uuid
+from typing import BinaryIO
+from app.core.app_config import app_config
+
+CHUNK_SIZE = 1024 * 1024
+# Multiple of 4, so every chunk of a base64 string decodes on its own
+BASE64_CHUNK_SIZE = 4 * CHUNK_SIZE // 3 // 4 * 4
+
+def image_path(filename: str) -> str:
+    if not filename or os.path.basename(filename) != filename or filename.startswith("."):
+        raise ValueError(f"Invalid image filename: {filename}")
+    return os.path.join(app_config.DATA_FOLDER, filename)
+
+class StagedFile:
+    """File written next to its final location under a temporary name.
+
+    commit() links it in place atomically without replacing an existing file, discard() removes whatever this file
+    left, so the image can be made visible together with the database row that points at it. All methods block, call
+    them off the event loop.
+    """
+    def __init__(self, final_path: str):
+        self.final_path = final_path
+        self.tmp_path = os.path.join(os.path.dirname(final_path), f".{uuid.uuid4().hex}.tmp")
+        self.committed = False
+        # Whether commit() created final_path, an identical file that was already there is never removed
+        self.created = False
+        self.size = 0
+
+    def write_stream(self, source: BinaryIO) -> int:
+        size = 0
+        with open(self.tmp_path, "wb") as new_file:
+            while chunk := source.read(CHUNK_SIZE):
+                new_file.write(chunk)
+                size += len(chunk)
+            new_file.flush()
+            os.fsync(new_file.fileno())
+        self.size = size
+        return size
+
+    def write_base64(self, data: str) -> int:
+        size = 0
+        with open(self.tmp_path, "wb") as new_file:
+            for start in range(0, len(data), BASE64_CHUNK_SIZE):
+                chunk = base64.b64decode(data[start:start + BASE64_CHUNK_SIZE], validate=True)
+                new_file.write(chunk)
+                size += len(chunk)
+            new_file.flush()
+            os.fsync(new_file.fileno())
+        self.size = size
+        return size
+
+    def write_bytes(self, data: bytes) -> int:
+        with open(self.tmp_path, "wb") as new_file:
+            new_file.write(data)
+            new_file.flush()
+            os.fsync(new_file.fileno())
+        self.size = len(data)
+        return self.size
+
+    def commit(self) -> None:
+        """Raises FileExistsError when another image already has the name."""
+        try:
+            os.link(self.tmp_path, self.final_path)
+            self.created = True
+        except FileExistsError:
+            # The same image left by an attempt whose database commit failed, e.g. a spool batch replayed after a crash
+            if not filecmp.cmp(self.tmp_path, self.final_path, shallow=False):
+                raise
+        os.remove(self.tmp_path)
+        self.committed = True
+
+    def discard(self) -> None:
+        if self.committed and not self.created:
+            return
+        path = self.final_path if self.committed else self.tmp_path
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
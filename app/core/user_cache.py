@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app.core.app_config import app_config
+from app.models import User
+
+class UserCache:
+    """TTL/LRU cache of users resolved from access tokens, keyed by user id and token.
+
+    Entries are detached copies, so they can be shared between requests. Users changed or deleted through a session of
+    this process are dropped when it commits, changes made by other workers or directly in the database are picked up
+    after the TTL.
+    """
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple[int, str], tuple[float, User]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_size > 0
+
+    def get(self, user_id: int, token: str) -> User | None:
+        key = (user_id, token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_id: int, token: str, user: User) -> None:
+        if not self.enabled:
+            return
+        detached = User.model_validate(user)
+        with self._lock:
+            self._entries[(user_id, token)] = (time.monotonic() + self.ttl, detached)
+            self._entries.move_to_end((user_id, token))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id: int) -> None:
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+user_cache = UserCache(ttl=app_config.USER_CACHE_TTL, max_size=app_config.USER_CACHE_SIZE)
+
+@event.listens_for(Session, "after_flush")
+def _collect_changed_users(session: Session, flush_context) -> None:
+    for user in [*session.dirty, *session.deleted]:
+        if isinstance(user, User) and user.id is not None:
+            session.info.setdefault("changed_user_ids", set()).add(user.id)
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_changed_users(session: Session) -> None:
+    for user_id in session.info.pop("changed_user_ids", ()):
+        user_cache.invalidate_user(user_id)
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changed_users(session: Session) -> None:
+    session.info.pop("changed_user_ids", None)
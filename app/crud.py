@@ -1,16 +1,45 @@
 from datetime import datetime, timedelta, tzinfo, UTC
-from typing import List
+from collections import defaultdict
+from typing import Callable, Iterator, List
 
-from sqlalchemy import func, column
-from app.models import PaymentStatusEnum, StateUpdate, User, UserCreate, DbInitState, BoatPass, BoatPassBase, BoundingBox, BoundingBoxBase, OcrResult, OcrResultBase, BoatPassCreate, State, StateBase, DashboardData
-from app.core.security import get_password_hash, verify_password
+from sqlalchemy import Table, and_, delete, func, or_, text, tuple_, update
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.orm import defer, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from app.models import PaymentStatusEnum, StateOfBoatEnum, StateUpdate, User, UserCreate, DbInitState, BoatPass, BoatPassBase, BoundingBox, BoundingBoxBase, OcrResult, OcrResultBase, BoatPassCreate, State, StateBase, DashboardData, IdAllocation, SpoolCheckpoint, OccupancyPublic
+from app.core.security import get_password_hash
 from app.core.app_logger import AppLogger
 from app.core.app_config import app_config
+from app.core.dashboard_cache import as_utc, dashboard_cache
+from app.core.detections import iter_ocr_results, pack_detections
+from app.core import occupancy, state_changes
+from app.core.state_engine import state_engine
+from app.core.state_events import state_events
+from app.core.identifier_index import boat_pass_identifiers
 from sqlmodel import Session, select
 import logging
 
 logger = AppLogger(__name__, logging._nameToLevel[app_config.LOG_LEVEL]).get_logger()
 
+def state_changed(state: State) -> None:
+    """Keeps the in-process views of States in sync, call it after every committed State change."""
+    dashboard_cache.apply(state)
+    state_engine.apply(state)
+    state_events.publish(state)
+
+def states_changed(states: List[State]) -> None:
+    for state in states:
+        state_changed(state)
+
+def mark_edited(state: State) -> None:
+    """Stamps a State about to be committed with the naive UTC time, like the other datetime columns."""
+    state.edit_timestamp = datetime.now(UTC).replace(tzinfo=None)
+
+def boat_passes_created(boat_passes: List[BoatPass]) -> None:
+    """Adds committed boat passes to the in-process identifier index."""
+    for boat_pass in boat_passes:
+        boat_pass_identifiers.add(boat_pass.detected_identifier, boat_pass.id)
+
 def get_init_db_state(*, session: Session) -> DbInitState:
     statement = select(DbInitState)
     session_state = session.exec(statement).first()
@@ -29,6 +58,9 @@ def create_user(*, session: Session, user_create: UserCreate) -> User:
     session.refresh(user)
     return user
 
+def get_user_by_id(*, session: Session, user_id: int) -> User | None:
+    return session.get(User, user_id)
+
 def get_user_by_email(*, session: Session, email: str) -> User | None:
     statement = select(User).where(User.email == email)
     session_user = session.exec(statement).first()
@@ -39,50 +71,209 @@ def get_user_by_username(*, session: Session, username: str) -> User | None:
     session_user = session.exec(statement).first()
     return session_user
 
-def authenticate(*, session: Session, username: str, password: str) -> User | None:
-    user = get_user_by_username(session=session, username=username)
-    if not user:
-        return None
-    if not verify_password(password, user.hashed_password):
+def allocate_ids(*, session: Session, table: Table, count: int) -> List[int]:
+    """count ids of table for rows that are never inserted, like the boxes of compact detections.
+
+    Postgres takes them from the table's id sequence, so row inserts never reuse them. SQLite picks row ids itself, the
+    ids are counted on from the highest one in use or handed out before.
+    """
+    if count == 0:
+        return []
+    if session.get_bind().dialect.name == "postgresql":
+        statement = text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :count)")
+        return session.execute(statement, {"table": table.name, "count": count}).scalars().all()
+    session.execute(sqlite.insert(IdAllocation).values(name=table.name, last_id=0).on_conflict_do_nothing())
+    highest = select(func.coalesce(func.max(table.c.id), 0)).scalar_subquery()
+    statement = update(IdAllocation).where(IdAllocation.name == table.name).values(last_id=func.max(IdAllocation.last_id, highest) + count).returning(IdAllocation.last_id)
+    last_id = session.execute(statement).scalar_one()
+    return list(range(last_id - count + 1, last_id + 1))
+
+def detection_ids(*, session: Session, boat_passes: List[BoatPassCreate]) -> tuple[Iterator[int], Iterator[int]] | None:
+    """Box and OCR result ids for build_boat_pass, one allocation for all passes. None when new passes are stored as rows."""
+    if app_config.DETECTIONS_STORAGE != "compact":
         return None
-    return user
+    boxes = [box for boat_pass in boat_passes for box in boat_pass.bounding_boxes]
+    box_ids = allocate_ids(session=session, table=BoundingBox.__table__, count=len(boxes))
+    ocr_ids = allocate_ids(session=session, table=OcrResult.__table__, count=sum(len(box.ocr_results) for box in boxes))
+    return iter(box_ids), iter(ocr_ids)
 
-def create_boat_pass(*, session: Session, boat_pass: BoatPassCreate) -> BoatPass:
-    logger.debug(f"Parameter boat pass: {boat_pass}")
+def build_boat_pass(boat_pass: BoatPassCreate, ids: tuple[Iterator[int], Iterator[int]] | None = None) -> BoatPass:
+    if ids is not None:
+        return BoatPass.model_validate(boat_pass, update={"bounding_boxes": [], "state": None, "detections": pack_detections(boat_pass.bounding_boxes, *ids)})
     boat_pass_db = BoatPass.model_validate(boat_pass, update={"bounding_boxes": [], "state": None})
+    for box in boat_pass.bounding_boxes:
+        box_db = BoundingBox(**box.model_dump(exclude={"ocr_results"}))
+        box_db.ocr_results = [OcrResult(**ocr.model_dump()) for ocr in box.ocr_results]
+        boat_pass_db.bounding_boxes.append(box_db)
+    return boat_pass_db
+
+def create_boat_pass(*, session: Session, boat_pass: BoatPassCreate, before_commit: Callable[[], None] | None = None, link: bool = False) -> BoatPass:
+    # The whole object graph is flushed at once, so SQLAlchemy emits one batched INSERT per table and the pass is written in a single transaction.
+    # With link its State is created or closed in the same transaction. before_commit runs after that, if either raises
+    # the transaction is rolled back.
+    logger.debug(f"Parameter boat pass: {boat_pass}")
+    boat_pass_db = build_boat_pass(boat_pass, detection_ids(session=session, boat_passes=[boat_pass]))
     session.add(boat_pass_db)
+    session.flush()
+    logger.debug(f"Created boat pass: {boat_pass_db.id}")
+    try:
+        changed = link_boat_passes(session=session, boat_passes=[boat_pass_db]) if link else []
+        if before_commit is not None:
+            before_commit()
+    except Exception:
+        session.rollback()
+        raise
     session.commit()
-    session.refresh(boat_pass_db)
-    logger.debug(f"Created boat pass: {boat_pass_db}")
+    boat_passes_created([boat_pass_db])
+    states_changed(changed)
+    return boat_pass_db
 
-    for box in boat_pass.bounding_boxes:
-        box_db = BoundingBox.model_validate(box, update={"ocr_results": [], "boat_pass_id": boat_pass_db.id})
-        session.add(box_db)
+def create_boat_passes(*, session: Session, boat_passes: List[BoatPassCreate], before_commit: Callable[[], None] | None = None, link: bool = False) -> List[BoatPass]:
+    ids = detection_ids(session=session, boat_passes=boat_passes)
+    boat_passes_db = [build_boat_pass(boat_pass, ids) for boat_pass in boat_passes]
+    session.add_all(boat_passes_db)
+    changed = []
+    if link or before_commit is not None:
+        session.flush()
+        try:
+            changed = link_boat_passes(session=session, boat_passes=boat_passes_db) if link else []
+            if before_commit is not None:
+                before_commit()
+        except Exception:
+            session.rollback()
+            raise
+    session.commit()
+    boat_passes_created(boat_passes_db)
+    states_changed(changed)
+    logger.debug(f"Created {len(boat_passes_db)} boat passes")
+    return boat_passes_db
+
+def get_spool_checkpoint(*, session: Session, segment: str) -> int:
+    checkpoint = session.get(SpoolCheckpoint, segment)
+    return checkpoint.offset if checkpoint is not None else 0
+
+def delete_spool_checkpoint(*, session: Session, segment: str) -> None:
+    checkpoint = session.get(SpoolCheckpoint, segment)
+    if checkpoint is not None:
+        session.delete(checkpoint)
         session.commit()
-        session.refresh(box_db)
 
-        for ocr in box.ocr_results:
-            ocr_db = OcrResult.model_validate(ocr, update={"bounding_box_id": box_db.id})
-            session.add(ocr_db)
-            session.commit()
-            session.refresh(ocr_db)
+def row_boxes_statement(*, boat_pass_ids: List[int]):
+    return select(BoundingBox).where(BoundingBox.boat_pass_id.in_(boat_pass_ids)).options(selectinload(BoundingBox.ocr_results)).order_by(BoundingBox.id)
 
-    session.refresh(boat_pass_db)
-    return boat_pass_db
+def passes_with_row_boxes(boat_passes: List[BoatPass]) -> List[BoatPass]:
+    return [boat_pass for boat_pass in boat_passes if boat_pass.detections is None]
+
+def attach_row_boxes(boat_passes: List[BoatPass], boxes: List[BoundingBox]) -> None:
+    # Sets the relationship as loaded, without marking the passes as modified
+    boxes_by_pass = defaultdict(list)
+    for box in boxes:
+        boxes_by_pass[box.boat_pass_id].append(box)
+    for boat_pass in boat_passes:
+        set_committed_value(boat_pass, "bounding_boxes", boxes_by_pass.get(boat_pass.id, []))
+
+def load_row_boxes(*, session: Session, boat_passes: List[BoatPass]) -> List[BoatPass]:
+    """Loads the boxes and OCR results of passes stored in the row per box layout, two IN queries for all of them.
+
+    Passes with compact detections need neither, once every pass is compact reading them costs no extra query.
+    """
+    row_passes = passes_with_row_boxes(boat_passes)
+    if row_passes:
+        attach_row_boxes(row_passes, session.exec(row_boxes_statement(boat_pass_ids=[boat_pass.id for boat_pass in row_passes])).all())
+    return boat_passes
+
+def compact_row_boxes(*, session: Session, batch_size: int, keep_rows: bool = False) -> int:
+    """Moves the boxes of the next batch_size passes in the row per box layout into their detections column, with their ids.
+
+    Returns the number of passes moved, 0 once every pass is compact. Each batch is its own transaction, an interrupted run
+    continues where it stopped.
+    """
+    statement = select(BoatPass).where(BoatPass.detections == None).order_by(BoatPass.id).limit(batch_size)
+    boat_passes = load_row_boxes(session=session, boat_passes=session.exec(statement).all())
+    if not boat_passes:
+        return 0
+    box_ids = []
+    for boat_pass in boat_passes:
+        boat_pass.detections = pack_detections(boat_pass.bounding_boxes)
+        box_ids.extend(box.id for box in boat_pass.bounding_boxes)
+    session.add_all(boat_passes)
+    if box_ids and not keep_rows:
+        session.execute(delete(OcrResult).where(OcrResult.bounding_box_id.in_(box_ids)))
+        session.execute(delete(BoundingBox).where(BoundingBox.id.in_(box_ids)))
+    last_id = boat_passes[-1].id
+    session.commit()
+    logger.debug(f"Compacted the boxes of {len(boat_passes)} boat passes up to {last_id}")
+    return len(boat_passes)
+
+def delete_kept_rows(*, session: Session, batch_size: int) -> int:
+    """Deletes the next batch_size BoundingBox rows, with their OcrResult rows, of passes already compact.
+
+    Those are left by compact_row_boxes with keep_rows. Returns the number of boxes deleted, 0 once none are left.
+    """
+    statement = select(BoundingBox.id).join(BoatPass, BoundingBox.boat_pass_id == BoatPass.id).where(BoatPass.detections != None).limit(batch_size)
+    box_ids = session.exec(statement).all()
+    if not box_ids:
+        return 0
+    session.execute(delete(OcrResult).where(OcrResult.bounding_box_id.in_(box_ids)))
+    session.execute(delete(BoundingBox).where(BoundingBox.id.in_(box_ids)))
+    session.commit()
+    return len(box_ids)
 
 def get_all_boat_passes(*, session: Session) -> List[BoatPass]:
     statement = select(BoatPass)
     session_boat_passes = session.exec(statement).all()
-    return session_boat_passes
+    return load_row_boxes(session=session, boat_passes=session_boat_passes)
+
+def boat_passes_page_statement(*, limit: int, cursor: tuple[datetime, int] | None = None, camera_id: int | None = None, since: datetime | None = None, until: datetime | None = None):
+    # Newest first, keyset on (timestamp, id) so deep pages cost the same as the first one.
+    # Nested boxes and OCR results are read from the detections column or loaded by load_row_boxes.
+    statement = select(BoatPass)
+    if cursor is not None:
+        statement = statement.where(tuple_(BoatPass.timestamp, BoatPass.id) < tuple_(*cursor))
+    if camera_id is not None:
+        statement = statement.where(BoatPass.camera_id == camera_id)
+    if since is not None:
+        statement = statement.where(BoatPass.timestamp >= since)
+    if until is not None:
+        statement = statement.where(BoatPass.timestamp < until)
+    return statement.order_by(BoatPass.timestamp.desc(), BoatPass.id.desc()).limit(limit)
+
+def get_boat_passes_page(*, session: Session, limit: int, cursor: tuple[datetime, int] | None = None, camera_id: int | None = None, since: datetime | None = None, until: datetime | None = None) -> List[BoatPass]:
+    statement = boat_passes_page_statement(limit=limit, cursor=cursor, camera_id=camera_id, since=since, until=until)
+    session_boat_passes = session.exec(statement).all()
+    return load_row_boxes(session=session, boat_passes=session_boat_passes)
+
+def iter_boat_passes(*, session: Session, since: datetime | None = None, until: datetime | None = None, with_boxes: bool = True, batch_size: int = 500) -> Iterator[BoatPass]:
+    """Boat passes in time order, fetched batch_size rows at a time through a server-side cursor."""
+    statement = select(BoatPass)
+    if not with_boxes:
+        statement = statement.options(defer(BoatPass.detections))
+    if since is not None:
+        statement = statement.where(BoatPass.timestamp >= since)
+    if until is not None:
+        statement = statement.where(BoatPass.timestamp < until)
+    statement = statement.order_by(BoatPass.timestamp, BoatPass.id).execution_options(yield_per=batch_size)
+    # The identity map only holds weak references, rows of a sent batch are freed once the caller drops them
+    for partition in session.exec(statement).partitions():
+        if with_boxes:
+            # Per fetched batch, so nested rows are never loaded for the whole range at once
+            load_row_boxes(session=session, boat_passes=partition)
+        yield from partition
 
 def get_bounding_boxes_by_boat_pass_id(*, session: Session, boat_pass_id: int) -> List[BoundingBox]:
     statement = select(BoundingBox).where(BoundingBox.boat_pass_id == boat_pass_id)
     session_boxes = session.exec(statement).all()
     return session_boxes
 
+def row_ocr_results_statement():
+    # Only passes still in the row per box layout, rows left by compact-detections --keep-rows are in the detections too
+    return select(OcrResult).join(BoundingBox, OcrResult.bounding_box_id == BoundingBox.id).join(BoatPass, BoundingBox.boat_pass_id == BoatPass.id).where(BoatPass.detections == None)
+
 def get_all_ocr_results(*, session: Session) -> List[OcrResult]:
-    statement = select(OcrResult)
-    session_ocr = session.exec(statement).all()
+    session_ocr = session.exec(row_ocr_results_statement()).all()
+    # Compact detections carry ids from the same sequences, see allocate_ids
+    for detections in session.exec(select(BoatPass.detections).where(BoatPass.detections != None)):
+        session_ocr.extend(iter_ocr_results(detections))
     return session_ocr
 
 def get_ocr_results_by_bounding_box_id(*, session: Session, bounding_box_id: int) -> List[OcrResult]:
@@ -95,13 +286,149 @@ def get_states(*, session: Session) -> List[State]:
     session_states = session.exec(statement).all()
     return session_states
 
+def get_state_changes_horizon(*, session: Session) -> int:
+    """Cursor version for GET /states?since=, taken before the States are read."""
+    return session.execute(state_changes.horizon_statement(session.get_bind().dialect.name)).scalar_one()
+
+def get_states_changed(*, session: Session, limit: int, cursor: tuple[int, int] | None = None) -> tuple[List[State], tuple[int, int]]:
+    """States changed after the (change_version, id) cursor, oldest change first, and the cursor for the next call."""
+    horizon = get_state_changes_horizon(session=session)
+    rows = session.execute(state_changes.changes_statement(horizon=horizon, limit=limit, cursor=cursor)).all()
+    return [row[0] for row in rows], next_changes_cursor(rows, horizon, limit)
+
+def next_changes_cursor(rows: list, horizon: int, limit: int) -> tuple[int, int]:
+    # A full page may be followed by more changes below the horizon, otherwise the next call starts at the horizon
+    if len(rows) == limit:
+        state, version = rows[-1]
+        return version, state.id
+    return horizon, 0
+
+def iter_states(*, session: Session, since: datetime | None = None, until: datetime | None = None, batch_size: int = 500) -> Iterator[State]:
+    """States that arrived or departed in the range, ordered by id and fetched through a server-side cursor."""
+    statement = select(State)
+    arrived, departed = [], []
+    if since is not None:
+        arrived.append(State.arrival_time >= since)
+        departed.append(State.departure_time >= since)
+    if until is not None:
+        arrived.append(State.arrival_time < until)
+        departed.append(State.departure_time < until)
+    if arrived:
+        statement = statement.where(or_(and_(*arrived), and_(*departed)))
+    statement = statement.order_by(State.id).execution_options(yield_per=batch_size)
+    for partition in session.exec(statement).partitions():
+        yield from partition
+
 def create_state(*, session: Session, state: StateBase, first_boat_pass_id: int | None = None, last_boat_pass_id: int | None = None) -> State:
     state_db = State.model_validate(state, update={"first_boat_pass_id": first_boat_pass_id, "last_boat_pass_id": last_boat_pass_id})
+    mark_edited(state_db)
     session.add(state_db)
     session.commit()
     session.refresh(state_db)
+    state_changed(state_db)
     return state_db
 
+def open_states_statement():
+    # Oldest first, so the newest State wins when an identifier is open more than once
+    return select(State.id, State.best_detected_identifier).where(State.departure_time == None, State.arrival_time != None, State.weird_state == False, State.best_detected_identifier != None).order_by(State.arrival_time)
+
+def rebuild_state_index(*, session: Session) -> int:
+    state_engine.rebuild(session.exec(open_states_statement()).all())
+    logger.debug(f"Loaded {len(state_engine.open_states)} open states")
+    return len(state_engine.open_states)
+
+def rebuild_boat_pass_identifier_index(*, session: Session) -> int:
+    boat_pass_identifiers.clear()
+    statement = select(BoatPass.id, BoatPass.detected_identifier).where(BoatPass.detected_identifier != None)
+    for boat_pass_id, identifier in session.exec(statement):
+        boat_pass_identifiers.add(identifier, boat_pass_id)
+    logger.debug(f"Loaded {len(boat_pass_identifiers)} boat pass identifiers")
+    return len(boat_pass_identifiers)
+
+def open_state_by_identifier_statement(*, identifier: str):
+    return select(State).where(State.best_detected_identifier == identifier, State.departure_time == None, State.arrival_time != None, State.weird_state == False).order_by(State.arrival_time.desc())
+
+def is_open(state: State | None) -> bool:
+    return state is not None and state.departure_time is None and state.arrival_time is not None and not state.weird_state
+
+def find_open_state(*, session: Session, identifier: str | None, fuzzy: bool = False) -> State | None:
+    # The index only learns about a change after its commit, a State closed earlier in this transaction is skipped
+    state_id = state_engine.match(identifier)
+    if state_id is not None:
+        state = session.get(State, state_id)
+        if is_open(state):
+            return state
+    if not identifier:
+        return None
+    # Not in the index of this process, the arrival may have been handled by another worker or in this transaction
+    state = session.exec(open_state_by_identifier_statement(identifier=identifier)).first()
+    if state is None and fuzzy:
+        state_id = state_engine.closest(identifier)
+        state = session.get(State, state_id) if state_id is not None else None
+        if not is_open(state):
+            return None
+        logger.debug(f"Matched identifier {identifier} to open state {state.id} ({state.best_detected_identifier})")
+    return state
+
+def link_boat_passes(*, session: Session, boat_passes: List[BoatPass]) -> List[State]:
+    """Creates or closes the States of flushed boat passes, oldest first, without committing.
+
+    Returns the changed States, they go to state_changed once the transaction is committed.
+    """
+    changed: dict[int, State] = {}
+    for boat_pass in sorted(boat_passes, key=lambda boat_pass: boat_pass.timestamp):
+        for state in link_boat_pass(session=session, boat_pass=boat_pass):
+            changed[id(state)] = state
+    return list(changed.values())
+
+def link_boat_pass(*, session: Session, boat_pass: BoatPass) -> List[State]:
+    """Creates or closes the State of a boat pass, depending on which way its camera looks, returns the changed States."""
+    direction = state_engine.direction(boat_pass.camera_id)
+    if direction is None:
+        return []
+
+    changed = []
+    # Only departures are matched approximately, a near miss on arrival would flag a different boat as weird
+    open_state = find_open_state(session=session, identifier=boat_pass.detected_identifier, fuzzy=direction == "departure") if boat_pass.detected_identifier else None
+    if direction == "arrival":
+        if open_state is not None:
+            # Arrived again without a recorded departure
+            open_state.weird_state = True
+            changed.append(open_state)
+        state = State(
+            arrival_time=boat_pass.timestamp,
+            best_detected_identifier=boat_pass.detected_identifier,
+            best_detected_boat_length=boat_pass.boat_length,
+            state_of_boat=StateOfBoatEnum.kotvi,
+            first_boat_pass_id=boat_pass.id,
+        )
+    elif open_state is None:
+        # Departure without a recorded arrival
+        state = State(
+            departure_time=boat_pass.timestamp,
+            best_detected_identifier=boat_pass.detected_identifier,
+            best_detected_boat_length=boat_pass.boat_length,
+            first_boat_pass_id=boat_pass.id,
+            last_boat_pass_id=boat_pass.id,
+            weird_state=True,
+        )
+    else:
+        state = open_state
+        state.departure_time = boat_pass.timestamp
+        state.last_boat_pass_id = boat_pass.id
+        state.time_in_marina = state_engine.time_in_marina(state.arrival_time, boat_pass.timestamp)
+        state.state_of_boat = state_engine.state_of_boat(state.time_in_marina)
+        state.weird_state = state.weird_state or state.time_in_marina < 0
+        if state.best_detected_boat_length is None:
+            state.best_detected_boat_length = boat_pass.boat_length
+
+    changed.append(state)
+    for changed_state in changed:
+        mark_edited(changed_state)
+    session.add_all(changed)
+    logger.debug(f"Linked boat pass {boat_pass.id} ({direction})")
+    return changed
+
 def get_state_by_id(*, session: Session, state_id: int) -> State | None:
     statement = select(State).where(State.id == state_id)
     session_state = session.exec(statement).first()
@@ -110,61 +437,97 @@ def get_state_by_id(*, session: Session, state_id: int) -> State | None:
 def update_state_payment(*, session: Session, update_state: StateUpdate) -> State:
     state = get_state_by_id(session=session, state_id=update_state.id)
     state.payment_status = update_state.payment_status
+    mark_edited(state)
     session.add(state)
     session.commit()
     session.refresh(state)
+    state_changed(state)
     return state
 
 def update_state_best_detected_identifier(*, session: Session, update_state: StateUpdate) -> State:
     state = get_state_by_id(session=session, state_id=update_state.id)
     state.best_detected_identifier = update_state.best_detected_identifier
+    mark_edited(state)
     session.add(state)
     session.commit()
     session.refresh(state)
+    state_changed(state)
     return state
 
 def update_state_raw(*, session: Session, original_state: State, updated_state: State) -> State:
     state_data = updated_state.model_dump(exclude_unset=True)
     original_state.sqlmodel_update(state_data)
+    mark_edited(original_state)
     session.add(original_state)
     session.commit()
     session.refresh(original_state)
+    state_changed(original_state)
     return original_state
 
 def update_state(*, session: Session, updated_state: State) -> State:
     original_state = get_state_by_id(session=session, state_id=updated_state.id)
     return update_state_raw(session=session, original_state=original_state, updated_state=updated_state)
 
-def get_dashboard_data(*, session: Session) -> DashboardData:
-    statement_today_arrived = select(func.count(State.id)).where(State.arrival_time + timedelta(days=1) > datetime.now(UTC))
-    count_of_today_arrived = session.exec(statement_today_arrived).one()
-    statement_today_arrived_undetected_identifier = select(func.count(State.id)).where(State.arrival_time + timedelta(days=1) > datetime.now(UTC)).where(column("best_detected_identifier").contains('?'))
-    count_of_today_arrived_undetected_identifier = session.exec(statement_today_arrived_undetected_identifier).one()
-
-    statement_today_departed = select(func.count(State.id)).where(State.departure_time + timedelta(days=1) > datetime.now(UTC))
-    count_of_today_departed = session.exec(statement_today_departed).one()
-    statement_today_departed_undetected_identifier= select(func.count(State.id)).where(State.departure_time + timedelta(days=1) > datetime.now(UTC)).where(column("best_detected_identifier").contains('?'))
-    count_of_today_departed_undetected_identifier = session.exec(statement_today_departed_undetected_identifier).one()
-
-    statement_today_in_marina = select(func.count(State.id)).where(State.arrival_time + timedelta(days=1) > datetime.now(UTC)).where(State.departure_time == None)
-    count_of_today_in_marina = session.exec(statement_today_in_marina).one()
-    statement_today_in_marina_undetected_identifier= select(func.count(State.id)).where(State.arrival_time + timedelta(days=1) > datetime.now(UTC)).where(State.departure_time == None).where(column("best_detected_identifier").contains('?'))
-    count_of_today_in_marina_undetected_identifier = session.exec(statement_today_in_marina_undetected_identifier).one()
-
-    statement_today_payed = select(func.count(State.id)).where(State.arrival_time + timedelta(days=1) > datetime.now(UTC)).where(State.payment_status == PaymentStatusEnum.zaplaceno)
-    count_of_today_payed = session.exec(statement_today_payed).one()
-
-    statement_today_nonpayed = select(func.count(State.id)).where(State.arrival_time + timedelta(days=1) > datetime.now(UTC)).where(State.payment_status == PaymentStatusEnum.nezaplaceno)
-    count_of_today_nonpayed = session.exec(statement_today_nonpayed).one()
+def dashboard_statement(*, since: datetime):
+    # One pass over the States of the window, every counter is a filtered aggregate over index friendly predicates
+    arrived = State.arrival_time > since
+    departed = State.departure_time > since
+    in_marina = and_(arrived, State.departure_time == None)
+    undetected = State.best_detected_identifier.contains('?')
+    return select(
+        func.count(State.id).filter(arrived),
+        func.count(State.id).filter(departed),
+        func.count(State.id).filter(in_marina),
+        func.count(State.id).filter(and_(arrived, undetected)),
+        func.count(State.id).filter(and_(departed, undetected)),
+        func.count(State.id).filter(and_(in_marina, undetected)),
+        func.count(State.id).filter(and_(arrived, State.payment_status == PaymentStatusEnum.zaplaceno)),
+        func.count(State.id).filter(and_(arrived, State.payment_status == PaymentStatusEnum.nezaplaceno)),
+    ).where(or_(arrived, departed))
+
+def dashboard_data_from_row(row) -> DashboardData:
     return DashboardData(
-        today_arrived=count_of_today_arrived, 
-        today_departed=count_of_today_departed, 
-        today_in_marina=count_of_today_in_marina, 
-        today_payed=count_of_today_payed, 
-        today_not_payed=count_of_today_nonpayed,
-        today_arrived_undetected_identifier=count_of_today_arrived_undetected_identifier,
-        today_departed_undetected_identifier=count_of_today_departed_undetected_identifier,
-        today_in_marina_undetected_identifier=count_of_today_in_marina_undetected_identifier
+        today_arrived=row[0],
+        today_departed=row[1],
+        today_in_marina=row[2],
+        today_arrived_undetected_identifier=row[3],
+        today_departed_undetected_identifier=row[4],
+        today_in_marina_undetected_identifier=row[5],
+        today_payed=row[6],
+        today_not_payed=row[7],
         )
 
-    
+def dashboard_states_statement(*, since: datetime):
+    return select(State).where(or_(State.arrival_time > since, State.departure_time > since))
+
+def count_dashboard_data(*, session: Session) -> DashboardData:
+    statement = dashboard_statement(since=datetime.now(UTC) - dashboard_cache.window)
+    return dashboard_data_from_row(session.exec(statement).one())
+
+def rebuild_dashboard_cache(*, session: Session) -> DashboardData:
+    since = dashboard_cache.begin_rebuild()
+    dashboard_cache.finish_rebuild(session.exec(dashboard_states_statement(since=since)).all())
+    return dashboard_cache.get()
+
+def get_dashboard_data(*, session: Session) -> DashboardData:
+    if not dashboard_cache.enabled:
+        return count_dashboard_data(session=session)
+    if not dashboard_cache.is_valid():
+        return rebuild_dashboard_cache(session=session)
+    return dashboard_cache.get()
+
+def occupancy_range(*, since: datetime, until: datetime | None, bucket: occupancy.Bucket, zone: tzinfo) -> tuple[datetime, datetime]:
+    """Naive UTC bounds of an occupancy query, since moved back to the start of its hour or day."""
+    until = datetime.now(UTC) if until is None else until
+    return occupancy.bucket_start(since, bucket, zone), as_utc(until).astimezone(UTC).replace(tzinfo=None)
+
+def get_occupancy(*, session: Session, since: datetime, until: datetime | None, bucket: occupancy.Bucket, zone: tzinfo) -> List[OccupancyPublic]:
+    since, until = occupancy_range(since=since, until=until, bucket=bucket, zone=zone)
+    rows = session.exec(occupancy.range_statement(since=since, until=until)).all()
+    return occupancy.periods(rows, since, until, bucket, zone)
+
+def rebuild_occupancy(*, session: Session) -> int:
+    """Recomputes the hourly occupancy rollup from all States, returns the number of hours."""
+    hours = occupancy.rebuild(session.connection())
+    session.commit()
+    return hours
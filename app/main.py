@@ -1,31 +1,63 @@
+import asyncio
+import contextlib
 import logging
 import os
 from app.models import WebsocketImageData
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 from contextlib import asynccontextmanager
 from app.core.app_config import app_config
 from app.core.app_logger import AppLogger
 from app.core.connection_manager import ConnectionManager
+from app.core.metrics import MetricsMiddleware, metrics
 from app.core.db import init_db, engine
+from app.core.images import thumbnails
+from app.core.state_events import state_events
 from app.routers.boats import boat_router
 from app.routers.login import login_router
-from app.routers.deps import ConnectionManagerDep, get_current_user, SessionDep, TokenDep
+from app.routers.deps import ConnectionManagerDep, PreviewCacheDep, backplane, get_current_user, ingest_spool, open_db, preview_cache, TokenDep
 from fastapi.encoders import jsonable_encoder
+from sqlalchemy import exc
+from sqlmodel import Session
+from app import crud
 
 logger = AppLogger(__name__, logging._nameToLevel[app_config.LOG_LEVEL]).get_logger()
 
+def rebuild_indexes() -> None:
+    with Session(engine) as session:
+        crud.rebuild_state_index(session=session)
+        crud.rebuild_boat_pass_identifier_index(session=session)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.debug('Starting app')
+    await asyncio.to_thread(rebuild_indexes)
+    await asyncio.to_thread(preview_cache.load)
+    preview_persister = asyncio.create_task(preview_cache.run_persister())
+    await backplane.start()
+    state_events.bind(asyncio.get_running_loop())
+    if ingest_spool is not None:
+        # Replays what earlier runs left in the spool before draining new passes
+        ingest_spool.open()
+        await ingest_spool.start(engine)
     yield
+    if ingest_spool is not None:
+        await ingest_spool.stop()
+    state_events.unbind()
+    await backplane.stop()
+    preview_persister.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await preview_persister
+    await preview_cache.persist()
+    thumbnails.shutdown()
     logger.debug('Shuting down app')
 
 init_db(app_config.INIT_DB)
 
 # app = FastAPI()
 
-app = FastAPI(docs_url='/api/v1/docs', redoc_url='/api/v1/redoc', openapi_url='/api/v1/openapi.json')
+app = FastAPI(lifespan=lifespan, docs_url='/api/v1/docs', redoc_url='/api/v1/redoc', openapi_url='/api/v1/openapi.json')
 
 origins = [
     "http://localhost",
@@ -42,11 +74,22 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
+if app_config.METRICS_ENABLED:
+    # Outermost, so the timings include the CORS handling
+    app.add_middleware(MetricsMiddleware)
+
 app.include_router(boat_router)
 app.include_router(login_router)
 
+@app.exception_handler(exc.TimeoutError)
+async def pool_timeout_handler(request, e: exc.TimeoutError):
+    # Every pooled connection stayed busy for DB_POOL_TIMEOUT, the client should back off instead of seeing a 500
+    logger.warning(f"Database pool exhausted: {e}")
+    return JSONResponse({"detail": "Database busy, try again later"}, status_code=503, headers={"Retry-After": "1"})
+
 @app.get("/")
 def read_root():
     return {"Message": "REST API is running!"}
@@ -55,9 +98,14 @@ def read_root():
 def health_check():
     return {"Status": "Healthy"}
 
-# TODO: Send cached data to the client
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def read_metrics():
+    if not app_config.METRICS_ENABLED:
+        raise HTTPException(status_code=404)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket, session: SessionDep, manager: ConnectionManagerDep):
+async def websocket_endpoint(websocket: WebSocket, manager: ConnectionManagerDep, previews: PreviewCacheDep):
     await manager.connect(websocket)
     try:
         while True:
@@ -65,16 +113,13 @@ async def websocket_endpoint(websocket: WebSocket, session: SessionDep, manager:
             if data['type'] == 'authorization':
                 token_d = TokenDep(data['token'])[7:]
                 try:
-                    user = get_current_user(session=session, token=token_d)
-                    for i, x in enumerate([app_config.WS_CAM_PREVIEW_1, app_config.WS_CAM_PREVIEW_2]):
-                        img_path = os.path.join(app_config.DATA_FOLDER, x)
-
-                        if not os.path.exists(img_path):
-                            continue
-
-                        with open(img_path, "r") as img_file:
-                            img_data = img_file.read()
-                        await manager.broadcast(jsonable_encoder(WebsocketImageData(camera_id=i+1, image=img_data)))
+                    async with open_db() as session:
+                        user = await get_current_user(session=session, token=token_d)
+                    manager.set_binary(websocket, data.get('format') == 'binary')
+                    manager.set_low_resolution(websocket, data.get('resolution') == 'low')
+                    manager.set_authorized(websocket)
+                    for frame in previews.values():
+                        await manager.send_frame(frame, websocket)
                 except HTTPException as e:
                     await websocket.send_json({'type': 'error', 'message': str(e.detail)})
                     raise WebSocketDisconnect()
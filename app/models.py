@@ -1,5 +1,6 @@
 from datetime import datetime
 from enum import Enum
+from sqlalchemy import BigInteger, Column, Index, LargeBinary
 from sqlmodel import Field, SQLModel, Relationship
 from typing import Optional, List
 
@@ -36,11 +37,11 @@ class User(UserBase, table=True):
     hashed_password: str
 
 class StateBase(SQLModel):
-    arrival_time: datetime | None = None
-    departure_time: datetime | None = None
-    best_detected_identifier: str | None = None
+    arrival_time: datetime | None = Field(default=None, index=True)
+    departure_time: datetime | None = Field(default=None, index=True)
+    best_detected_identifier: str | None = Field(default=None, index=True)
     best_detected_boat_length: BoatLengthEnum | None = None
-    payment_status: PaymentStatusEnum = PaymentStatusEnum.nezaplaceno
+    payment_status: PaymentStatusEnum = Field(default=PaymentStatusEnum.nezaplaceno, index=True)
     time_in_marina: int | None = None
     state_of_boat : StateOfBoatEnum = StateOfBoatEnum.prujezd
     added_manually: bool = False
@@ -48,9 +49,14 @@ class StateBase(SQLModel):
     edit_timestamp: datetime | None = None
 
 class State(StateBase, table=True):
+    # GET /states?since= pages through (change_version, id), see app.core.state_changes
+    __table_args__ = (Index("ix_state_change_version_id", "change_version", "id"),)
     id: int | None = Field(default=None, primary_key=True)
-    first_boat_pass_id: int | None = Field(default=None, foreign_key="boatpass.id")
+    first_boat_pass_id: int | None = Field(default=None, foreign_key="boatpass.id", index=True)
     last_boat_pass_id: int | None = Field(default=None)
+    # Set by a trigger on every write and left out of the API output. A loaded State keeps the value it was read or
+    # created with, the change queries select the column itself.
+    change_version: int = Field(default=0, sa_column=Column(BigInteger, nullable=False, server_default="0"), exclude=True)
     # first_boat_pass = Relationship(sa_relationship_kwargs={ 'foreign_keys': [first_boat_pass_id] })
     # last_boat_pass = Relationship(sa_relationship_kwargs={ 'foreign_keys': [last_boat_pass_id] })
     boat_passes: list["BoatPass"] = Relationship(back_populates="state", sa_relationship_kwargs={ 'foreign_keys': "[State.first_boat_pass_id]" })
@@ -60,11 +66,15 @@ class BoatPassBase(SQLModel):
     timestamp: datetime
     image_filename: str
     raw_text: str | None = None
-    detected_identifier: str | None = None
+    detected_identifier: str | None = Field(default=None, index=True)
     boat_length: BoatLengthEnum | None = None
 
 class BoatPass(BoatPassBase, table=True):
+    # Serves time ranges and the (timestamp, id) keyset pagination
+    __table_args__ = (Index("ix_boatpass_timestamp_id", "timestamp", "id"),)
     id: int | None = Field(default=None, primary_key=True)
+    # Boxes and OCR results in the compact layout of app.core.detections, None for passes stored as BoundingBox rows
+    detections: bytes | None = Field(default=None, sa_column=Column(LargeBinary))
     state: State | None = Relationship(back_populates="boat_passes")
     bounding_boxes: list["BoundingBox"] = Relationship(back_populates="boat_pass")
 
@@ -78,7 +88,7 @@ class BoundingBoxBase(SQLModel):
 
 class BoundingBox(BoundingBoxBase, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    boat_pass_id: int = Field(foreign_key="boatpass.id")
+    boat_pass_id: int = Field(foreign_key="boatpass.id", index=True)
     boat_pass: BoatPass = Relationship(back_populates="bounding_boxes")
     ocr_results: list["OcrResult"] = Relationship(back_populates="bounding_box")
 
@@ -92,13 +102,35 @@ class OcrResultBase(SQLModel):
 
 class OcrResult(OcrResultBase, table=True):
     id: int | None = Field(default=None, primary_key=True)
-    bounding_box_id: int = Field(foreign_key="boundingbox.id")
+    bounding_box_id: int = Field(foreign_key="boundingbox.id", index=True)
     bounding_box: BoundingBox = Relationship(back_populates="ocr_results")
 
 class DbInitState(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
     state: bool = False
 
+class BackplaneMessage(SQLModel, table=True):
+    # Payloads too large for a Postgres NOTIFY, see app.core.backplane
+    id: int | None = Field(default=None, primary_key=True)
+    kind: str
+    payload: bytes
+    created_at: datetime = Field(index=True)
+
+class SpoolCheckpoint(SQLModel, table=True):
+    # Offset up to which a spool segment is in the database, committed with the boat passes, see app.core.spool
+    segment: str = Field(primary_key=True)
+    offset: int
+
+class IdAllocation(SQLModel, table=True):
+    # Highest id of a table handed out to compact detections on SQLite, which has no sequences, see app.crud.allocate_ids
+    name: str = Field(primary_key=True)
+    last_id: int
+
+class SchemaVersion(SQLModel, table=True):
+    version: int = Field(primary_key=True)
+    description: str
+    applied_at: datetime
+
 class Token(SQLModel):
     access_token: str
     token_type: str = "bearer"
@@ -144,6 +176,32 @@ class DashboardData(SQLModel):
     today_payed:int
     today_not_payed:int
 
+class OccupancyCounts(SQLModel):
+    arrived: int = 0
+    departed: int = 0
+    arrived_undetected_identifier: int = 0
+    departed_undetected_identifier: int = 0
+    payed: int = 0
+    not_payed: int = 0
+
+class OccupancyHour(OccupancyCounts, table=True):
+    # Rollup of the States per UTC hour kept by app.core.occupancy, payment counts belong to the hour of the arrival
+    hour: datetime = Field(primary_key=True)
+    # Boats that arrived minus boats that left in the hour, the running sum is the occupancy
+    occupancy_change: int = 0
+
+class OccupancyPublic(OccupancyCounts):
+    start: datetime
+    undetected_identifier_rate: float
+    # Boats in the marina at the end of the period and the most at the end of any of its hours
+    occupancy: int
+    peak_occupancy: int
+
+class IdentifierMatchPublic(SQLModel):
+    identifier: str
+    distance: int
+    ids: list[int]
+
 class ImageModel(SQLModel):
     camera_id: int
     image: str
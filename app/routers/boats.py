@@ -2,15 +2,41 @@ import os
 import io
 import logging
 import base64
-from typing import Any, List
-from fastapi import FastAPI, HTTPException, APIRouter, Request, Depends
+import binascii
+import mimetypes
+from datetime import datetime, timedelta, UTC
+from typing import Annotated, Any, BinaryIO, List, Literal
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from fastapi import FastAPI, HTTPException, APIRouter, Request, Depends, Form, Query, Response, UploadFile
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
+from starlette.datastructures import UploadFile as StarletteUploadFile
 from fastapi.encoders import jsonable_encoder
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from app.core.app_logger import AppLogger
 from app.core.app_config import app_config
-from app.models import DashboardData, ImageModel, OcrResult, State, StateBase, StateUpdate, User, BoatPass, BoatPassCreate, BoatPassPublic, OcrResultPublic, PaymentStatusEnum, BoatLengthEnum, StateOfBoatEnum, ImagePayload, WebsocketImageData
+from app.core.cursor import decode_change_cursor, decode_cursor, encode_change_cursor, encode_cursor
+from app.core.dashboard_cache import as_utc
+from app.core.db import pool_stats
+from app.core.metrics import image_bytes, preview_bytes_saved, preview_frames_dropped
+from app.core.export import ExportFormat, MEDIA_TYPES, csv_chunks, ndjson_chunks
+from app.core.identifier_index import boat_pass_identifiers
+from app.core.images import file_response, thumbnails
+from app.core import occupancy
+from app.core.serialization import JSONBytesResponse, boat_pass_public_json, ocr_result_json, state_json
+from app.core.state_engine import state_engine
+from app.core.preview_cache import PreviewCache, PreviewFrame
+from app.core.preview_filter import PreviewFilter
+from app.core.backplane import Backplane
+from app.core.connection_manager import ConnectionManager
+from app.core.spool import SpoolFull
+from app.core.storage import StagedFile, image_path
+from app.core.user_cache import user_cache
+from app.models import DashboardData, IdentifierMatchPublic, ImageModel, OccupancyPublic, OcrResult, State, StateBase, BoatPassBase, StateUpdate, User, BoatPass, BoatPassCreate, BoatPassPublic, OcrResultPublic, PaymentStatusEnum, BoatLengthEnum, StateOfBoatEnum, ImagePayload, WebsocketImageData
 from app import crud
-from app.routers.deps import ConnectionManagerDep, SessionDep, TokenDep, CurrentUser, get_current_active_user
+from app.routers.deps import BackplaneDep, ConnectionManagerDep, PreviewCacheDep, PreviewFilterDep, SessionDep, TokenDep, CurrentUser, ingest_spool, iter_crud, run_crud, get_current_active_user
 
 logger = AppLogger(__name__, logging._nameToLevel[app_config.LOG_LEVEL]).get_logger()
 boat_router = APIRouter(
@@ -20,76 +46,274 @@ boat_router = APIRouter(
 )
 
 @boat_router.get("/boat-passes", dependencies=[Depends(get_current_active_user)], response_model=list[BoatPassPublic])
-async def read_boat_passes(session: SessionDep) -> list[BoatPassPublic]:
-    res_db = crud.get_all_boat_passes(session=session)
-    return res_db
+async def read_boat_passes(session: SessionDep, limit: Annotated[int, Query(ge=1, le=1000)] = 100, cursor: str | None = None, camera_id: int | None = None, since: datetime | None = None, until: datetime | None = None) -> list[BoatPassPublic]:
+    """Newest passes first, the cursor of the next page is returned in the X-Next-Cursor header."""
+    try:
+        cursor_key = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    res_db = await run_crud(session, crud.get_boat_passes_page, limit=limit + 1, cursor=cursor_key, camera_id=camera_id, since=since, until=until)
+    headers = {}
+    if len(res_db) > limit:
+        res_db = res_db[:limit]
+        headers["X-Next-Cursor"] = encode_cursor(res_db[-1].timestamp, res_db[-1].id)
+    # Encoded straight from the rows, response_model only documents the schema
+    return JSONBytesResponse(boat_pass_public_json.dump_json_list(res_db), headers=headers)
+
+def export_response(chunks, format: ExportFormat, name: str) -> StreamingResponse:
+    return StreamingResponse(chunks, media_type=MEDIA_TYPES[format], headers={"Content-Disposition": f'attachment; filename="{name}.{format}"'})
+
+def check_range(since: datetime | None, until: datetime | None) -> None:
+    if since is not None and until is not None and since >= until:
+        raise HTTPException(status_code=400, detail="since must be before until")
+
+@boat_router.get("/export/boat-passes", dependencies=[Depends(get_current_active_user)], response_class=StreamingResponse)
+async def export_boat_passes(format: ExportFormat = "ndjson", since: datetime | None = None, until: datetime | None = None) -> StreamingResponse:
+    """Streams boat passes in time order, NDJSON lines carry the nested boxes, CSV has the pass columns only."""
+    check_range(since, until)
+    rows = iter_crud(crud.iter_boat_passes, since=since, until=until, with_boxes=format == "ndjson", batch_size=app_config.EXPORT_BATCH_SIZE)
+    chunks = ndjson_chunks(rows, boat_pass_public_json) if format == "ndjson" else csv_chunks(rows, ["id", *BoatPassBase.model_fields])
+    return export_response(chunks, format, "boat-passes")
+
+@boat_router.get("/export/states", dependencies=[Depends(get_current_active_user)], response_class=StreamingResponse)
+async def export_states(format: ExportFormat = "ndjson", since: datetime | None = None, until: datetime | None = None) -> StreamingResponse:
+    """Streams States that arrived or departed within the range."""
+    check_range(since, until)
+    rows = iter_crud(crud.iter_states, since=since, until=until, batch_size=app_config.EXPORT_BATCH_SIZE)
+    chunks = ndjson_chunks(rows, state_json) if format == "ndjson" else csv_chunks(rows, list(state_json.fields))
+    return export_response(chunks, format, "states")
+
+@boat_router.get("/images/{filename}", dependencies=[Depends(get_current_active_user)], response_class=Response, responses={200: {"content": {"image/jpeg": {}}}, 206: {"description": "Partial content"}, 304: {"description": "Not modified"}})
+async def read_image(filename: str, request: Request, variant: Literal["full", "thumbnail"] = "full") -> Response:
+    """Stored image of a boat pass, variant=thumbnail for a downscaled copy. Answers conditional and range requests."""
+    try:
+        path = image_path(filename)
+        stat_result = await run_in_threadpool(os.stat, path)
+    except (ValueError, FileNotFoundError):
+        raise HTTPException(status_code=404, detail="Image not found")
+    media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    if variant == "thumbnail":
+        try:
+            thumbnail = await thumbnails.get(path, filename)
+        except Exception as e:
+            # Not an image Pillow can read, the original is still worth showing
+            logger.error(f"Error while creating the thumbnail of {filename}: {e!r}")
+            thumbnail = None
+        if thumbnail is not None:
+            path, media_type = thumbnail, "image/jpeg"
+            stat_result = await run_in_threadpool(os.stat, path)
+    try:
+        return file_response(path, stat_result, request.headers, media_type)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Image not found")
 
 @boat_router.get("/dashboard", dependencies=[Depends(get_current_active_user)], response_model=DashboardData)
 async def dashboard(session: SessionDep) -> DashboardData:
-    return crud.get_dashboard_data(session=session)
+    return await run_crud(session, crud.get_dashboard_data)
 
-@boat_router.post("/boat-pass",dependencies=[Depends(get_current_active_user)], response_model=BoatPassPublic)
+@boat_router.post("/dashboard/rebuild", dependencies=[Depends(get_current_active_user)], response_model=DashboardData)
+async def rebuild_dashboard(session: SessionDep) -> DashboardData:
+    """Drops the in-process dashboard counters and reloads them from the database."""
+    return await run_crud(session, crud.rebuild_dashboard_cache)
+
+@boat_router.get("/occupancy", dependencies=[Depends(get_current_active_user)], response_model=list[OccupancyPublic])
+async def read_occupancy(session: SessionDep, since: datetime, until: datetime | None = None, bucket: occupancy.Bucket = "hour", tz: str = "UTC") -> list[OccupancyPublic]:
+    """Arrivals, departures, payments, undetected identifiers and occupancy per hour or per day of tz, from the hourly rollup."""
+    try:
+        zone = ZoneInfo(tz)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise HTTPException(status_code=400, detail=f"Unknown time zone {tz}")
+    check_range(since, until)
+    span = as_utc(until or datetime.now(UTC)) - as_utc(since)
+    if span / (occupancy.HOUR if bucket == "hour" else timedelta(days=1)) > occupancy.MAX_PERIODS:
+        raise HTTPException(status_code=400, detail=f"At most {occupancy.MAX_PERIODS} periods, use a shorter range or bucket=day")
+    return await run_crud(session, crud.get_occupancy, since=since, until=until, bucket=bucket, zone=zone)
+
+SPOOLED_RESPONSE = {202: {"description": "Queued in the ingest spool, with API_INGEST_MODE=spool"}}
+
+@boat_router.post("/boat-pass",dependencies=[Depends(get_current_active_user)], response_model=BoatPassPublic, responses=SPOOLED_RESPONSE)
 async def create_boat_pass(session: SessionDep, boat_pass: BoatPassCreate, image_data: ImagePayload) -> BoatPassPublic:
-    res = crud.create_boat_pass(session=session, boat_pass=boat_pass)
-    image_path = os.path.join(app_config.DATA_FOLDER, res.image_filename)
+    if ingest_spool is not None:
+        try:
+            image = await run_in_threadpool(base64.b64decode, image_data.image, validate=True)
+        except (ValueError, binascii.Error):
+            raise HTTPException(status_code=422, detail="Invalid base64 image")
+        return await spool_boat_pass(boat_pass, image)
+    staged = stage_image(boat_pass.image_filename)
     try:
-        # logger.debug(f"Saving image: {image_data.image}")
-        img_data = base64.b64decode(image_data.image)
-        with open(image_path, "wb") as new_file:
-            new_file.write(img_data)
-    except Exception as e:
+        await run_in_threadpool(staged.write_base64, image_data.image)
+    except (ValueError, binascii.Error) as e:
+        await run_in_threadpool(staged.discard)
         logger.error(f"Error while saving image: {e}")
         logger.error(f"Image data: {image_data.image[:20]}, ..., {image_data.image[-20:]}")
+        raise HTTPException(status_code=422, detail="Invalid base64 image")
+    return JSONBytesResponse(boat_pass_public_json.dump_json(await store_boat_pass(session, boat_pass, staged)))
+
+@boat_router.post("/boat-pass/upload", dependencies=[Depends(get_current_active_user)], response_model=BoatPassPublic, responses=SPOOLED_RESPONSE)
+async def upload_boat_pass(session: SessionDep, boat_pass: Annotated[str, Form(description="BoatPassCreate as JSON")], image: UploadFile) -> BoatPassPublic:
+    """Multipart variant of /boat-pass, the image is streamed to disk in chunks instead of being sent as base64."""
+    try:
+        boat_pass_create = BoatPassCreate.model_validate_json(boat_pass)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False))
+    if ingest_spool is not None:
+        return await spool_boat_pass(boat_pass_create, image.file)
+    staged = stage_image(boat_pass_create.image_filename)
+    try:
+        await run_in_threadpool(staged.write_stream, image.file)
+    except Exception:
+        await run_in_threadpool(staged.discard)
+        raise
+    return JSONBytesResponse(boat_pass_public_json.dump_json(await store_boat_pass(session, boat_pass_create, staged)))
+
+def stage_image(filename: str) -> StagedFile:
+    try:
+        return StagedFile(image_path(filename))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+async def spool_boat_pass(boat_pass: BoatPassCreate, image: bytes | BinaryIO) -> JSONResponse:
+    # Answered once the pass is durable in the spool, the background drain stores the image and the row
+    stage_image(boat_pass.image_filename)
+    try:
+        size = await run_in_threadpool(ingest_spool.append, boat_pass, image)
+    except SpoolFull:
+        raise HTTPException(status_code=503, detail="Ingest spool is full", headers={"Retry-After": "5"})
+    image_bytes.inc(size, camera_id=boat_pass.camera_id, source="boat_pass")
+    return JSONResponse({"status": "queued", "image_filename": boat_pass.image_filename}, status_code=202)
+
+async def store_boat_pass(session: Session | AsyncSession, boat_pass: BoatPassCreate, staged: StagedFile) -> BoatPass:
+    # The image is renamed into place right before the commit, a failure on either side leaves neither the row nor the file behind
+    try:
+        res = await run_crud(session, crud.create_boat_pass, boat_pass=boat_pass, before_commit=staged.commit, link=True)
+    except FileExistsError:
+        await run_in_threadpool(staged.discard)
+        raise HTTPException(status_code=409, detail=f"Image {boat_pass.image_filename} already exists")
+    except Exception:
+        await run_in_threadpool(staged.discard)
+        raise
+    image_bytes.inc(staged.size, camera_id=boat_pass.camera_id, source="boat_pass")
+    thumbnails.submit(staged.final_path, boat_pass.image_filename)
     return res
 
+@boat_router.post("/boat-passes/batch", dependencies=[Depends(get_current_active_user)], response_model=list[BoatPassPublic])
+async def create_boat_passes(session: SessionDep, boat_passes: list[BoatPassCreate]) -> list[BoatPassPublic]:
+    res = await run_crud(session, crud.create_boat_passes, boat_passes=boat_passes, link=True)
+    return JSONBytesResponse(boat_pass_public_json.dump_json_list(res))
+
 # TODO: Just for debugging purposes, remove this endpoint
 @boat_router.post("/boat-pass-state", response_model=BoatPassPublic)
 async def create_boat_pass_state(session: SessionDep, boat_pass: BoatPassCreate) -> BoatPassPublic:
-    boat_pass_res = crud.create_boat_pass(session=session, boat_pass=boat_pass)
+    boat_pass_res = await run_crud(session, crud.create_boat_pass, boat_pass=boat_pass, link=True)
     logger.debug(f"Created pass: {boat_pass_res}")
-    state = StateBase(arrival_time=boat_pass_res.timestamp, 
-                      departure_time=boat_pass_res.timestamp, 
-                      best_detected_identifier=boat_pass_res.detected_identifier, 
-                      best_detected_boat_length=boat_pass_res.boat_length, 
-                      payment_status=PaymentStatusEnum.nezaplaceno, 
-                      time_in_marina=15, 
-                      state_of_boat=StateOfBoatEnum.prujezd)
-    crud.create_state(session=session, state=state, first_boat_pass_id=boat_pass_res.id, last_boat_pass_id=None)
-    logger.debug(f"Created state: {state}")
-    
-    return boat_pass_res
+
+    return JSONBytesResponse(boat_pass_public_json.dump_json(boat_pass_res))
 
 @boat_router.post('/state', dependencies=[Depends(get_current_active_user)], response_model=State)
 async def create_state(session: SessionDep, state: StateBase) -> State:
     logger.debug(f"Creating state: {state}")
-    return crud.create_state(session=session, state=state)
+    return await run_crud(session, crud.create_state, state=state)
 
 @boat_router.put('/state', dependencies=[Depends(get_current_active_user)], response_model=State)
 async def update_state_full(session: SessionDep, update_stated: StateUpdate) -> State:
-    return crud.update_state(session=session, updated_state=update_stated)
+    return await run_crud(session, crud.update_state, updated_state=update_stated)
 
 @boat_router.patch('/state/payment', dependencies=[Depends(get_current_active_user)], response_model=State)
 async def update_state_payment(session: SessionDep, update_state: StateUpdate) -> State:
-    return crud.update_state_payment(session=session, update_state=update_state)
+    return await run_crud(session, crud.update_state_payment, update_state=update_state)
 
 @boat_router.patch('/state/identifier', dependencies=[Depends(get_current_active_user)], response_model=State)
 async def update_state_best_detected_identifier(session: SessionDep, update_state: StateUpdate) -> State:
-    return crud.update_state_best_detected_identifier(session=session, update_state=update_state)
+    return await run_crud(session, crud.update_state_best_detected_identifier, update_state=update_state)
 
 @boat_router.get("/ocr-results", dependencies=[Depends(get_current_active_user)], response_model=list[OcrResult])
 async def ocr_results(session: SessionDep) -> list[OcrResult]:
-    return crud.get_all_ocr_results(session=session)
+    return JSONBytesResponse(ocr_result_json.dump_json_list(await run_crud(session, crud.get_all_ocr_results)))
 
 @boat_router.get("/states", dependencies=[Depends(get_current_active_user)], response_model=list[State])
-async def get_all_states(session: SessionDep) -> list[State]:
-    return crud.get_states(session=session)
+async def get_all_states(session: SessionDep, since: str | None = None, limit: Annotated[int, Query(ge=1, le=5000)] = 1000) -> list[State]:
+    """All States newest first, or with since only the States changed after that cursor, oldest change first.
+
+    Both return the cursor for the next since call in the X-Next-Cursor header, a page of limit changes means there are more.
+    Changes are also pushed over /ws as {"type": "state"} messages.
+    """
+    try:
+        cursor_key = decode_change_cursor(since) if since else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if since is None:
+        # Taken first, changes below it are committed before the States are read
+        horizon = await run_crud(session, crud.get_state_changes_horizon)
+        res_db, next_cursor = await run_crud(session, crud.get_states), (horizon, 0)
+    else:
+        res_db, next_cursor = await run_crud(session, crud.get_states_changed, limit=limit, cursor=cursor_key)
+    return JSONBytesResponse(state_json.dump_json_list(res_db), headers={"X-Next-Cursor": encode_change_cursor(*next_cursor)})
+
+@boat_router.get("/identifiers/lookup", dependencies=[Depends(get_current_active_user)], response_model=list[IdentifierMatchPublic])
+async def lookup_identifier(q: Annotated[str, Query(min_length=1, max_length=32)], max_distance: Annotated[int, Query(ge=0, le=2)] = 1, limit: Annotated[int, Query(ge=1, le=100)] = 10, scope: Literal["states", "boat_passes"] = "states") -> list[IdentifierMatchPublic]:
+    # Closest identifiers to an OCR read, '?' matches any character. The states scope covers open States only.
+    index = state_engine.identifiers if scope == "states" else boat_pass_identifiers
+    return [IdentifierMatchPublic(identifier=match.identifier, distance=match.distance, ids=sorted(match.keys)) for match in index.search(q, max_distance=max_distance, limit=limit)]
 
 @boat_router.post("/preview", dependencies=[Depends(get_current_active_user)], response_model=Any)
-async def broadcast_preview(image: ImageModel, manager: ConnectionManagerDep) -> Any:
-    await manager.broadcast(jsonable_encoder(WebsocketImageData(camera_id=image.camera_id, image=image.image)))
-    img_path = os.path.join(app_config.DATA_FOLDER, app_config.WS_CAM_PREVIEW_1 if image.camera_id == 1 else app_config.WS_CAM_PREVIEW_2)
-    with open(img_path, "w") as new_file:
-        new_file.write(image.image)
+async def broadcast_preview(image: ImageModel, manager: ConnectionManagerDep, previews: PreviewCacheDep, backplane: BackplaneDep, preview_filter: PreviewFilterDep) -> Any:
+    # Decoded before the filter reads the bytes, the frame keeps both encodings
+    try:
+        data = await run_in_threadpool(base64.b64decode, image.image, validate=True)
+    except (ValueError, binascii.Error):
+        raise HTTPException(status_code=422, detail="Invalid base64 image")
+    if not data:
+        raise HTTPException(status_code=422, detail="Empty image")
+    dropped = await publish_preview(PreviewFrame(image.camera_id, data=data, image_b64=image.image), manager, previews, backplane, preview_filter)
 
     # await manager.broadcast({'data': 'here'})
-    return {"status": "ok"}
\ No newline at end of file
+    return {"status": "ok", "dropped": dropped}
+
+@boat_router.post("/preview/{camera_id}", dependencies=[Depends(get_current_active_user)], response_model=Any)
+async def broadcast_preview_raw(camera_id: int, request: Request, manager: ConnectionManagerDep, previews: PreviewCacheDep, backplane: BackplaneDep, preview_filter: PreviewFilterDep) -> Any:
+    """Raw JPEG preview, sent either as the request body (image/jpeg or application/octet-stream) or as the image field of a multipart form."""
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form(max_files=1)
+        upload = form.get("image")
+        if not isinstance(upload, StarletteUploadFile):
+            raise HTTPException(status_code=422, detail="Missing image file")
+        data = await upload.read(app_config.PREVIEW_MAX_BYTES + 1)
+    else:
+        data = bytearray()
+        async for chunk in request.stream():
+            data += chunk
+            if len(data) > app_config.PREVIEW_MAX_BYTES:
+                break
+        data = bytes(data)
+
+    if not data:
+        raise HTTPException(status_code=422, detail="Empty image")
+    if len(data) > app_config.PREVIEW_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Image too large")
+
+    dropped = await publish_preview(PreviewFrame(camera_id, data=data), manager, previews, backplane, preview_filter)
+    return {"status": "ok", "dropped": dropped}
+
+async def publish_preview(frame: PreviewFrame, manager: ConnectionManager, previews: PreviewCache, backplane: Backplane, preview_filter: PreviewFilter) -> str | None:
+    """Broadcasts a posted preview unless the filter drops it, returns the reason it was dropped."""
+    image_bytes.inc(frame.size, camera_id=frame.camera_id, source="preview")
+    dropped = await preview_filter.process(frame, manager.wants_low_resolution())
+    if dropped is not None:
+        preview_frames_dropped.inc(camera_id=frame.camera_id, reason=dropped)
+        preview_bytes_saved.inc(frame.size * manager.number_of_connections(), reason=dropped)
+        return dropped
+    previews.put(frame)
+    await manager.broadcast_frame(frame)
+    if backplane.enabled:
+        # Other workers get the binary message, it carries the camera id and the raw JPEG and supersedes the camera's last one
+        await backplane.publish("preview", frame.binary_message, key=str(frame.camera_id))
+    return None
+
+@boat_router.get("/stats", dependencies=[Depends(get_current_active_user)], response_model=dict[str, Any])
+async def stats(manager: ConnectionManagerDep, backplane: BackplaneDep, preview_filter: PreviewFilterDep) -> dict[str, Any]:
+    stats = {"websocket": manager.stats(), "user_cache": user_cache.stats(), "backplane": backplane.stats(), "db_pool": pool_stats(), "preview": preview_filter.stats()}
+    if ingest_spool is not None:
+        stats["spool"] = ingest_spool.stats()
+    return stats
@@ -1,16 +1,28 @@
-from collections.abc import Generator
-from typing import Annotated
+from collections.abc import AsyncGenerator, AsyncIterator, Callable, Generator, Iterator
+from contextlib import asynccontextmanager
+from typing import Annotated, Any, TypeVar
 from fastapi.security import OAuth2PasswordBearer
 from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 from fastapi import Depends, HTTPException, status
+from app.core.backplane import Backplane, create_backplane
 from app.core.connection_manager import ConnectionManager
-from app.core.db import engine
+from app.core.metrics import metrics
+from app.core.security import verify_password_async
+from app.core.preview_cache import PreviewCache, PreviewFrame
+from app.core.preview_filter import PreviewFilter
+from app.core.spool import IngestSpool
+from app.core.state_events import state_events
+from app.core.user_cache import user_cache
+from app.core.db import engine, async_engine, database_url
 from app.models import User, TokenPayload
 from app.core.app_config import app_config
 from jose import jwt, JWTError
 from pydantic import ValidationError
 import logging
+import os
 from app.core.app_logger import AppLogger
+from app import crud, async_crud
 
 logger = AppLogger(__name__, logging._nameToLevel[app_config.LOG_LEVEL]).get_logger()
 
@@ -20,25 +32,149 @@ oauth2_scheme = OAuth2PasswordBearer(
 
 connection_manager = ConnectionManager()
 
+preview_cache = PreviewCache(app_config.DATA_FOLDER, app_config.WS_CAM_PREVIEW_TEMPLATE, app_config.WS_CAM_PREVIEW_PERSIST_INTERVAL)
+
+preview_filter = PreviewFilter(app_config.PREVIEW_MAX_FPS, app_config.PREVIEW_CAMERA_MAX_FPS, app_config.PREVIEW_DEDUPE_DISTANCE, app_config.PREVIEW_LOW_SIZE, app_config.PREVIEW_LOW_QUALITY)
+
+metrics.callback("ws_connections", "Open WebSocket connections", lambda: connection_manager.stats()["connections"])
+metrics.callback("ws_queue_depth", "Messages waiting in WebSocket client queues", lambda: connection_manager.stats()["queue_depth"])
+metrics.callback("ws_messages_sent_total", "Messages written to WebSocket clients", lambda: connection_manager.stats()["sent_messages"], type="counter")
+metrics.callback("ws_frames_dropped_total", "Queued WebSocket messages replaced by a newer one or dropped from a full queue", lambda: connection_manager.stats()["dropped_frames"], type="counter")
+metrics.callback("ws_connections_evicted_total", "WebSocket clients disconnected after a failed or timed out send", lambda: connection_manager.stats()["evicted_connections"], type="counter")
+
+backplane = create_backplane(app_config.BROADCAST_BACKPLANE, database_url)
+
+# Only in the spool ingest mode, see app.core.spool
+ingest_spool = IngestSpool(
+    app_config.SPOOL_FOLDER or os.path.join(app_config.DATA_FOLDER, ".spool"),
+    app_config.SPOOL_BATCH_SIZE,
+    app_config.SPOOL_MAX_BYTES,
+    app_config.SPOOL_SEGMENT_BYTES,
+    app_config.SPOOL_RETRY_DELAY,
+    app_config.SPOOL_MAX_ATTEMPTS,
+) if app_config.INGEST_MODE == "spool" else None
+
+if ingest_spool is not None:
+    metrics.callback("spool_pending_bytes", "Bytes of boat passes in the spool not written to the database yet", lambda: ingest_spool.stats()["pending_bytes"])
+    metrics.callback("spool_lag_seconds", "Age of the oldest boat pass in the spool not written to the database yet", ingest_spool.lag)
+    metrics.callback("spool_records_appended_total", "Boat passes appended to the spool", lambda: ingest_spool.appended, type="counter")
+    metrics.callback("spool_records_drained_total", "Boat passes written from the spool to the database", lambda: ingest_spool.drained, type="counter")
+    metrics.callback("spool_drain_failures_total", "Failed attempts to write a spool batch to the database", lambda: ingest_spool.failures, type="counter")
+    metrics.callback("spool_records_rejected_total", "Spooled boat passes the database kept refusing, set aside in the rejected folder", lambda: ingest_spool.rejected, type="counter")
+
+async def receive_preview(payload: bytes) -> None:
+    # A preview published by another worker
+    frame = PreviewFrame.from_binary_message(payload)
+    if connection_manager.wants_low_resolution():
+        await preview_filter.add_low_variant(frame)
+    preview_cache.put(frame)
+    await connection_manager.broadcast_frame(frame)
+
+backplane.subscribe("preview", receive_preview)
+
+async def broadcast_state(state_id: int, message: str) -> None:
+    await connection_manager.broadcast_state(state_id, message)
+    if backplane.enabled:
+        await backplane.publish("state", f"{state_id}:{message}".encode())
+
+async def receive_state(payload: bytes) -> None:
+    # A State change committed by another worker
+    state_id, _, message = payload.decode().partition(":")
+    await connection_manager.broadcast_state(int(state_id), message)
+
+state_events.subscribe(broadcast_state)
+backplane.subscribe("state", receive_state)
+
 def get_connection_manager() -> ConnectionManager:
     return connection_manager
 
-def get_db() -> Generator[Session, None, None]:
-    with Session(engine) as session:
+def get_preview_cache() -> PreviewCache:
+    return preview_cache
+
+def get_backplane() -> Backplane:
+    return backplane
+
+def get_preview_filter() -> PreviewFilter:
+    return preview_filter
+
+T = TypeVar("T")
+
+def get_sync_db() -> Generator[Session, None, None]:
+    # Like the async sessions, objects stay loaded after a commit, so a response serialized from them needs no reloads
+    with Session(engine, expire_on_commit=False) as session:
+        yield session
+
+async def get_async_db() -> AsyncGenerator[AsyncSession, None]:
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
         yield session
 
-SessionDep = Annotated[Session, Depends(get_db)]
+get_db = get_async_db if app_config.DB_ASYNC else get_sync_db
+
+@asynccontextmanager
+async def open_db() -> AsyncIterator[Session | AsyncSession]:
+    """Short lived session outside of request dependencies, e.g. for a single WebSocket message."""
+    if app_config.DB_ASYNC:
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            yield session
+    else:
+        with Session(engine, expire_on_commit=False) as session:
+            yield session
+
+def iter_crud(func: Callable[..., Iterator[T]], /, **kwargs: Any) -> Iterator[T]:
+    """Runs a generator from app.crud in its own sync session, for streaming responses.
+
+    A streaming response is sent after the request dependencies are closed, so it cannot use SessionDep. Starlette
+    iterates sync generators in the threadpool, the session lives until the last row is sent.
+    """
+    with Session(engine) as session:
+        yield from func(session=session, **kwargs)
+
+async def run_crud(session: Session | AsyncSession, func: Callable[..., T], /, **kwargs: Any) -> T:
+    """Calls a function from app.crud, or its counterpart in app.async_crud.COUNTERPARTS when the session is async.
+
+    Functions without a native async counterpart run through AsyncSession.run_sync, so they never block the event loop.
+    """
+    if not isinstance(session, AsyncSession):
+        return func(session=session, **kwargs)
+    async_func = async_crud.COUNTERPARTS.get(func)
+    if async_func is not None:
+        return await async_func(session=session, **kwargs)
+    return await session.run_sync(lambda sync_session: func(session=sync_session, **kwargs))
+
+async def release_db(session: Session | AsyncSession) -> None:
+    """Returns the session's connection to the pool, loaded objects stay usable. Call it before slow non-database work."""
+    if isinstance(session, AsyncSession):
+        await session.close()
+    else:
+        session.close()
+
+async def authenticate(session: Session | AsyncSession, username: str, password: str) -> User | None:
+    """The user with these credentials. The connection goes back to the pool while bcrypt runs on the password workers."""
+    user = await run_crud(session, crud.get_user_by_username, username=username)
+    await release_db(session)
+    if user is None or not await verify_password_async(password, user.hashed_password):
+        return None
+    return user
+
+SessionDep = Annotated[Session | AsyncSession, Depends(get_db)]
 TokenDep = Annotated[str, Depends(oauth2_scheme)]
 ConnectionManagerDep = Annotated[ConnectionManager, Depends(get_connection_manager)]
+PreviewCacheDep = Annotated[PreviewCache, Depends(get_preview_cache)]
+BackplaneDep = Annotated[Backplane, Depends(get_backplane)]
+PreviewFilterDep = Annotated[PreviewFilter, Depends(get_preview_filter)]
 
-def get_current_user(session: SessionDep, token: TokenDep) -> User:
+async def get_current_user(session: SessionDep, token: TokenDep) -> User:
     try:
         payload = jwt.decode(token, app_config.JWT_SECRET, algorithms=[app_config.JWT_ALGORITHM])
         token_data = TokenPayload(**payload)
     except (JWTError, ValidationError):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Could not validate credentials")
     
-    user = session.get(User, token_data.sub)
+    user = user_cache.get(token_data.sub, token)
+    if user is None:
+        user = await run_crud(session, crud.get_user_by_id, user_id=token_data.sub)
+        if user:
+            user_cache.put(token_data.sub, token, user)
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     if not user.is_active:
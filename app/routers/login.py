@@ -10,7 +10,7 @@ from app.core.app_logger import AppLogger
 from app.core.app_config import app_config
 from app.core.security import create_access_token
 from app.models import User, Token, UserBase
-from app.routers.deps import SessionDep, TokenDep, CurrentUser
+from app.routers.deps import SessionDep, TokenDep, CurrentUser, authenticate
 import app.crud as crud
 
 logger = AppLogger(__name__, logging._nameToLevel[app_config.LOG_LEVEL]).get_logger()
@@ -22,10 +22,7 @@ login_router = APIRouter(
 
 @login_router.post("/login/access-token")
 async def login_access_token(session: SessionDep, form_data: Annotated[OAuth2PasswordRequestForm, Depends()]) -> Token:
-    user = crud.authenticate(
-        session=session, username=form_data.username, password=form_data.password
-    )
-
+    user = await authenticate(session, form_data.username, form_data.password)
     if not user:
         raise HTTPException(status_code=400, detail="Nesprávné uživatelské jméno nebo heslo")
     elif not user.is_active:
@@ -0,0 +1,79 @@
+import os
+import random
+import string
+import time
+from datetime import datetime, timedelta, UTC
+
+# The app reads its settings on import, benchmarks only need placeholders for the mandatory ones
+for key, value in {
+    "API_POSTGRES_SERVER": "localhost",
+    "API_POSTGRES_USER": "bench",
+    "API_POSTGRES_PASSWORD": "bench",
+    "API_INIT_DB_FILE": "init/init_db.json",
+    "API_DATA_FOLDER": "data",
+    "API_LOG_LEVEL": "WARNING",
+}.items():
+    os.environ.setdefault(key, value)
+
+from sqlalchemy import Engine
+from sqlmodel import SQLModel, create_engine
+from app.models import BoatPassCreate, BoundingBoxCreate, OcrResultBase
+
+def make_engine(db_url: str) -> Engine:
+    engine = create_engine(db_url, echo=False)
+    SQLModel.metadata.drop_all(engine)
+    SQLModel.metadata.create_all(engine)
+    return engine
+
+def random_identifier(rng: random.Random) -> str:
+    return "".join(rng.choices(string.ascii_uppercase + string.digits, k=rng.randint(5, 8)))
+
+def make_boat_pass(rng: random.Random, timestamp: datetime | None = None, boxes: int = 5, ocr_per_box: int = 4) -> BoatPassCreate:
+    identifier = random_identifier(rng)
+    timestamp = timestamp or datetime.now(UTC) - timedelta(seconds=rng.randint(0, 86400))
+    return BoatPassCreate(
+        camera_id=rng.choice([1, 2]),
+        timestamp=timestamp,
+        image_filename=f"{identifier}_{int(timestamp.timestamp())}.jpg",
+        raw_text=identifier,
+        detected_identifier=identifier,
+        bounding_boxes=[
+            BoundingBoxCreate(
+                left=rng.random(), top=rng.random(), right=rng.random(), bottom=rng.random(),
+                confidence=rng.random(), class_identifier=rng.randint(0, 3),
+                ocr_results=[
+                    OcrResultBase(left=rng.random(), top=rng.random(), right=rng.random(), bottom=rng.random(), text=random_identifier(rng), confidence=rng.random())
+                    for _ in range(ocr_per_box)
+                ],
+            )
+            for _ in range(boxes)
+        ],
+    )
+
+def rows_in(boat_pass: BoatPassCreate) -> int:
+    return 1 + sum(1 + len(box.ocr_results) for box in boat_pass.bounding_boxes)
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def latency_summary(values: list[float]) -> dict[str, float]:
+    # Seconds in, milliseconds out
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+        "max_ms": max(values, default=float("nan")) * 1000,
+    }
@@ -0,0 +1,94 @@
+"""Storage size and read latency of boat pass detections as BoundingBox/OcrResult rows and as the compact column.
+
+Seeds passes in the row per box layout, measures, moves them with crud.compact_row_boxes like
+python -m app.cli compact-detections does, then measures again. The /boat-passes output is checked to be the same
+before and after.
+
+Usage: python -m bench.detections [--db-url postgresql+psycopg://...] [--passes 10000] [--boxes 2] [--ocr-per-box 2]
+"""
+import argparse
+import random
+import statistics
+import time
+from sqlalchemy import Engine, text
+from sqlmodel import Session
+from bench.common import make_boat_pass, make_engine
+from app import crud
+from app.core.app_config import app_config
+from app.core.serialization import boat_pass_public_json
+
+TABLES = ("boatpass", "boundingbox", "ocrresult")
+
+def seed(engine: Engine, passes: int, boxes: int, ocr_per_box: int) -> None:
+    rng = random.Random(42)
+    app_config.DETECTIONS_STORAGE = "rows"
+    with Session(engine) as session:
+        for i in range(0, passes, 500):
+            crud.create_boat_passes(session=session, boat_passes=[make_boat_pass(rng, boxes=boxes, ocr_per_box=ocr_per_box) for _ in range(min(500, passes - i))])
+
+def vacuum(engine: Engine) -> None:
+    # Deleted rows only give their pages back after a vacuum
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        if engine.dialect.name == "postgresql":
+            for table in TABLES:
+                connection.execute(text(f"VACUUM FULL ANALYZE {table}"))
+        else:
+            connection.execute(text("VACUUM"))
+
+def table_bytes(engine: Engine) -> dict[str, int]:
+    """Bytes of each table with its indexes and, on Postgres, its TOAST table."""
+    with engine.connect() as connection:
+        if engine.dialect.name == "postgresql":
+            return {table: connection.execute(text("SELECT pg_total_relation_size(:table)"), {"table": table}).scalar() for table in TABLES}
+        rows = connection.execute(text("SELECT m.tbl_name, SUM(d.pgsize) FROM dbstat d JOIN sqlite_master m ON d.name = m.name GROUP BY m.tbl_name")).all()
+    sizes = dict(rows)
+    return {table: sizes.get(table, 0) for table in TABLES}
+
+def timed(func, repeat: int) -> tuple[float, object]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+def measure(engine: Engine, name: str, passes: int, repeat: int) -> bytes:
+    sizes = table_bytes(engine)
+    print(f"{name}: " + ", ".join(f"{table} {size / 1024 / 1024:.1f} MiB" for table, size in sizes.items()) + f", total {sum(sizes.values()) / 1024 / 1024:.1f} MiB")
+
+    def read(limit: int) -> bytes:
+        # A fresh session each time, nothing is served from the identity map
+        with Session(engine) as session:
+            return boat_pass_public_json.dump_json_list(crud.get_boat_passes_page(session=session, limit=limit))
+
+    for limit in (100, passes):
+        latency, body = timed(lambda: read(limit), repeat)
+        print(f"  read and encode {limit:>6} passes: {latency * 1000:8.1f} ms")
+    return body
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--db-url", default="sqlite:///bench_detections.sqlite")
+    parser.add_argument("--passes", type=int, default=10_000)
+    parser.add_argument("--boxes", type=int, default=2)
+    parser.add_argument("--ocr-per-box", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    engine = make_engine(args.db_url)
+    seed(engine, args.passes, args.boxes, args.ocr_per_box)
+    vacuum(engine)
+    before = measure(engine, f"rows ({args.passes} passes, {args.boxes} boxes and {args.boxes * args.ocr_per_box} OCR results each)", args.passes, args.repeat)
+
+    start = time.perf_counter()
+    with Session(engine) as session:
+        while crud.compact_row_boxes(session=session, batch_size=500):
+            pass
+    print(f"compacted in {time.perf_counter() - start:.1f} s")
+    vacuum(engine)
+    after = measure(engine, "compact", args.passes, args.repeat)
+    assert after == before, "/boat-passes output differs after compacting"
+    engine.dispose()
+
+if __name__ == "__main__":
+    main()
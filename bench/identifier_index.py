@@ -0,0 +1,56 @@
+"""Compares approximate identifier lookups through IdentifierIndex with a linear scan over all identifiers.
+
+Queries are indexed identifiers with one or two OCR errors: substituted, dropped or unreadable ('?') characters.
+
+Usage: python -m bench.identifier_index [--identifiers 30000] [--queries 1000] [--max-distance 1]
+"""
+import argparse
+import random
+import string
+from bench.common import Timer, latency_summary, random_identifier
+from app.core.identifier_index import IdentifierIndex, WILDCARD
+
+def misread(rng: random.Random, identifier: str, errors: int) -> str:
+    characters = list(identifier)
+    for _ in range(errors):
+        position = rng.randrange(len(characters))
+        kind = rng.choice(["substitute", "drop", "unreadable"])
+        if kind == "substitute":
+            characters[position] = rng.choice(string.ascii_uppercase + string.digits)
+        elif kind == "drop" and len(characters) > 3:
+            del characters[position]
+        else:
+            characters[position] = WILDCARD
+    return "".join(characters)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--identifiers", type=int, default=30000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--max-distance", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    identifiers = [random_identifier(rng) for _ in range(args.identifiers)]
+    index = IdentifierIndex()
+    with Timer() as build:
+        for key, identifier in enumerate(identifiers):
+            # A few stored reads are partial as well
+            index.add(misread(rng, identifier, 1) if rng.random() < 0.02 else identifier, key)
+    queries = [misread(rng, rng.choice(identifiers), rng.randint(1, args.max_distance)) for _ in range(args.queries)]
+
+    results = {}
+    print(f"{len(index)} identifiers indexed in {build.elapsed:.3f} s, {args.queries} queries, max distance {args.max_distance}")
+    for name, search in [("index", index.search), ("linear scan", index.linear_search)]:
+        latencies = []
+        results[name] = []
+        for query in queries:
+            with Timer() as timer:
+                results[name].append(search(query, max_distance=args.max_distance))
+            latencies.append(timer.elapsed)
+        summary = latency_summary(latencies)
+        print(f"{name:>12}: p50 {summary['p50_ms']:8.3f} ms  p95 {summary['p95_ms']:8.3f} ms  p99 {summary['p99_ms']:8.3f} ms")
+    assert results["index"] == results["linear scan"], "index and linear scan disagree"
+
+if __name__ == "__main__":
+    main()
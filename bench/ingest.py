@@ -0,0 +1,61 @@
+"""Compares boat pass ingest throughput of the per-row commit path with the single transaction and batch paths.
+
+Usage: python -m bench.ingest [--db-url postgresql+psycopg://...] [--passes 200] [--batch-size 20]
+"""
+import argparse
+import random
+from sqlmodel import Session
+from bench.common import Timer, make_boat_pass, make_engine, rows_in
+from app import crud
+from app.models import BoatPass, BoatPassCreate, BoundingBox, OcrResult
+
+def legacy_create_boat_pass(*, session: Session, boat_pass: BoatPassCreate) -> BoatPass:
+    # The original implementation, one commit and refresh per row
+    boat_pass_db = BoatPass.model_validate(boat_pass, update={"bounding_boxes": [], "state": None})
+    session.add(boat_pass_db)
+    session.commit()
+    session.refresh(boat_pass_db)
+    for box in boat_pass.bounding_boxes:
+        box_db = BoundingBox.model_validate(box, update={"ocr_results": [], "boat_pass_id": boat_pass_db.id})
+        session.add(box_db)
+        session.commit()
+        session.refresh(box_db)
+        for ocr in box.ocr_results:
+            ocr_db = OcrResult.model_validate(ocr, update={"bounding_box_id": box_db.id})
+            session.add(ocr_db)
+            session.commit()
+            session.refresh(ocr_db)
+    session.refresh(boat_pass_db)
+    return boat_pass_db
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--db-url", default="sqlite:///bench_ingest.sqlite")
+    parser.add_argument("--passes", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    payloads = [make_boat_pass(rng) for _ in range(args.passes)]
+    total_rows = sum(rows_in(p) for p in payloads)
+
+    def per_pass(create):
+        def run(session: Session):
+            for payload in payloads:
+                create(session=session, boat_pass=payload)
+        return run
+
+    def batched(session: Session):
+        for i in range(0, len(payloads), args.batch_size):
+            crud.create_boat_passes(session=session, boat_passes=payloads[i:i + args.batch_size])
+
+    print(f"{args.passes} passes, {total_rows} rows, {args.db_url}")
+    for name, run in [("legacy per-row commit", per_pass(legacy_create_boat_pass)), ("single transaction", per_pass(crud.create_boat_pass)), (f"batch of {args.batch_size}", batched)]:
+        engine = make_engine(args.db_url)
+        with Session(engine) as session, Timer() as timer:
+            run(session)
+        engine.dispose()
+        print(f"{name:>24}: {timer.elapsed:8.3f} s {total_rows / timer.elapsed:10.0f} rows/s")
+
+if __name__ == "__main__":
+    main()
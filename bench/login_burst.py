@@ -0,0 +1,83 @@
+"""Measures how much a burst of logins inflates the latency of concurrent /dashboard requests.
+
+The app runs in-process against SQLite, once with bcrypt on the event loop (API_PASSWORD_HASH_WORKERS=0, the previous
+behaviour) and once on the password worker pool. Requires httpx.
+
+Usage: python -m bench.login_burst [--logins 10] [--workers 2]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+def run_child(args: argparse.Namespace) -> None:
+    os.environ["API_DATABASE_URL"] = f"sqlite:///bench_login_{args.workers}.sqlite"
+    os.environ["API_INIT_DB"] = "True"
+    os.environ["API_PASSWORD_HASH_WORKERS"] = str(args.workers)
+    if os.path.exists(f"bench_login_{args.workers}.sqlite"):
+        os.remove(f"bench_login_{args.workers}.sqlite")
+
+    import asyncio
+    import time
+    import httpx
+    import bench.common  # noqa: F401, sets the mandatory settings
+    from bench.common import latency_summary
+    from app.main import app
+
+    credentials = {"username": "petrovadmin", "password": "Petrov.Admin.2024"}
+
+    async def scenario() -> dict:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+            token = (await client.post("/api/v1/login/access-token", data=credentials)).json()["access_token"]
+            headers = {"Authorization": f"Bearer {token}"}
+            latencies: list[float] = []
+            burst_done = asyncio.Event()
+
+            async def poll_dashboard():
+                while not burst_done.is_set():
+                    start = time.perf_counter()
+                    response = await client.get("/api/v1/dashboard", headers=headers)
+                    response.raise_for_status()
+                    latencies.append(time.perf_counter() - start)
+                    await asyncio.sleep(0.005)
+
+            pollers = [asyncio.create_task(poll_dashboard()) for _ in range(4)]
+            await asyncio.sleep(0.5)
+            baseline = len(latencies)
+            start = time.perf_counter()
+            responses = await asyncio.gather(*[client.post("/api/v1/login/access-token", data=credentials) for _ in range(args.logins)])
+            burst = time.perf_counter() - start
+            burst_done.set()
+            await asyncio.gather(*pollers)
+            assert all(r.status_code == 200 for r in responses)
+            return {
+                "workers": args.workers,
+                "logins_per_s": args.logins / burst,
+                "idle": latency_summary(latencies[:baseline]),
+                "during_burst": latency_summary(latencies[baseline:]),
+            }
+
+    print(json.dumps(asyncio.run(scenario())))
+    os.remove(f"bench_login_{args.workers}.sqlite")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--logins", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args)
+        return
+
+    for workers in (0, args.workers):
+        # Separate processes, the worker pool size is read when the app is imported
+        output = subprocess.run([sys.executable, "-m", "bench.login_burst", "--child", "--workers", str(workers), "--logins", str(args.logins)], check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        label = "bcrypt on event loop" if workers == 0 else f"bcrypt on {workers} workers"
+        idle, burst = result["idle"], result["during_burst"]
+        print(f"{label:>22}: {result['logins_per_s']:6.1f} logins/s, dashboard p50/p99 idle {idle['p50_ms']:.1f}/{idle['p99_ms']:.1f} ms, during burst {burst['p50_ms']:.1f}/{burst['p99_ms']:.1f} ms (max {burst['max_ms']:.1f} ms)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Load test of the connection pool settings: throughput and checkout waits of concurrent requests per pool size.
+
+Each client thread repeatedly checks out a connection, runs a query and keeps the connection for --hold seconds,
+standing in for the rest of a request's work, like a camera burst of boat pass uploads. When the pool is smaller
+than the number of clients, requests queue for a connection and throughput is capped at connections / hold.
+
+Runs on a SQLite file by default, pass `--db-url` to load a Postgres database, where the query is pg_sleep and the
+statement timeout and prepared statement settings take effect too.
+
+Usage: python -m bench.pool_load [--db-url postgresql+psycopg://...] [--clients 32] [--hold 0.02] [--seconds 3]
+"""
+import argparse
+import json
+import threading
+import time
+import bench.common  # noqa: F401, sets the mandatory settings
+from sqlalchemy import exc, text
+from sqlmodel import create_engine
+from bench.common import latency_summary
+from app.core.app_config import app_config
+from app.core.db import engine_options
+from app.core.metrics import TimedQueuePool
+
+# (pool size, max overflow), the first is the previous default of create_engine
+CONFIGURATIONS = [(5, 10), (5, 0), (16, 16), (32, 0)]
+
+def run(db_url: str, pool_size: int, max_overflow: int, args: argparse.Namespace) -> dict:
+    config = app_config.model_copy(update={"DB_POOL_SIZE": pool_size, "DB_MAX_OVERFLOW": max_overflow, "DB_POOL_TIMEOUT": args.timeout})
+    engine = create_engine(db_url, echo=False, poolclass=TimedQueuePool, **engine_options(db_url, config))
+    postgres = engine.dialect.name == "postgresql"
+    query = text("SELECT pg_sleep(:hold)") if postgres else text("SELECT 1")
+    waits: list[float] = []
+    requests: list[float] = []
+    timeouts = 0
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.seconds
+
+    def client():
+        nonlocal timeouts
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                with engine.connect() as connection:
+                    checked_out = time.perf_counter()
+                    connection.execute(query, {"hold": args.hold})
+                    if not postgres:
+                        time.sleep(args.hold)
+            except exc.TimeoutError:
+                # The pool does not queue waiters fairly, under saturation some clients wait until the timeout
+                with lock:
+                    timeouts += 1
+                    waits.append(time.perf_counter() - start)
+                continue
+            with lock:
+                waits.append(checked_out - start)
+                requests.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client) for _ in range(args.clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    engine.dispose()
+    return {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "requests_per_s": len(requests) / elapsed,
+        "timeouts": timeouts,
+        "checkout_wait": latency_summary(waits),
+        "request": latency_summary(requests),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--db-url", default="sqlite:///bench_pool_load.sqlite")
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--hold", type=float, default=0.02, help="seconds each request keeps its connection")
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--timeout", type=float, default=1.0, help="DB_POOL_TIMEOUT for the run")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = [run(args.db_url, pool_size, max_overflow, args) for pool_size, max_overflow in CONFIGURATIONS]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.clients} clients holding a connection for {args.hold * 1000:.0f} ms")
+    print(f"{'size':>5} {'overflow':>8} {'req/s':>8} {'timeouts':>8} {'wait p50':>9} {'wait p99':>9} {'req p99':>9}")
+    for result in results:
+        wait, request = result["checkout_wait"], result["request"]
+        print(f"{result['pool_size']:>5} {result['max_overflow']:>8} {result['requests_per_s']:>8.0f} {result['timeouts']:>8} {wait['p50_ms']:>7.1f}ms {wait['p99_ms']:>7.1f}ms {request['p99_ms']:>7.1f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""Replays camera traffic against the API served by uvicorn and reports throughput, latency and memory.
+
+A trace is a JSON lines file. Its first line describes the run, every further line is a request at an offset in
+seconds: a boat pass with its image, a preview frame or a dashboard poll. Boats arrive on the arrival camera and
+most of them leave on the departure camera later, some with an unreadable character, so the State linking runs
+as in the harbour. WebSocket subscribers stay connected for the whole replay and measure how long a preview takes
+to reach them. Requires httpx and websockets.
+
+The server runs in a subprocess against a fresh SQLite file by default, or a Postgres database given with
+`--db-url` (use a scratch database, the replay adds rows to it). `--save` writes the results to
+bench/results/<commit>.json, `compare` lists the changes between two results and exits with 1 on a regression.
+
+Usage:
+  python -m bench.replay generate [--seconds 60] [--subscribers 50] [--preview-fps 2] [--out bench/traces/harbour.jsonl]
+  python -m bench.replay run [--trace bench/traces/harbour.jsonl] [--db-url ...] [--workers 1] [--speed 1] [--save]
+  python -m bench.replay compare bench/results/<before>.json bench/results/<after>.json [--threshold 10]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, UTC
+from pathlib import Path
+import bench.common  # noqa: F401, sets the mandatory settings
+from bench.common import latency_summary, make_boat_pass, random_identifier
+
+BENCH_DIR = Path(__file__).parent
+DEFAULT_TRACE = BENCH_DIR / "traces" / "harbour.jsonl"
+RESULTS_DIR = BENCH_DIR / "results"
+CREDENTIALS = {"username": "petrovadmin", "password": "Petrov.Admin.2024"}
+ARRIVAL_CAMERA, DEPARTURE_CAMERA = 1, 2
+# Same layout as app.core.preview_cache.BINARY_HEADER, version, type, camera id
+PREVIEW_HEADER_SIZE = 6
+
+def generate(args: argparse.Namespace) -> None:
+    rng = random.Random(args.seed)
+    events = []
+    boat = 0
+    t = rng.expovariate(args.boats_per_minute / 60)
+    while t < args.seconds:
+        identifier = random_identifier(rng)
+        events.append({"t": t, "kind": "boat_pass", "camera_id": ARRIVAL_CAMERA, "identifier": identifier, "image_bytes": rng.randint(80_000, 250_000), "seed": boat})
+        departure = t + rng.expovariate(3 / args.seconds)
+        if departure < args.seconds and rng.random() < 0.9:
+            if rng.random() < 0.1:
+                position = rng.randrange(len(identifier))
+                identifier = identifier[:position] + "?" + identifier[position + 1:]
+            events.append({"t": departure, "kind": "boat_pass", "camera_id": DEPARTURE_CAMERA, "identifier": identifier, "image_bytes": rng.randint(80_000, 250_000), "seed": boat})
+        boat += 1
+        t += rng.expovariate(args.boats_per_minute / 60)
+    for camera_id in (ARRIVAL_CAMERA, DEPARTURE_CAMERA):
+        t = rng.random() / args.preview_fps
+        while t < args.seconds:
+            events.append({"t": t, "kind": "preview", "camera_id": camera_id, "image_bytes": rng.randint(20_000, 40_000)})
+            t += rng.gauss(1 / args.preview_fps, 0.05 / args.preview_fps)
+    for _ in range(args.pollers):
+        t = rng.random() * args.poll_interval
+        while t < args.seconds:
+            events.append({"t": t, "kind": "dashboard"})
+            t += args.poll_interval
+    events.sort(key=lambda event: event["t"])
+    meta = {"kind": "meta", "seconds": args.seconds, "subscribers": args.subscribers, "seed": args.seed, "boats_per_minute": args.boats_per_minute, "preview_fps": args.preview_fps, "pollers": args.pollers}
+    args.out.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.out, "w") as f:
+        for event in [meta] + events:
+            f.write(json.dumps({key: round(value, 4) if isinstance(value, float) else value for key, value in event.items()}) + "\n")
+    print(f"Wrote {len(events)} requests over {args.seconds} s to {args.out}")
+
+def load_trace(path: Path) -> tuple[dict, list[dict]]:
+    with open(path) as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    return lines[0], lines[1:]
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def process_tree_rss(pid: int) -> int:
+    """Resident memory in bytes of a process and its children, read from /proc (Linux only)."""
+    children: dict[int, list[int]] = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    parent = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(parent, []).append(int(entry))
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending += children.get(current, [])
+        try:
+            with open(f"/proc/{current}/status") as f:
+                total += next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+        except (OSError, StopIteration):
+            pass
+    return total
+
+def git_commit() -> tuple[str, bool]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short=10", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+    return commit, dirty
+
+def start_server(args: argparse.Namespace, data_folder: str, port: int) -> subprocess.Popen:
+    env = dict(os.environ, API_DATABASE_URL=args.db_url, API_INIT_DB="True", API_DATA_FOLDER=data_folder, API_LOG_LEVEL="WARNING")
+    if args.workers > 1:
+        env["API_BROADCAST_BACKPLANE"] = "postgres"
+    command = [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port), "--workers", str(args.workers), "--log-level", "warning"]
+    return subprocess.Popen(command, env=env)
+
+async def replay(args: argparse.Namespace, meta: dict, events: list[dict], base_url: str, server: subprocess.Popen) -> dict:
+    import httpx
+    import websockets
+
+    latencies: dict[str, list[float]] = {"boat_pass": [], "preview": [], "dashboard": []}
+    errors = {kind: 0 for kind in latencies}
+    deliveries: list[float] = []
+    preview_sent: dict[int, float] = {}
+    lag = 0.0
+    memory = {"start": process_tree_rss(server.pid), "peak": 0}
+    stopping = asyncio.Event()
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+        response = await client.post("/api/v1/login/access-token", data=CREDENTIALS)
+        response.raise_for_status()
+        headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+        async def subscriber(ready: asyncio.Event):
+            async with websockets.connect(base_url.replace("http", "ws") + "/ws", max_size=None) as websocket:
+                await websocket.send(json.dumps({"type": "authorization", "token": headers["Authorization"], "format": "binary"}))
+                ready.set()
+                while not stopping.is_set():
+                    try:
+                        message = await asyncio.wait_for(websocket.recv(), 0.5)
+                    except asyncio.TimeoutError:
+                        continue
+                    if isinstance(message, bytes) and len(message) >= PREVIEW_HEADER_SIZE:
+                        sent = preview_sent.get(int.from_bytes(message[2:PREVIEW_HEADER_SIZE], "big"))
+                        if sent is not None:
+                            deliveries.append(time.perf_counter() - sent)
+
+        async def sample_memory():
+            while not stopping.is_set():
+                memory["peak"] = max(memory["peak"], await asyncio.to_thread(process_tree_rss, server.pid))
+                await asyncio.sleep(0.25)
+
+        async def send(index: int, event: dict):
+            kind = event["kind"]
+            start = time.perf_counter()
+            try:
+                if kind == "boat_pass":
+                    rng = random.Random(event["seed"])
+                    boat_pass = make_boat_pass(rng, timestamp=datetime.now(UTC), boxes=2, ocr_per_box=2)
+                    boat_pass.camera_id = event["camera_id"]
+                    boat_pass.detected_identifier = boat_pass.raw_text = event["identifier"]
+                    boat_pass.image_filename = f"replay_{index}.jpg"
+                    image = base64.b64encode(rng.randbytes(event["image_bytes"])).decode()
+                    response = await client.post("/api/v1/boat-pass", json={"boat_pass": boat_pass.model_dump(mode="json"), "image_data": {"image": image}}, headers=headers)
+                elif kind == "preview":
+                    preview_sent[event["camera_id"]] = start
+                    response = await client.post(f"/api/v1/preview/{event['camera_id']}", content=random.randbytes(event["image_bytes"]), headers=headers | {"Content-Type": "image/jpeg"})
+                else:
+                    response = await client.get("/api/v1/dashboard", headers=headers)
+                response.raise_for_status()
+            except httpx.HTTPError:
+                errors[kind] += 1
+                return
+            latencies[kind].append(time.perf_counter() - start)
+
+        ready_events = [asyncio.Event() for _ in range(meta["subscribers"])]
+        subscribers = [asyncio.create_task(subscriber(ready)) for ready in ready_events]
+        await asyncio.gather(*[ready.wait() for ready in ready_events])
+        # Drops the cached previews sent on connect
+        await asyncio.sleep(0.5)
+        deliveries.clear()
+        sampler = asyncio.create_task(sample_memory())
+
+        pending = []
+        start = time.perf_counter()
+        for index, event in enumerate(events):
+            delay = start + event["t"] / args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                lag = max(lag, -delay)
+            pending.append(asyncio.create_task(send(index, event)))
+        await asyncio.gather(*pending)
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(0.5)
+        stats = (await client.get("/api/v1/stats", headers=headers)).json()
+        stopping.set()
+        await asyncio.gather(sampler, *subscribers)
+
+    memory["end"] = process_tree_rss(server.pid)
+    mib = 1024 * 1024
+    return {
+        "duration_s": elapsed,
+        "schedule_lag_ms": lag * 1000,
+        "requests": {kind: latency_summary(values) | {"errors": errors[kind], "per_s": len(values) / elapsed} for kind, values in latencies.items()},
+        "websocket": latency_summary(deliveries) | {"subscribers": meta["subscribers"], "per_s": len(deliveries) / elapsed, "dropped_frames": stats["websocket"]["dropped_frames"]},
+        "memory": {f"rss_{key}_mib": value / mib for key, value in memory.items()},
+    }
+
+def run(args: argparse.Namespace) -> None:
+    meta, events = load_trace(args.trace)
+    if args.workers > 1 and not args.db_url.startswith("postgresql"):
+        sys.exit("More than one worker needs a Postgres database, the workers share previews over its backplane")
+    if args.db_url.startswith("sqlite:///"):
+        Path(args.db_url.removeprefix("sqlite:///")).unlink(missing_ok=True)
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as data_folder:
+        server = start_server(args, data_folder, port)
+        try:
+            wait_for_server(base_url, server)
+            result = asyncio.run(replay(args, meta, events, base_url, server))
+        finally:
+            server.terminate()
+            server.wait(10)
+    commit, dirty = git_commit()
+    result = {
+        "commit": commit,
+        "dirty": dirty,
+        "date": datetime.now(UTC).isoformat(timespec="seconds"),
+        "trace": str(args.trace),
+        "database": args.db_url.split(":", 1)[0],
+        "workers": args.workers,
+        "speed": args.speed,
+    } | result
+    print_result(result)
+    if args.save:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        path = RESULTS_DIR / f"{commit}{'-dirty' if dirty else ''}.json"
+        path.write_text(json.dumps(result, indent=2) + "\n")
+        print(f"Saved {path}")
+
+def wait_for_server(base_url: str, server: subprocess.Popen, timeout: float = 30.0) -> None:
+    import httpx
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit(f"Server exited with {server.returncode}")
+        try:
+            if httpx.get(base_url + "/health").status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    sys.exit("Server did not start")
+
+def print_result(result: dict) -> None:
+    print(f"{result['commit']}{' (dirty)' if result['dirty'] else ''}, {result['database']}, {result['workers']} worker(s), {result['duration_s']:.1f} s, schedule lag {result['schedule_lag_ms']:.0f} ms")
+    print(f"{'':>12} {'count':>7} {'per s':>7} {'errors':>6} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for kind, summary in result["requests"].items():
+        print(f"{kind:>12} {summary['count']:>7} {summary['per_s']:>7.1f} {summary['errors']:>6} {summary['p50_ms']:>6.1f}ms {summary['p95_ms']:>6.1f}ms {summary['p99_ms']:>6.1f}ms")
+    ws = result["websocket"]
+    print(f"{'ws delivery':>12} {ws['count']:>7} {ws['per_s']:>7.1f} {ws['dropped_frames']:>6} {ws['p50_ms']:>6.1f}ms {ws['p95_ms']:>6.1f}ms {ws['p99_ms']:>6.1f}ms  ({ws['subscribers']} subscribers, errors column is dropped frames)")
+    memory = result["memory"]
+    print(f"{'memory':>12} start {memory['rss_start_mib']:.0f} MiB, peak {memory['rss_peak_mib']:.0f} MiB, end {memory['rss_end_mib']:.0f} MiB")
+
+def compare(args: argparse.Namespace) -> None:
+    before, after = (json.loads(Path(path).read_text()) for path in (args.before, args.after))
+    # (name, before, after, True when higher is better)
+    rows = []
+    for kind, summary in after["requests"].items():
+        rows.append((f"{kind} p95 ms", before["requests"][kind]["p95_ms"], summary["p95_ms"], False))
+        rows.append((f"{kind} p99 ms", before["requests"][kind]["p99_ms"], summary["p99_ms"], False))
+        rows.append((f"{kind} per s", before["requests"][kind]["per_s"], summary["per_s"], True))
+    rows.append(("ws delivery p95 ms", before["websocket"]["p95_ms"], after["websocket"]["p95_ms"], False))
+    rows.append(("ws messages per s", before["websocket"]["per_s"], after["websocket"]["per_s"], True))
+    rows.append(("peak rss MiB", before["memory"]["rss_peak_mib"], after["memory"]["rss_peak_mib"], False))
+    print(f"{before['commit']} -> {after['commit']}")
+    regressions = 0
+    for name, old, new, higher_is_better in rows:
+        change = (new - old) / old * 100 if old else 0.0
+        regressed = (-change if higher_is_better else change) > args.threshold
+        regressions += regressed
+        print(f"{name:>22} {old:>10.1f} {new:>10.1f} {change:>+7.1f}%{'  REGRESSION' if regressed else ''}")
+    sys.exit(1 if regressions else 0)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = commands.add_parser("generate", help="write a synthetic trace")
+    generate_parser.add_argument("--out", type=Path, default=DEFAULT_TRACE)
+    generate_parser.add_argument("--seconds", type=float, default=60)
+    generate_parser.add_argument("--boats-per-minute", type=float, default=20)
+    generate_parser.add_argument("--preview-fps", type=float, default=2)
+    generate_parser.add_argument("--pollers", type=int, default=4, help="dashboards polling at the same time")
+    generate_parser.add_argument("--poll-interval", type=float, default=2)
+    generate_parser.add_argument("--subscribers", type=int, default=50, help="WebSocket clients")
+    generate_parser.add_argument("--seed", type=int, default=42)
+    generate_parser.set_defaults(run=generate)
+
+    run_parser = commands.add_parser("run", help="replay a trace against a fresh server")
+    run_parser.add_argument("--trace", type=Path, default=DEFAULT_TRACE)
+    run_parser.add_argument("--db-url", default="sqlite:///bench_replay.sqlite")
+    run_parser.add_argument("--workers", type=int, default=1)
+    run_parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 2 sends the trace twice as fast")
+    run_parser.add_argument("--save", action="store_true", help=f"write the results to {RESULTS_DIR.relative_to(BENCH_DIR.parent)}/<commit>.json")
+    run_parser.set_defaults(run=run)
+
+    compare_parser = commands.add_parser("compare", help="compare two saved results")
+    compare_parser.add_argument("before", type=Path)
+    compare_parser.add_argument("after", type=Path)
+    compare_parser.add_argument("--threshold", type=float, default=10.0, help="percent change counted as a regression")
+    compare_parser.set_defaults(run=compare)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Compares FastAPI's response_model serialization of list responses with the RowSerializer path.
+
+The response_model path is what FastAPI does for a route returning ORM rows: validate every row, box and OCR
+result into the public model, serialize to Python values and encode them with json.dumps. Both outputs are
+checked to decode to the same documents.
+
+Usage: python -m bench.serialization [--db-url postgresql+psycopg://...] [--passes 10000] [--repeat 5]
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+from sqlmodel import Session, select
+from bench.common import make_boat_pass, make_engine
+from app import crud
+from app.core.serialization import RowSerializer, boat_pass_public_json, state_json
+from app.models import BoatPass, BoatPassPublic, State
+
+def seed(session: Session, passes: int) -> None:
+    rng = random.Random(42)
+    for i in range(0, passes, 500):
+        crud.create_boat_passes(session=session, boat_passes=[make_boat_pass(rng, boxes=2, ocr_per_box=2) for _ in range(min(500, passes - i))], link=True)
+
+def timed(func, repeat: int) -> tuple[float, object]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+def compare(name: str, rows: list, response_model, serializer: RowSerializer, repeat: int) -> None:
+    field = create_response_field(name="Response", type_=response_model)
+
+    def response_model_path() -> bytes:
+        content = asyncio.run(serialize_response(field=field, response_content=rows))
+        return JSONResponse(content).body
+
+    def serializer_path() -> bytes:
+        return serializer.dump_json_list(rows)
+
+    before, expected = timed(response_model_path, repeat)
+    after, body = timed(serializer_path, repeat)
+    assert json.loads(body) == json.loads(expected), f"{name}: outputs differ"
+    print(f"{name:>12}: response_model {before * 1000:8.1f} ms, serializer {after * 1000:7.1f} ms, {before / after:5.1f}x faster, {len(body) / 1024 / 1024:.1f} MiB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--db-url", default="sqlite:///bench_serialization.sqlite")
+    parser.add_argument("--passes", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    engine = make_engine(args.db_url)
+    with Session(engine) as session:
+        seed(session, args.passes)
+    with Session(engine) as session:
+        query, boat_passes = timed(lambda: crud.get_boat_passes_page(session=session, limit=args.passes), 1)
+        print(f"{len(boat_passes)} passes with 2 boxes and 4 OCR results each, query {query * 1000:.1f} ms")
+        compare("boat passes", boat_passes, list[BoatPassPublic], boat_pass_public_json, args.repeat)
+        query, states = timed(lambda: crud.get_states(session=session), 1)
+        print(f"{len(states)} States, query {query * 1000:.1f} ms")
+        compare("states", states, list[State], state_json, args.repeat)
+    engine.dispose()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+import os
+import tempfile
+
+# app.core.app_config requires these settings. The tests never connect to Postgres, and the data folder is a scratch directory.
+os.environ.setdefault("API_POSTGRES_SERVER", "localhost")
+os.environ.setdefault("API_POSTGRES_USER", "test")
+os.environ.setdefault("API_POSTGRES_PASSWORD", "test")
+os.environ.setdefault("API_INIT_DB_FILE", os.path.join(os.path.dirname(os.path.dirname(__file__)), "init", "init_db.json"))
+os.environ.setdefault("API_DATA_FOLDER", tempfile.mkdtemp(prefix="smart-harbour-tests-"))
+os.environ.setdefault("API_LOG_LEVEL", "WARNING")
@@ -0,0 +1,35 @@
+import asyncio
+from app.core.backplane import PostgresBackplane
+
+def make_backplane(folder) -> PostgresBackplane:
+    # Never started, the tests pass messages to _receive instead of going through Postgres
+    return PostgresBackplane("postgresql://unused", "test", str(folder), message_ttl=60)
+
+def test_keyed_message_is_read_from_the_shared_file(tmp_path):
+    publisher, receiver = make_backplane(tmp_path), make_backplane(tmp_path)
+    received = []
+    async def handler(payload: bytes) -> None:
+        received.append(payload)
+    receiver.subscribe("preview", handler)
+
+    async def run():
+        publisher._write("preview", "1", 1, b"first")
+        await receiver._receive(f"{publisher.origin}:preview:f:1:1")
+        publisher._write("preview", "1", 2, b"second")
+        publisher._write("preview", "1", 3, b"third")
+        # Superseded before it was read, the notification of 3 delivers the newer frame
+        await receiver._receive(f"{publisher.origin}:preview:f:2:1")
+        await receiver._receive(f"{publisher.origin}:preview:f:3:1")
+        # The publisher skips its own messages
+        await publisher._receive(f"{publisher.origin}:preview:f:3:1")
+    asyncio.run(run())
+    assert received == [b"first", b"third"]
+
+def test_invalid_key_is_not_read(tmp_path):
+    receiver = make_backplane(tmp_path)
+    received = []
+    async def handler(payload: bytes) -> None:
+        received.append(payload)
+    receiver.subscribe("preview", handler)
+    asyncio.run(receiver._receive("other:preview:f:1:../secret"))
+    assert received == []
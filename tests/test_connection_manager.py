@@ -0,0 +1,103 @@
+import asyncio
+from app.core.connection_manager import ClientConnection, ConnectionManager
+from app.core.preview_cache import PreviewFrame
+
+class FakeWebSocket:
+    """Records what is sent, every send waits until the gate is open."""
+    def __init__(self, blocked: bool = False):
+        self.sent = []
+        self.closed = False
+        self.gate = asyncio.Event()
+        if not blocked:
+            self.gate.set()
+
+    async def accept(self):
+        pass
+
+    async def close(self):
+        self.closed = True
+
+    async def _send(self, message):
+        await self.gate.wait()
+        self.sent.append(message)
+
+    async def send_text(self, message):
+        await self._send(message)
+
+    async def send_json(self, message):
+        await self._send(message)
+
+    async def send_bytes(self, message):
+        await self._send(message)
+
+def frame(camera_id: int, data: bytes = b"jpeg") -> PreviewFrame:
+    return PreviewFrame(camera_id, data=data)
+
+def test_full_queue_drops_the_oldest_frame():
+    connection = ClientConnection(FakeWebSocket(), max_queue=3, send_timeout=1.0)
+    for camera_id in (1, 2, 3):
+        connection.enqueue(frame(camera_id), ("image", camera_id))
+    connection.enqueue(frame(4), ("image", 4))
+    assert list(connection.pending) == [("image", 2), ("image", 3), ("image", 4)]
+    # A State change makes room the same way
+    connection.enqueue("state 1", ("state", 1))
+    assert list(connection.pending) == [("image", 3), ("image", 4), ("state", 1)]
+    assert connection.dropped == 2 and not connection.overflowed
+
+def test_pending_message_with_the_same_key_is_replaced():
+    connection = ClientConnection(FakeWebSocket(), max_queue=3, send_timeout=1.0)
+    first, latest = frame(1, b"first"), frame(1, b"latest")
+    connection.enqueue(first, ("image", 1))
+    connection.enqueue(frame(2), ("image", 2))
+    connection.enqueue(latest, ("image", 1))
+    assert list(connection.pending) == [("image", 2), ("image", 1)]
+    assert connection.pending[("image", 1)] is latest
+    assert connection.dropped == 1
+
+def test_client_with_only_states_queued_is_evicted():
+    async def scenario():
+        manager = ConnectionManager(max_queue=2, send_timeout=5.0)
+        websocket = FakeWebSocket(blocked=True)
+        await manager.connect(websocket)
+        manager.set_authorized(websocket)
+        await manager.broadcast_state(1, "state 1")
+        # The writer takes the first State and waits in its send
+        await asyncio.sleep(0)
+        await manager.broadcast_state(2, "state 2")
+        await manager.broadcast_state(3, "state 3")
+        # A frame is dropped rather than a State
+        await manager.broadcast_frame(frame(1))
+        assert manager.number_of_connections() == 1
+        await manager.broadcast_state(4, "state 4")
+
+        websocket.gate.set()
+        await asyncio.sleep(0.05)
+        assert manager.number_of_connections() == 0
+        assert websocket.closed
+        assert websocket.sent == ["state 1"]
+        assert manager.stats()["evicted_connections"] == 1
+
+    asyncio.run(scenario())
+
+def test_slow_client_does_not_delay_the_others():
+    async def scenario():
+        manager = ConnectionManager(max_queue=8, send_timeout=0.2)
+        slow, fast = FakeWebSocket(blocked=True), FakeWebSocket()
+        await manager.connect(slow)
+        await manager.connect(fast)
+        for index in range(3):
+            await manager.broadcast({"index": index})
+        await asyncio.sleep(0.05)
+        assert fast.sent == [{"index": index} for index in range(3)]
+        assert slow.sent == []
+
+        # The stuck send times out and only the slow client is disconnected
+        await asyncio.sleep(0.3)
+        assert manager.number_of_connections() == 1
+        assert slow.closed and not fast.closed
+        await manager.broadcast({"index": 3})
+        await asyncio.sleep(0.05)
+        assert fast.sent[-1] == {"index": 3}
+        manager.disconnect(fast)
+
+    asyncio.run(scenario())
@@ -0,0 +1,75 @@
+import random
+from datetime import datetime
+import pytest
+from sqlmodel import Session, create_engine, select
+from app import crud
+from app.core.app_config import app_config
+from app.core.detections import iter_ocr_results, pack_detections, unpack_detections
+from app.core.migrations import migrate
+from app.models import BoatPassCreate, BoundingBox, BoundingBoxCreate, OcrResult, OcrResultBase
+
+def random_box(rng: random.Random, ocr_results: int) -> BoundingBoxCreate:
+    return BoundingBoxCreate(
+        left=rng.random(), top=rng.random(), right=rng.uniform(1, 2000), bottom=rng.uniform(1, 2000), confidence=rng.random(), class_identifier=rng.randint(-5, 5),
+        ocr_results=[OcrResultBase(left=rng.random(), top=rng.random(), right=rng.random(), bottom=rng.random(), text=rng.choice(["", "CZ1234", "ŽŠ?9"]), confidence=rng.random()) for _ in range(ocr_results)],
+    )
+
+def test_round_trip_keeps_values_and_ids():
+    rng = random.Random(7)
+    boxes = [random_box(rng, ocr_results) for ocr_results in (0, 1, 3)]
+    box_ids, ocr_ids = [11, 12, 13], [21, 22, 23, 24]
+    unpacked = unpack_detections(pack_detections(boxes, iter(box_ids), iter(ocr_ids)))
+    expected = [box.model_dump() | {"id": box_id} for box, box_id in zip(boxes, box_ids)]
+    remaining = iter(ocr_ids)
+    for box in expected:
+        box["ocr_results"] = [ocr | {"id": next(remaining)} for ocr in box["ocr_results"]]
+    assert unpacked == expected
+
+def test_rows_keep_their_ids():
+    box = BoundingBox(id=5, left=1.5, top=2.5, right=3.5, bottom=4.5, confidence=0.9, class_identifier=1, boat_pass_id=1)
+    box.ocr_results = [OcrResult(id=8, left=0.1, top=0.2, right=0.3, bottom=0.4, text="AB", confidence=0.5, bounding_box_id=5)]
+    detections = pack_detections([box])
+    assert [box["id"] for box in unpack_detections(detections)] == [5]
+    assert [(ocr.id, ocr.bounding_box_id, ocr.text) for ocr in iter_ocr_results(detections)] == [(8, 5, "AB")]
+
+def test_empty_detections():
+    assert unpack_detections(pack_detections([])) == []
+
+def test_compact_ids_are_unique_across_passes_and_layouts(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'detections.sqlite'}")
+    migrate(engine)
+    rng = random.Random(3)
+    def boat_pass(index: int) -> BoatPassCreate:
+        return BoatPassCreate(camera_id=1, timestamp=datetime(2026, 7, 1, 10, index), image_filename=f"{index}.jpg", bounding_boxes=[random_box(rng, 2) for _ in range(2)])
+    with Session(engine, expire_on_commit=False) as session:
+        crud.create_boat_passes(session=session, boat_passes=[boat_pass(0), boat_pass(1)])
+        monkeypatch.setattr(app_config, "DETECTIONS_STORAGE", "compact")
+        crud.create_boat_passes(session=session, boat_passes=[boat_pass(2), boat_pass(3)])
+        crud.create_boat_pass(session=session, boat_pass=boat_pass(4))
+        ocr_results = crud.get_all_ocr_results(session=session)
+    engine.dispose()
+    assert len(ocr_results) == 5 * 2 * 2
+    assert len({ocr.id for ocr in ocr_results}) == len(ocr_results)
+    # Two OCR results per box, every box id is used by exactly two of them
+    assert sorted(ocr.bounding_box_id for ocr in ocr_results) == sorted(list(range(1, 11)) * 2)
+
+def test_kept_rows_are_read_once_and_deleted_later(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'detections.sqlite'}")
+    migrate(engine)
+    rng = random.Random(5)
+    boat_passes = [BoatPassCreate(camera_id=1, timestamp=datetime(2026, 7, 1, 10, index), image_filename=f"{index}.jpg", bounding_boxes=[random_box(rng, 2) for _ in range(2)]) for index in range(3)]
+    with Session(engine, expire_on_commit=False) as session:
+        crud.create_boat_passes(session=session, boat_passes=boat_passes)
+        before = sorted((ocr.id, ocr.bounding_box_id, ocr.text) for ocr in crud.get_all_ocr_results(session=session))
+    # Like the command, on a session of its own
+    with Session(engine, expire_on_commit=False) as session:
+        assert crud.compact_row_boxes(session=session, batch_size=2, keep_rows=True) == 2
+        assert crud.compact_row_boxes(session=session, batch_size=2, keep_rows=True) == 1
+        assert crud.compact_row_boxes(session=session, batch_size=2) == 0
+        assert sorted((ocr.id, ocr.bounding_box_id, ocr.text) for ocr in crud.get_all_ocr_results(session=session)) == before
+        assert crud.delete_kept_rows(session=session, batch_size=4) == 4
+        assert crud.delete_kept_rows(session=session, batch_size=4) == 2
+        assert crud.delete_kept_rows(session=session, batch_size=4) == 0
+        assert session.exec(select(BoundingBox)).all() == [] and session.exec(select(OcrResult)).all() == []
+        assert sorted((ocr.id, ocr.bounding_box_id, ocr.text) for ocr in crud.get_all_ocr_results(session=session)) == before
+    engine.dispose()
@@ -0,0 +1,81 @@
+import random
+import pytest
+from app.core.identifier_index import WILDCARD, IdentifierIndex, WildcardPattern
+
+ALPHABET = "AB1" + WILDCARD
+
+def wildcard_distance(pattern: str, text: str) -> int:
+    """Plain dynamic programming Levenshtein, '?' on either side matches any character."""
+    previous = list(range(len(text) + 1))
+    for i, pattern_char in enumerate(pattern, 1):
+        current = [i]
+        for j, text_char in enumerate(text, 1):
+            same = pattern_char == text_char or WILDCARD in (pattern_char, text_char)
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (not same)))
+        previous = current
+    return previous[-1]
+
+def random_identifier(rng: random.Random, max_length: int = 8) -> str:
+    return "".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, max_length)))
+
+def test_distance_matches_dynamic_programming():
+    rng = random.Random(1)
+    for _ in range(20_000):
+        pattern, text = random_identifier(rng), random_identifier(rng)
+        assert WildcardPattern(pattern).distance(text) == wildcard_distance(pattern, text), (pattern, text)
+
+@pytest.mark.parametrize("pattern, text, distance", [
+    ("CZ1234", "CZ1234", 0),
+    ("CZ12?4", "CZ1234", 0),
+    ("CZ1234", "CZ12?4", 0),
+    ("CZ1234", "CZ124", 1),
+    ("CZ1234", "XCZ1234", 1),
+    ("", "ABC", 3),
+    ("ABC", "", 3),
+])
+def test_distance_examples(pattern, text, distance):
+    assert WildcardPattern(pattern).distance(text) == distance
+
+def test_distance_of_long_patterns():
+    # Longer than a machine word, the bit vectors are Python ints
+    rng = random.Random(2)
+    for _ in range(200):
+        pattern, text = random_identifier(rng, 100), random_identifier(rng, 100)
+        assert WildcardPattern(pattern).distance(text) == wildcard_distance(pattern, text)
+
+def brute_force(identifiers: dict[str, set], query: str, max_distance: int) -> list[tuple[str, int, frozenset]]:
+    matches = [(identifier, wildcard_distance(query, identifier), frozenset(keys)) for identifier, keys in identifiers.items()]
+    matches = [match for match in matches if match[1] <= max_distance]
+    return sorted(matches, key=lambda match: (match[1], match[0].count(WILDCARD), match[0]))
+
+@pytest.mark.parametrize("max_distance", [0, 1, 2])
+def test_search_matches_brute_force(max_distance):
+    rng = random.Random(max_distance)
+    index = IdentifierIndex()
+    identifiers: dict[str, set] = {}
+    for key in range(400):
+        identifier = random_identifier(rng)
+        index.add(identifier, key)
+        if identifier:
+            identifiers.setdefault(identifier, set()).add(key)
+    for _ in range(300):
+        query = random_identifier(rng)
+        expected = brute_force(identifiers, query, max_distance) if query else []
+        assert [tuple(match) for match in index.search(query, max_distance=max_distance, limit=len(identifiers))] == expected, query
+        if query:
+            assert [tuple(match) for match in index.linear_search(query, max_distance=max_distance, limit=len(identifiers))] == expected, query
+
+def test_remove_and_reuse_slots():
+    index = IdentifierIndex()
+    index.add("CZ1234", 1)
+    index.add("CZ1234", 2)
+    index.add("CZ9999", 3)
+    index.remove("CZ1234", 1)
+    assert index.search("CZ1234", max_distance=0) == [("CZ1234", 0, frozenset({2}))]
+    index.remove("CZ1234", 2)
+    assert index.search("CZ1234", max_distance=0) == []
+    assert len(index) == 1
+    index.add("AB12", 4)
+    assert index.search("AB1?", max_distance=0) == [("AB12", 0, frozenset({4}))]
+    assert [match.identifier for match in index.search("CZ1234", max_distance=2)] == []
+    assert [match.identifier for match in index.search("CZ9994", max_distance=1)] == ["CZ9999"]
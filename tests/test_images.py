@@ -0,0 +1,48 @@
+import asyncio
+import os
+from concurrent.futures.process import BrokenProcessPool
+import pytest
+from app.core import images
+from app.core.app_config import app_config
+from app.core.images import Image, ThumbnailGenerator, make_thumbnail, thumbnail_path
+
+def test_thumbnail_path_keeps_the_extension():
+    assert thumbnail_path("a.png") != thumbnail_path("a.jpg")
+
+@pytest.mark.skipif(Image is None, reason="needs Pillow")
+def test_outdated_thumbnail_is_made_again():
+    source = os.path.join(app_config.DATA_FOLDER, "thumbnail_test.png")
+    Image.new("RGB", (640, 480), "red").save(source)
+    generator = ThumbnailGenerator(0, 32, 80)
+    target = asyncio.run(generator.get(source, "thumbnail_test.png"))
+    with Image.open(target) as thumbnail:
+        assert thumbnail.size == (32, 24) and thumbnail.getpixel((0, 0))[0] > 200
+
+    Image.new("RGB", (640, 480), "blue").save(source)
+    # Older than the new image, however coarse the file system timestamps are
+    os.utime(target, ns=(0, 0))
+    assert asyncio.run(generator.get(source, "thumbnail_test.png")) == target
+    with Image.open(target) as thumbnail:
+        assert thumbnail.getpixel((0, 0))[2] > 200
+
+def crash(source: str, target: str, size: int, quality: int) -> None:
+    # Like a worker killed for running out of memory
+    os._exit(1)
+
+@pytest.mark.skipif(Image is None, reason="needs Pillow")
+def test_dead_worker_does_not_break_later_thumbnails(monkeypatch):
+    source = os.path.join(app_config.DATA_FOLDER, "thumbnail_crash.png")
+    Image.new("RGB", (64, 48), "green").save(source)
+    generator = ThumbnailGenerator(1, 16, 80)
+    try:
+        monkeypatch.setattr(images, "make_thumbnail", crash)
+        generator.submit(source, "thumbnail_crash.png")
+        with pytest.raises(BrokenProcessPool):
+            asyncio.run(generator.get(source, "thumbnail_crash.png"))
+        monkeypatch.setattr(images, "make_thumbnail", make_thumbnail)
+        # Submitting after the pool broke neither raises nor sticks
+        generator.submit(source, "thumbnail_crash.png")
+        target = asyncio.run(generator.get(source, "thumbnail_crash.png"))
+        assert os.path.exists(target)
+    finally:
+        generator.shutdown()
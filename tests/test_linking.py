@@ -0,0 +1,94 @@
+from datetime import datetime
+import pytest
+from sqlmodel import Session, create_engine, select
+from app import crud
+from app.core.migrations import migrate
+from app.core.state_engine import state_engine
+from app.models import BoatPassCreate, State, StateOfBoatEnum
+
+# The default camera directions, camera 1 looks at arrivals and camera 2 at departures
+ARRIVAL, DEPARTURE = 1, 2
+
+@pytest.fixture
+def session(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'linking.sqlite'}")
+    migrate(engine)
+    with Session(engine, expire_on_commit=False) as session:
+        # The index is shared by the whole process, start from this empty database
+        crud.rebuild_state_index(session=session)
+        yield session
+        crud.rebuild_state_index(session=session)
+    engine.dispose()
+
+def boat_pass(camera_id: int, identifier: str, hour: int, minute: int = 0) -> BoatPassCreate:
+    timestamp = datetime(2026, 7, 1, hour, minute)
+    return BoatPassCreate(camera_id=camera_id, timestamp=timestamp, image_filename=f"{identifier}_{camera_id}_{hour}_{minute}.jpg", detected_identifier=identifier, bounding_boxes=[])
+
+def link(session: Session, *boat_passes: BoatPassCreate) -> list:
+    return crud.create_boat_passes(session=session, boat_passes=list(boat_passes), link=True)
+
+def all_states(session: Session) -> list[State]:
+    return session.exec(select(State).order_by(State.id)).all()
+
+def test_departure_closes_the_arrival(session):
+    arrival, = link(session, boat_pass(ARRIVAL, "CZ1234", 10))
+    assert state_engine.match("CZ1234") is not None
+    departure, = link(session, boat_pass(DEPARTURE, "CZ1234", 10, 30))
+    state, = all_states(session)
+    assert (state.arrival_time, state.departure_time) == (datetime(2026, 7, 1, 10), datetime(2026, 7, 1, 10, 30))
+    assert (state.first_boat_pass_id, state.last_boat_pass_id) == (arrival.id, departure.id)
+    assert state.time_in_marina == 30
+    assert state.state_of_boat == StateOfBoatEnum.prujezd
+    assert not state.weird_state
+    assert state_engine.match("CZ1234") is None
+
+def test_long_stay_is_anchored(session):
+    link(session, boat_pass(ARRIVAL, "CZ1234", 8))
+    link(session, boat_pass(DEPARTURE, "CZ1234", 11))
+    state, = all_states(session)
+    assert state.time_in_marina == 180
+    assert state.state_of_boat == StateOfBoatEnum.kotvi
+
+def test_departure_without_arrival_is_weird(session):
+    departure, = link(session, boat_pass(DEPARTURE, "CZ1234", 10))
+    state, = all_states(session)
+    assert state.arrival_time is None and state.departure_time == datetime(2026, 7, 1, 10)
+    assert state.first_boat_pass_id == state.last_boat_pass_id == departure.id
+    assert state.weird_state
+    assert state_engine.match("CZ1234") is None
+
+def test_repeated_arrival_flags_the_first_one(session):
+    link(session, boat_pass(ARRIVAL, "CZ1234", 10))
+    second, = link(session, boat_pass(ARRIVAL, "CZ1234", 12))
+    first_state, second_state = all_states(session)
+    assert first_state.weird_state and first_state.departure_time is None
+    assert not second_state.weird_state and second_state.first_boat_pass_id == second.id
+    assert state_engine.match("CZ1234") == second_state.id
+
+    # The departure closes the newer arrival
+    link(session, boat_pass(DEPARTURE, "CZ1234", 12, 10))
+    first_state, second_state = all_states(session)
+    assert first_state.departure_time is None
+    assert second_state.time_in_marina == 10
+
+def test_arrival_and_departure_in_one_batch(session):
+    # Linked in time order, not in the order of the batch
+    departure, arrival = link(session, boat_pass(DEPARTURE, "CZ1234", 14), boat_pass(ARRIVAL, "CZ1234", 9))
+    state, = all_states(session)
+    assert (state.first_boat_pass_id, state.last_boat_pass_id) == (arrival.id, departure.id)
+    assert state.time_in_marina == 300
+    assert state.state_of_boat == StateOfBoatEnum.kotvi
+    assert not state.weird_state
+    assert state_engine.match("CZ1234") is None
+
+def test_rebuilt_index_matches_the_database(session):
+    link(session, boat_pass(ARRIVAL, "CZ1111", 8), boat_pass(ARRIVAL, "CZ2222", 8, 5), boat_pass(ARRIVAL, "CZ3333", 8, 10))
+    link(session, boat_pass(DEPARTURE, "CZ2222", 9), boat_pass(ARRIVAL, "CZ3333", 9, 30), boat_pass(DEPARTURE, "CZ4444", 10))
+    link(session, boat_pass(ARRIVAL, "CZ5555", 11))
+    open_states = {state.best_detected_identifier: state.id for state in all_states(session) if state.departure_time is None and not state.weird_state}
+    assert set(open_states) == {"CZ1111", "CZ3333", "CZ5555"}
+    assert state_engine.open_states == open_states
+
+    assert crud.rebuild_state_index(session=session) == 3
+    assert state_engine.open_states == open_states
+    assert state_engine.closest("CZ3334") == open_states["CZ3333"]
@@ -0,0 +1,124 @@
+import random
+from datetime import datetime, timedelta, UTC
+from zoneinfo import ZoneInfo
+import pytest
+from sqlmodel import Session, create_engine, select
+from app import crud
+from app.core import occupancy
+from app.core.migrations import migrate
+from app.models import OccupancyHour, PaymentStatusEnum, State
+
+START = datetime(2026, 3, 27)
+HOURS = 24 * 5
+
+def test_contributions_of_a_stay():
+    arrival, departure = datetime(2026, 7, 1, 10, 30), datetime(2026, 7, 1, 13, 5)
+    changes = occupancy.contributions(arrival, departure, "CZ?234", PaymentStatusEnum.zaplaceno, False)
+    assert {key: value for key, value in changes.items() if value} == {
+        (datetime(2026, 7, 1, 10), "arrived"): 1,
+        (datetime(2026, 7, 1, 10), "arrived_undetected_identifier"): 1,
+        (datetime(2026, 7, 1, 10), "payed"): 1,
+        (datetime(2026, 7, 1, 10), "occupancy_change"): 1,
+        (datetime(2026, 7, 1, 13), "occupancy_change"): -1,
+        (datetime(2026, 7, 1, 13), "departed"): 1,
+        (datetime(2026, 7, 1, 13), "departed_undetected_identifier"): 1,
+    }
+
+def test_weird_state_is_counted_but_not_in_the_marina():
+    changes = occupancy.contributions(datetime(2026, 7, 1, 10), None, "CZ1234", PaymentStatusEnum.nezaplaceno, True)
+    assert changes[datetime(2026, 7, 1, 10), "arrived"] == 1
+    assert changes[datetime(2026, 7, 1, 10), "occupancy_change"] == 0
+
+def random_state(rng: random.Random) -> State:
+    arrival = START + timedelta(minutes=rng.randrange(HOURS * 60)) if rng.random() < 0.9 else None
+    departure = None
+    if rng.random() < 0.7:
+        departure = (arrival or START) + timedelta(minutes=rng.randrange(1, 48 * 60))
+    identifier = rng.choice(["CZ1234", "CZ12?4", "AB99", None])
+    return State(arrival_time=arrival, departure_time=departure, best_detected_identifier=identifier, payment_status=rng.choice(list(PaymentStatusEnum)), weird_state=rng.random() < 0.1)
+
+def expected_hours(states: list[State], since: datetime, until: datetime) -> list[dict]:
+    """Brute force count of every hour in [since, until) from the States."""
+    result = []
+    hour = since
+    while hour < until:
+        end = hour + occupancy.HOUR
+        arrived = [state for state in states if state.arrival_time is not None and hour <= state.arrival_time < end]
+        departed = [state for state in states if state.departure_time is not None and hour <= state.departure_time < end]
+        undetected = lambda state: state.best_detected_identifier is not None and "?" in state.best_detected_identifier
+        in_marina = sum(
+            1 for state in states
+            if not state.weird_state and state.arrival_time is not None and state.arrival_time < end
+            and (state.departure_time is None or occupancy.hour_of(state.departure_time) >= end)
+        )
+        result.append({
+            "arrived": len(arrived),
+            "departed": len(departed),
+            "arrived_undetected_identifier": sum(map(undetected, arrived)),
+            "departed_undetected_identifier": sum(map(undetected, departed)),
+            "payed": sum(state.payment_status == PaymentStatusEnum.zaplaceno for state in arrived),
+            "not_payed": sum(state.payment_status == PaymentStatusEnum.nezaplaceno for state in arrived),
+            "occupancy": in_marina,
+        })
+        hour = end
+    return result
+
+@pytest.fixture
+def session(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'occupancy.sqlite'}")
+    migrate(engine)
+    with Session(engine, expire_on_commit=False) as session:
+        yield session
+    engine.dispose()
+
+@pytest.fixture
+def states(session) -> list[State]:
+    rng = random.Random(11)
+    states = [random_state(rng) for _ in range(300)]
+    session.add_all(states)
+    session.commit()
+    # Changes and deletes go through the rollup too
+    for state in rng.sample(states, 60):
+        state.departure_time = None if state.departure_time is not None else (state.arrival_time or START) + timedelta(hours=3)
+        state.payment_status = PaymentStatusEnum.zaplaceno
+    deleted = rng.sample(states, 20)
+    for state in deleted:
+        session.delete(state)
+    session.commit()
+    return [state for state in states if state not in deleted]
+
+def test_hours_match_brute_force(session, states):
+    since, until = START + timedelta(hours=30), START + timedelta(hours=90)
+    periods = crud.get_occupancy(session=session, since=since, until=until, bucket="hour", zone=UTC)
+    expected = expected_hours(states, since, until)
+    assert [period.start for period in periods] == [(since + timedelta(hours=index)).replace(tzinfo=UTC) for index in range(60)]
+    assert [period.model_dump(exclude={"start", "undetected_identifier_rate", "peak_occupancy"}) for period in periods] == expected
+    assert all(period.peak_occupancy == period.occupancy for period in periods)
+
+def test_days_sum_their_hours(session, states):
+    zone = ZoneInfo("Europe/Prague")
+    # Covers the switch to summer time on 29 March 2026, a day of 23 hours
+    since, until = datetime(2026, 3, 28, tzinfo=zone), datetime(2026, 3, 31, tzinfo=zone)
+    days = crud.get_occupancy(session=session, since=since, until=until, bucket="day", zone=zone)
+    assert [day.start for day in days] == [datetime(2026, 3, day, tzinfo=zone) for day in (28, 29, 30)]
+    for day, next_day in zip(days, days[1:] + [None]):
+        start = day.start.astimezone(UTC).replace(tzinfo=None)
+        end = (next_day.start if next_day else until).astimezone(UTC).replace(tzinfo=None)
+        hours = expected_hours(states, start, end)
+        for name in ("arrived", "departed", "arrived_undetected_identifier", "departed_undetected_identifier", "payed", "not_payed"):
+            assert getattr(day, name) == sum(hour[name] for hour in hours), name
+        assert day.occupancy == hours[-1]["occupancy"]
+        assert day.peak_occupancy == max(hour["occupancy"] for hour in hours)
+        passes = day.arrived + day.departed
+        assert day.undetected_identifier_rate == ((day.arrived_undetected_identifier + day.departed_undetected_identifier) / passes if passes else 0.0)
+
+def test_range_before_any_state_is_empty(session, states):
+    periods = crud.get_occupancy(session=session, since=START - timedelta(days=2), until=START - timedelta(days=1), bucket="hour", zone=UTC)
+    assert len(periods) == 24 and all(period.occupancy == 0 and period.arrived == 0 for period in periods)
+
+def test_rebuild_matches_the_incremental_rollup(session, states):
+    incremental = [row.model_dump() for row in session.exec(select(OccupancyHour).order_by(OccupancyHour.hour)).all() if any(row.model_dump(exclude={"hour"}).values())]
+    crud.rebuild_occupancy(session=session)
+    session.expire_all()
+    rebuilt = [row.model_dump() for row in session.exec(select(OccupancyHour).order_by(OccupancyHour.hour)).all()]
+    assert rebuilt == incremental
@@ -0,0 +1,49 @@
+import asyncio
+import io
+import random
+import pytest
+from app.core.preview_cache import PreviewFrame
+from app.core.preview_filter import Image, PreviewFilter
+
+pytestmark = pytest.mark.skipif(Image is None, reason="needs Pillow")
+
+def jpeg(seed: int, quality: int = 90) -> bytes:
+    noise = random.Random(seed).randbytes(64 * 48)
+    buffer = io.BytesIO()
+    Image.frombytes("L", (64, 48), noise).resize((640, 480)).save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+def test_concurrent_posts_respect_the_rate():
+    preview_filter = PreviewFilter(max_fps=1, camera_max_fps={}, max_distance=4, low_size=160, low_quality=60)
+
+    async def post_all():
+        return await asyncio.gather(*(preview_filter.process(PreviewFrame(1, data=jpeg(seed)), True) for seed in range(10)))
+
+    reasons = asyncio.run(post_all())
+    assert reasons.count(None) == 1
+    assert reasons.count("rate") == 9
+    assert preview_filter.forwarded == 1
+
+def test_concurrent_copies_are_duplicates():
+    preview_filter = PreviewFilter(max_fps=0, camera_max_fps={}, max_distance=4, low_size=0, low_quality=60)
+    data = jpeg(0)
+
+    async def post_all():
+        return await asyncio.gather(*(preview_filter.process(PreviewFrame(1, data=data), False) for _ in range(5)))
+
+    reasons = asyncio.run(post_all())
+    assert reasons == [None] + ["duplicate"] * 4
+
+def test_unchanged_frame_gives_back_its_claim():
+    preview_filter = PreviewFilter(max_fps=0, camera_max_fps={}, max_distance=4, low_size=0, low_quality=60)
+    first = jpeg(0)
+
+    async def post(data):
+        return await preview_filter.process(PreviewFrame(1, data=data), False)
+
+    assert asyncio.run(post(first)) is None
+    # Same picture encoded again, other bytes but the same difference hash
+    assert asyncio.run(post(jpeg(0, quality=70))) == "unchanged"
+    # Still compared with the broadcast frame, not the dropped one
+    assert asyncio.run(post(first)) == "duplicate"
+    assert asyncio.run(post(jpeg(1))) is None
@@ -0,0 +1,63 @@
+"""Checks with EXPLAIN that the crud queries are answered through the schema indexes.
+
+Runs against a migrated SQLite file, set TEST_DATABASE_URL to check a Postgres database instead. Postgres plans small
+tables with sequential scans, so index usage is checked with enable_seqscan turned off.
+"""
+import os
+import random
+from datetime import datetime, timedelta, UTC
+import pytest
+from sqlalchemy import text
+from sqlmodel import Session, create_engine, select
+from bench.common import make_boat_pass
+from app import crud
+from app.core import occupancy, state_changes
+from app.core.migrations import migrate
+from app.models import BoatPass, BoundingBox, OcrResult
+
+SINCE = datetime.now(UTC) - timedelta(days=1)
+
+# (name, statement, indexes of which at least one has to show up in the plan)
+CASES = [
+    ("boat pass page", crud.boat_passes_page_statement(limit=50), ["ix_boatpass_timestamp_id"]),
+    ("boat pass page after cursor", crud.boat_passes_page_statement(limit=50, cursor=(SINCE + timedelta(hours=12), 100)), ["ix_boatpass_timestamp_id"]),
+    ("boat pass time range", crud.boat_passes_page_statement(limit=50, since=SINCE, until=SINCE + timedelta(hours=1)), ["ix_boatpass_timestamp_id"]),
+    ("boat pass boxes", select(BoundingBox).where(BoundingBox.boat_pass_id.in_([1, 2, 3])), ["ix_boundingbox_boat_pass_id"]),
+    ("box ocr results", select(OcrResult).where(OcrResult.bounding_box_id.in_([1, 2, 3])), ["ix_ocrresult_bounding_box_id"]),
+    ("open state by identifier", crud.open_state_by_identifier_statement(identifier="CZ1234"), ["ix_state_best_detected_identifier"]),
+    ("open states", crud.open_states_statement(), ["ix_state_departure_time", "ix_state_arrival_time"]),
+    ("dashboard counters", crud.dashboard_statement(since=SINCE), ["ix_state_arrival_time", "ix_state_departure_time"]),
+    ("dashboard states", crud.dashboard_states_statement(since=SINCE), ["ix_state_arrival_time", "ix_state_departure_time"]),
+    ("state changes after cursor", state_changes.changes_statement(horizon=10**9, limit=500, cursor=(1000, 0)), ["ix_state_change_version_id"]),
+    # The primary key index, named by Postgres and SQLite
+    ("occupancy range", occupancy.range_statement(since=SINCE - timedelta(days=180), until=SINCE), ["occupancyhour_pkey", "sqlite_autoindex_occupancyhour_1"]),
+]
+
+def explain(session: Session, statement) -> str:
+    dialect = session.get_bind().dialect
+    compiled = statement.compile(dialect=dialect, compile_kwargs={"literal_binds": True})
+    if dialect.name == "sqlite":
+        return "\n".join(row[-1] for row in session.execute(text(f"EXPLAIN QUERY PLAN {compiled}")))
+    return "\n".join(row[0] for row in session.execute(text(f"EXPLAIN {compiled}")))
+
+@pytest.fixture(scope="module")
+def session(tmp_path_factory):
+    db_url = os.environ.get("TEST_DATABASE_URL") or f"sqlite:///{tmp_path_factory.mktemp('plans') / 'plans.sqlite'}"
+    engine = create_engine(db_url, echo=False)
+    migrate(engine)
+    rng = random.Random(42)
+    with Session(engine) as session:
+        if session.exec(select(BoatPass.id).limit(1)).first() is None:
+            crud.create_boat_passes(session=session, boat_passes=[make_boat_pass(rng, boxes=2, ocr_per_box=2) for _ in range(500)], link=True)
+        if engine.dialect.name == "sqlite":
+            session.execute(text("ANALYZE"))
+            session.commit()
+        else:
+            session.execute(text("SET enable_seqscan = off"))
+        yield session
+    engine.dispose()
+
+@pytest.mark.parametrize("statement, indexes", [case[1:] for case in CASES], ids=[case[0] for case in CASES])
+def test_query_uses_index(session, statement, indexes):
+    plan = explain(session, statement)
+    assert any(index in plan for index in indexes), plan
@@ -0,0 +1,57 @@
+import asyncio
+import json
+import random
+from datetime import datetime, timedelta
+import pytest
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+from sqlmodel import Session, create_engine
+from app import crud
+from app.core.app_config import app_config
+from app.core.migrations import migrate
+from app.core.serialization import boat_pass_public_json, ocr_result_json, state_json
+from app.models import BoatPassPublic, BoundingBoxPublic, OcrResult, State
+from bench.common import make_boat_pass
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'serialization.sqlite'}")
+    migrate(engine)
+    rng = random.Random(6)
+    start = datetime(2026, 7, 1)
+    with Session(engine) as session:
+        crud.create_boat_passes(session=session, boat_passes=[make_boat_pass(rng, start + timedelta(minutes=minute), boxes=2, ocr_per_box=2) for minute in range(10)], link=True)
+        monkeypatch.setattr(app_config, "DETECTIONS_STORAGE", "compact")
+        crud.create_boat_passes(session=session, boat_passes=[make_boat_pass(rng, start + timedelta(minutes=minute), boxes=2, ocr_per_box=2) for minute in range(10, 20)], link=True)
+    yield engine
+    engine.dispose()
+
+def response_model_json(rows: list, response_model) -> bytes:
+    # What FastAPI does for a route returning the rows with this response_model
+    field = create_response_field(name="Response", type_=response_model)
+    return JSONResponse(asyncio.run(serialize_response(field=field, response_content=rows))).body
+
+def test_serializers_match_the_response_model_path(engine):
+    with Session(engine) as session:
+        boat_passes = crud.get_boat_passes_page(session=session, limit=100)
+        states = crud.get_states(session=session)
+        ocr_results = crud.get_all_ocr_results(session=session)
+        assert len(boat_passes) == 20 and states and len(ocr_results) == 20 * 2 * 2
+        # The response_model path reads boxes from their rows only
+        row_passes = [boat_pass for boat_pass in boat_passes if boat_pass.detections is None]
+        assert len(row_passes) == 10
+        assert json.loads(boat_pass_public_json.dump_json_list(row_passes)) == json.loads(response_model_json(row_passes, list[BoatPassPublic]))
+        assert json.loads(state_json.dump_json_list(states)) == json.loads(response_model_json(states, list[State]))
+        assert json.loads(ocr_result_json.dump_json_list(ocr_results)) == json.loads(response_model_json(ocr_results, list[OcrResult]))
+
+        # Rows expired by a commit are loaded again, not written as empty objects
+        session.commit()
+        assert json.loads(state_json.dump_json(states[0])) == json.loads(response_model_json(states[0], State))
+
+def test_public_models_keep_their_field_order(engine):
+    with Session(engine) as session:
+        boat_pass = crud.get_boat_passes_page(session=session, limit=1)[0]
+        document = json.loads(boat_pass_public_json.dump_json(boat_pass))
+    assert list(document) == list(BoatPassPublic.model_fields)
+    assert list(document["bounding_boxes"][0]) == list(BoundingBoxPublic.model_fields)
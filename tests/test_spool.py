@@ -0,0 +1,128 @@
+import os
+import random
+import pytest
+from sqlmodel import Session, create_engine, select
+from app import crud
+from app.core import spool
+from app.core.migrations import migrate
+from app.core.spool import IngestSpool
+from app.core.storage import image_path
+from app.models import BoatPass, SpoolCheckpoint
+from bench.common import make_boat_pass
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    # The images are not JPEGs, no thumbnails are made of them
+    monkeypatch.setattr(spool.thumbnails, "submit", lambda source, filename: None)
+    engine = create_engine(f"sqlite:///{tmp_path / 'spool.sqlite'}")
+    migrate(engine)
+    yield engine
+    engine.dispose()
+
+def open_spool(folder, batch_size: int = 2, max_attempts: int = 2) -> IngestSpool:
+    ingest_spool = IngestSpool(str(folder), batch_size, 10**9, 10**9, 0.1, max_attempts)
+    ingest_spool.open()
+    return ingest_spool
+
+def crash(ingest_spool: IngestSpool) -> None:
+    # The flocks go with the file descriptors, like when the worker dies
+    for segment in ingest_spool.segments:
+        segment.close()
+
+def drain_all(ingest_spool: IngestSpool, engine) -> int:
+    total = 0
+    while drained := ingest_spool.drain_once(engine):
+        total += drained
+    return total
+
+def stored_filenames(engine) -> list[str]:
+    with Session(engine) as session:
+        return sorted(session.exec(select(BoatPass.image_filename)).all())
+
+def segment_files(folder) -> list[str]:
+    return sorted(name for name in os.listdir(folder) if name != "rejected")
+
+def test_appended_passes_are_drained(engine, tmp_path):
+    rng = random.Random(1)
+    boat_passes = [make_boat_pass(rng, boxes=1, ocr_per_box=1) for _ in range(5)]
+    ingest_spool = open_spool(tmp_path / "spool")
+    for boat_pass in boat_passes:
+        assert ingest_spool.append(boat_pass, b"image") == len(b"image")
+    assert ingest_spool.pending_bytes() > 0
+
+    assert drain_all(ingest_spool, engine) == 5
+    assert ingest_spool.pending_bytes() == 0
+    assert stored_filenames(engine) == sorted(boat_pass.image_filename for boat_pass in boat_passes)
+    with open(image_path(boat_passes[0].image_filename), "rb") as f:
+        assert f.read() == b"image"
+    crash(ingest_spool)
+
+def test_crashed_worker_is_replayed_from_its_checkpoint(engine, tmp_path):
+    rng = random.Random(2)
+    boat_passes = [make_boat_pass(rng, boxes=1, ocr_per_box=1) for _ in range(5)]
+    crashed = open_spool(tmp_path / "spool")
+    for boat_pass in boat_passes:
+        crashed.append(boat_pass, b"image")
+    assert crashed.drain_once(engine) == 2
+    segment = crashed.segments[0].name
+    crash(crashed)
+
+    replaying = open_spool(tmp_path / "spool")
+    assert drain_all(replaying, engine) == 3
+    assert stored_filenames(engine) == sorted(boat_pass.image_filename for boat_pass in boat_passes)
+    # The replayed segment is removed with its checkpoint, only the new worker's own segment is left
+    assert segment_files(tmp_path / "spool") == [replaying.segments[0].name] != [segment]
+    with Session(engine) as session:
+        assert session.get(SpoolCheckpoint, segment) is None
+    crash(replaying)
+
+def test_truncated_tail_record_is_skipped(engine, tmp_path):
+    rng = random.Random(3)
+    boat_passes = [make_boat_pass(rng, boxes=1, ocr_per_box=1) for _ in range(3)]
+    crashed = open_spool(tmp_path / "spool")
+    for boat_pass in boat_passes:
+        crashed.append(boat_pass, b"image")
+    # A header promising more bytes than the crash let through
+    os.write(crashed.segments[0].fd, spool.RECORD_HEADER.pack(1000, 0, 0.0, 10) + b"cut short")
+    crash(crashed)
+
+    replaying = open_spool(tmp_path / "spool")
+    assert drain_all(replaying, engine) == 3
+    assert stored_filenames(engine) == sorted(boat_pass.image_filename for boat_pass in boat_passes)
+    assert segment_files(tmp_path / "spool") == [replaying.segments[0].name]
+    crash(replaying)
+
+def test_refused_record_is_set_aside(engine, tmp_path, monkeypatch):
+    create_boat_passes = crud.create_boat_passes
+    def refuse_poison(*, session, boat_passes, before_commit=None, link=False):
+        if any(boat_pass.raw_text == "POISON" for boat_pass in boat_passes):
+            raise ValueError("refused")
+        return create_boat_passes(session=session, boat_passes=boat_passes, before_commit=before_commit, link=link)
+    monkeypatch.setattr(crud, "create_boat_passes", refuse_poison)
+
+    rng = random.Random(4)
+    boat_passes = [make_boat_pass(rng, boxes=1, ocr_per_box=1) for _ in range(4)]
+    boat_passes[1].raw_text = "POISON"
+    ingest_spool = open_spool(tmp_path / "spool", batch_size=4, max_attempts=2)
+    offsets = []
+    for boat_pass in boat_passes:
+        offsets.append(ingest_spool.segments[-1].written)
+        ingest_spool.append(boat_pass, b"image")
+
+    failures = 0
+    for _ in range(20):
+        try:
+            if not ingest_spool.drain_once(engine):
+                break
+        except ValueError:
+            failures += 1
+    # Twice as a batch, then once on its own, the second attempt on its own sets it aside
+    assert failures == 3
+    assert ingest_spool.rejected == 1
+    assert stored_filenames(engine) == sorted(boat_pass.image_filename for index, boat_pass in enumerate(boat_passes) if index != 1)
+    base = os.path.join(tmp_path / "spool", "rejected", f"{ingest_spool.segments[0].name}.{offsets[1]}")
+    with open(f"{base}.json") as f:
+        assert "POISON" in f.read()
+    with open(f"{base}.jpg", "rb") as f:
+        assert f.read() == b"image"
+    crash(ingest_spool)
@@ -0,0 +1,55 @@
+import json
+from datetime import datetime
+import pytest
+from sqlalchemy import text
+from sqlmodel import Session, create_engine
+from app import crud
+from app.core.migrations import migrate
+from app.core.serialization import state_json
+from app.models import PaymentStatusEnum, StateBase, StateUpdate
+
+@pytest.fixture
+def session(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'changes.sqlite'}")
+    migrate(engine)
+    with Session(engine, expire_on_commit=False) as session:
+        yield session
+    engine.dispose()
+
+def read_all(session: Session, cursor: tuple[int, int], limit: int) -> tuple[list[int], tuple[int, int]]:
+    ids = []
+    while True:
+        states, cursor = crud.get_states_changed(session=session, limit=limit, cursor=cursor)
+        ids += [state.id for state in states]
+        if len(states) < limit:
+            return ids, cursor
+
+def test_paging_returns_every_change_once(session):
+    cursor = (crud.get_state_changes_horizon(session=session), 0)
+    created = [crud.create_state(session=session, state=StateBase(arrival_time=datetime(2026, 7, 1, hour))).id for hour in range(7)]
+    ids, cursor = read_all(session, cursor, limit=3)
+    assert ids == created
+
+    assert read_all(session, cursor, limit=3) == ([], cursor)
+    crud.update_state_payment(session=session, update_state=StateUpdate(id=created[2], payment_status=PaymentStatusEnum.zaplaceno))
+    crud.update_state_payment(session=session, update_state=StateUpdate(id=created[0], payment_status=PaymentStatusEnum.zaplaceno))
+    # In the order of the changes, not of the ids
+    assert read_all(session, cursor, limit=1)[0] == [created[2], created[0]]
+
+def test_states_from_before_the_cursor_are_not_returned(session):
+    first = crud.create_state(session=session, state=StateBase(arrival_time=datetime(2026, 7, 1)))
+    cursor = (crud.get_state_changes_horizon(session=session), 0)
+    second = crud.create_state(session=session, state=StateBase(arrival_time=datetime(2026, 7, 2)))
+    assert read_all(session, cursor, limit=10)[0] == [second.id]
+    assert first.id != second.id
+
+def test_edit_timestamp_is_naive_utc(session):
+    state = crud.create_state(session=session, state=StateBase(arrival_time=datetime(2026, 7, 1)))
+    assert state.edit_timestamp.tzinfo is None
+    stored = session.execute(text("SELECT edit_timestamp FROM state WHERE id = :id"), {"id": state.id}).scalar_one()
+    assert stored == state.edit_timestamp.isoformat(sep=" ")
+
+def test_change_version_is_not_in_the_output(session):
+    state = crud.create_state(session=session, state=StateBase(arrival_time=datetime(2026, 7, 1)))
+    assert "change_version" not in json.loads(state_json.dump_json(state))
+    assert "change_version" not in state.model_dump()
@@ -0,0 +1,55 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from sqlmodel import Session, create_engine
+from app.core.migrations import migrate
+from app.core.security import create_access_token
+from app.core.user_cache import user_cache
+from app.models import User
+from app.routers.deps import get_current_user
+
+def test_deactivated_user_is_rejected_on_the_next_request(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'users.sqlite'}")
+    migrate(engine)
+    with Session(engine, expire_on_commit=False) as session:
+        user = User(full_name="Harbour Master", username="master", hashed_password="-")
+        session.add(user)
+        session.commit()
+    token = create_access_token(user.id)
+    user_cache.clear()
+    try:
+        with Session(engine, expire_on_commit=False) as session:
+            assert asyncio.run(get_current_user(session, token)).username == "master"
+        assert user_cache.get(user.id, token) is not None
+
+        with Session(engine) as session:
+            user = session.get(User, user.id)
+            user.is_active = False
+            session.add(user)
+            session.commit()
+
+        with Session(engine, expire_on_commit=False) as session:
+            with pytest.raises(HTTPException) as error:
+                asyncio.run(get_current_user(session, token))
+        assert error.value.status_code == 400
+    finally:
+        user_cache.clear()
+        engine.dispose()
+
+def test_rolled_back_change_keeps_the_cached_user(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'users.sqlite'}")
+    migrate(engine)
+    with Session(engine, expire_on_commit=False) as session:
+        user = User(full_name="Harbour Master", username="master", hashed_password="-")
+        session.add(user)
+        session.commit()
+    user_cache.put(user.id, "token", user)
+    try:
+        with Session(engine) as session:
+            session.get(User, user.id).is_active = False
+            session.flush()
+            session.rollback()
+        assert user_cache.get(user.id, "token") is not None
+    finally:
+        user_cache.clear()
+        engine.dispose()